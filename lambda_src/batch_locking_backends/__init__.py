@@ -15,6 +15,12 @@ The modules should expose:
 - `is_batch_processing(batch_id)` to return true for state (2) and false otherwise
 - `finish_batch_processing(batch_id, response)` to move lock to state (3) and store a response value
 - `get_response_for_batch(batch_id)` to return the response value for the batch on stage (3) and None otherwise
+- `wait_for_batch_response(batch_id, timeout)` to wait, with backoff, for a batch in state (2) to reach (3) and
+  return its response, or None if it is still processing after `timeout` seconds
+- `claim_batch(batch_id, lease_seconds)` to move a lock to (2) unless another live invocation holds it, taking
+  over locks held past their lease or released by `release_batch(batch_id)`, and return the number of checkpoints
+- `BatchCheckpoint(batch_id)` to store completed rows while the batch is processed, and
+  `get_checkpoints(batch_id, checkpoints)` to return them by row number when a claimed batch is resumed
 
 after a batch is finalized, locks should exist for at least 24h to allow for debugging
 '''
@@ -11,13 +11,31 @@ In dynamodb, this will correspond to Items like:
 1. No item
 2. {"batch_id": "558c5ffb-08a7-4b15-aba7-b7f68edd567f", "locked": true}
 3. {"batch_id": "558c5ffb-08a7-4b15-aba7-b7f68edd567f", "locked": false, "response": ...}
+
+Batches claimed with claim_batch() hold the lock until "locked_until", after which
+the invocation holding it is assumed to have died and a retry may take it over.
+Completed rows are checkpointed in chunks while the batch is processed, so that
+the retry only processes the rows that are missing:
+
+{"batch_id": "558c5ffb-08a7-4b15-aba7-b7f68edd567f", "locked": true, "locked_until": 1700000900, "checkpoints": 2}
+{"batch_id": "558c5ffb-08a7-4b15-aba7-b7f68edd567f#checkpoint#1", "rows": "[[0, ...], [1, ...]]"}
+{"batch_id": "558c5ffb-08a7-4b15-aba7-b7f68edd567f#checkpoint#2", "s3_key": "..."}
+
+Responses and chunks too large for an item are written to BATCH_LOCKING_OVERFLOW_S3_URI
+if it is set, and the item only keeps their S3 key, e.g.
+
+{"batch_id": "558c5ffb-08a7-4b15-aba7-b7f68edd567f", "locked": false, "response_s3_key": "...", "response_size": 1048576, "response_sha256": "..."}
 '''
 
 import os
 from typing import Dict, Text, List, Any, Tuple, Union, Optional
+from urllib.parse import urlparse
 import boto3
-from json import dumps
-from hashlib import md5
+from json import dumps, loads
+from hashlib import md5, sha256
+from random import uniform
+from time import sleep, time
+from timeit import default_timer as timer
 
 from botocore.exceptions import ClientError
 from ..utils import LOG, ResponseType
@@ -27,6 +45,14 @@ AWS_REGION = os.environ.get(
 )  # Placeholder while in dev TODO: change as variable/header
 DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE_NAME')
 TTL = os.environ.get('DYNAMODB_TABLE_TTL', 86400)
+LOCK_POLL_INITIAL_SECONDS = 0.1
+LOCK_POLL_MAX_SECONDS = 2.0
+CHECKPOINT_INTERVAL_SECONDS = float(
+    os.environ.get('DYNAMODB_CHECKPOINT_INTERVAL_SECONDS', 5)
+)
+# DynamoDB items are limited to 400 KB
+MAX_ITEM_BYTES = 350_000
+OVERFLOW_S3_URI = urlparse(os.environ.get('BATCH_LOCKING_OVERFLOW_S3_URI', ''))
 
 if DYNAMODB_TABLE:
     table = boto3.resource('dynamodb', region_name=AWS_REGION).Table(DYNAMODB_TABLE)
@@ -34,6 +60,14 @@ if DYNAMODB_TABLE:
 else:
     BATCH_LOCKING_ENABLED = False
 
+if OVERFLOW_S3_URI.scheme == 's3':
+    s3 = boto3.client('s3', region_name=AWS_REGION)
+
+
+def expires_at() -> int:
+    """Epoch second at which DynamoDB TTL may delete an item written now."""
+    return int(time()) + int(TTL)
+
 
 def finish_batch_processing(
     batch_id: Text, response: ResponseType, res_data: List[List[Union[int, Dict]]]
@@ -49,6 +83,26 @@ def finish_batch_processing(
     Returns:
         None
     """
+    response_json = dumps(response)
+    if len(response_json) > MAX_ITEM_BYTES and OVERFLOW_S3_URI.scheme:
+        s3_key = f'{OVERFLOW_S3_URI.path.lstrip("/")}{batch_id}/response.json'
+        s3.put_object(
+            Bucket=OVERFLOW_S3_URI.netloc,
+            Key=s3_key,
+            Body=response_json.encode(),
+            ContentType='application/json',
+        )
+        table.put_item(
+            Item={
+                'batch_id': batch_id,
+                'locked': False,
+                'response_s3_key': s3_key,
+                'response_size': len(response_json),
+                'response_sha256': sha256(response_json.encode()).hexdigest(),
+                'ttl': expires_at(),
+            }
+        )
+        return
 
     try:
         table.put_item(
@@ -56,7 +110,7 @@ def finish_batch_processing(
                 'batch_id': batch_id,
                 'locked': False,
                 'response': response,
-                'ttl': TTL,
+                'ttl': expires_at(),
             }
         )
     except ClientError as ce:
@@ -91,7 +145,7 @@ def finish_batch_processing(
                     'batch_id': batch_id,
                     'locked': False,
                     'response': size_exceeded_response,
-                    'ttl': TTL,
+                    'ttl': expires_at(),
                 }
             )
 
@@ -106,7 +160,34 @@ def initialize_batch(batch_id: Text):
     Returns:
         None
     """
-    table.put_item(Item={'batch_id': batch_id, 'locked': True, 'ttl': TTL})
+    table.put_item(Item={'batch_id': batch_id, 'locked': True, 'ttl': expires_at()})
+
+
+def _load_response(item: Dict[Text, Any]) -> Optional[ResponseType]:
+    """
+    Retrieve the response stored in a batch item, from S3 if it overflowed.
+
+    Args:
+        item (Dict[Text, Any]): The batch item.
+
+    Returns:
+        Optional[ResponseType]: The response. None if absent or unreadable.
+    """
+    if 'response_s3_key' not in item:
+        return item.get('response')
+
+    try:
+        obj = s3.get_object(Bucket=OVERFLOW_S3_URI.netloc, Key=item['response_s3_key'])
+        body = obj['Body'].read()
+    except ClientError as ce:
+        LOG.error(f'Stored response for batch {item["batch_id"]} is unreadable: {ce}')
+        return None
+
+    if sha256(body).hexdigest() != item['response_sha256']:
+        LOG.error(f'Stored response for batch {item["batch_id"]} is corrupted.')
+        return None
+
+    return loads(body)
 
 
 def _get_lock(batch_id: Text) -> Optional[bool]:
@@ -119,11 +200,76 @@ def _get_lock(batch_id: Text) -> Optional[bool]:
     Returns:
         Optional[bool]: Value of the locked key. None if absent.
     """
-    item = table.get_item(Key={'batch_id': batch_id})
+    item = table.get_item(
+        Key={'batch_id': batch_id},
+        ProjectionExpression='#locked',
+        ExpressionAttributeNames={'#locked': 'locked'},
+        ConsistentRead=True,
+    )
 
     return item['Item']['locked'] if 'Item' in item else None
 
 
+def get_batch_state(batch_id: Text) -> Tuple[Optional[bool], Optional[ResponseType]]:
+    """
+    Retreive lock and response for a batch ID in a single strongly consistent read.
+
+    Args:
+        batch_id (Text): The batch ID to be retrieved.
+
+    Returns:
+        Tuple[Optional[bool], Optional[ResponseType]]: Value of the locked key and the
+        response. None for either if absent.
+    """
+    item = table.get_item(Key={'batch_id': batch_id}, ConsistentRead=True)
+
+    if 'Item' not in item:
+        return None, None
+
+    return item['Item']['locked'], _load_response(item['Item'])
+
+
+def wait_for_batch_response(batch_id: Text, timeout: float) -> Optional[ResponseType]:
+    """
+    Wait for a batch being processed by another invocation to finish, polling with
+    exponential backoff and jitter between LOCK_POLL_INITIAL_SECONDS and
+    LOCK_POLL_MAX_SECONDS.
+
+    Args:
+        batch_id (Text): The batch ID to wait for.
+        timeout (float): Seconds after which to give up waiting.
+
+    Returns:
+        Optional[ResponseType]: Response stored for the batch. None if the batch is
+        still processing after timeout seconds, or finished without storing one.
+    """
+    start_time = timer()
+    delay = LOCK_POLL_INITIAL_SECONDS
+    reads = 0
+
+    while True:
+        locked, response = get_batch_state(batch_id)
+        reads += 1
+        waited = timer() - start_time
+
+        if locked is not True:
+            LOG.info(
+                f'Batch {batch_id} finished after waiting {waited:.3f}s '
+                f'({reads} reads, response stored: {response is not None}).'
+            )
+            return response
+
+        if waited + delay / 2 >= timeout:
+            LOG.info(
+                f'Batch {batch_id} still processing after waiting {waited:.3f}s '
+                f'({reads} reads).'
+            )
+            return None
+
+        sleep(min(delay / 2 + uniform(0, delay / 2), timeout - waited))
+        delay = min(delay * 2, LOCK_POLL_MAX_SECONDS)
+
+
 def is_batch_processing(batch_id: Text) -> bool:
     """
     Check if a batch ID is being processed already, i.e is locked.
@@ -163,4 +309,201 @@ def get_response_for_batch(batch_id: Text) -> Optional[ResponseType]:
     """
     item = table.get_item(Key={'batch_id': batch_id})
 
-    return item['Item']['response'] if 'Item' in item else None
+    return _load_response(item['Item']) if 'Item' in item else None
+
+
+def count_request(key: Text, ttl_seconds: int) -> int:
+    """
+    Atomically increment a request counter, e.g. for rate limits shared between
+    containers. Counters share the table with batch locks, under keys that are
+    not batch IDs, and expire with the table's TTL.
+
+    Args:
+        key (Text): Key of the counter.
+        ttl_seconds (int): Seconds for which the counter is needed.
+
+    Returns:
+        int: Value of the counter after the increment.
+    """
+    item = table.update_item(
+        Key={'batch_id': key},
+        UpdateExpression='SET #ttl = if_not_exists(#ttl, :ttl) ADD #hits :one',
+        ExpressionAttributeNames={'#hits': 'hits', '#ttl': 'ttl'},
+        ExpressionAttributeValues={':one': 1, ':ttl': int(time()) + ttl_seconds},
+        ReturnValues='UPDATED_NEW',
+    )
+
+    return int(item['Attributes']['hits'])
+
+
+def claim_batch(batch_id: Text, lease_seconds: float) -> Tuple[bool, int]:
+    """
+    Lock a batch unless another invocation holds the lock or already stored its
+    response. Locks whose holder outlived locked_until, or released by
+    release_batch(), are taken over.
+
+    Args:
+        batch_id (Text): The batch ID to be locked.
+        lease_seconds (float): Seconds until the lock may be taken over, i.e. how
+            long this invocation can still run.
+
+    Returns:
+        Tuple[bool, int]: Whether the batch was claimed, and the number of
+        checkpoints stored for it.
+    """
+    now = int(time())
+    try:
+        item = table.update_item(
+            Key={'batch_id': batch_id},
+            UpdateExpression=(
+                'SET #locked = :true, #locked_until = :locked_until, '
+                '#ttl = if_not_exists(#ttl, :ttl)'
+            ),
+            ConditionExpression=(
+                'attribute_not_exists(#locked) '
+                'OR (#locked = :false AND attribute_not_exists(#response) '
+                'AND attribute_not_exists(#response_s3_key)) '
+                'OR (#locked = :true AND #locked_until < :now)'
+            ),
+            ExpressionAttributeNames={
+                '#locked': 'locked',
+                '#locked_until': 'locked_until',
+                '#response': 'response',
+                '#response_s3_key': 'response_s3_key',
+                '#ttl': 'ttl',
+            },
+            ExpressionAttributeValues={
+                ':true': True,
+                ':false': False,
+                ':now': now,
+                ':locked_until': now + int(lease_seconds) + 1,
+                ':ttl': expires_at(),
+            },
+            ReturnValues='ALL_NEW',
+        )
+    except ClientError as ce:
+        if ce.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False, 0
+        raise
+
+    return True, int(item['Attributes'].get('checkpoints', 0))
+
+
+def release_batch(batch_id: Text):
+    """
+    Unlock a batch without storing a response, so that a retry of the request
+    claims it and processes the rows that were not checkpointed.
+
+    Args:
+        batch_id (Text): The batch ID to be unlocked.
+
+    Returns:
+        None
+    """
+    table.update_item(
+        Key={'batch_id': batch_id},
+        UpdateExpression='SET #locked = :false REMOVE #locked_until',
+        ExpressionAttributeNames={'#locked': 'locked', '#locked_until': 'locked_until'},
+        ExpressionAttributeValues={':false': False},
+    )
+
+
+def get_checkpoints(batch_id: Text, checkpoints: int) -> Dict[int, Any]:
+    """
+    Retrieve the rows checkpointed for a batch.
+
+    Args:
+        batch_id (Text): The batch ID whose checkpoints are retrieved.
+        checkpoints (int): Number of checkpoints, as returned by claim_batch().
+
+    Returns:
+        Dict[int, Any]: Result of each checkpointed row by row number. Chunks that
+        were not written completely are missing.
+    """
+    rows: Dict[int, Any] = {}
+
+    for n in range(1, checkpoints + 1):
+        item = table.get_item(
+            Key={'batch_id': f'{batch_id}#checkpoint#{n}'}, ConsistentRead=True
+        ).get('Item')
+        if not item:
+            continue
+
+        if 's3_key' in item:
+            try:
+                chunk = s3.get_object(Bucket=OVERFLOW_S3_URI.netloc, Key=item['s3_key'])
+                chunk_rows = loads(chunk['Body'].read())
+            except ClientError as ce:
+                LOG.error(ce)  # the rows are processed again
+                continue
+        else:
+            chunk_rows = loads(item['rows'])
+
+        rows.update((row_number, result) for row_number, result in chunk_rows)
+
+    LOG.info(f'Batch {batch_id} resumed with {len(rows)} checkpointed row(s).')
+    return rows
+
+
+class BatchCheckpoint:
+    """
+    Collects the completed rows of a batch and writes them to the table in
+    chunks, at most every CHECKPOINT_INTERVAL_SECONDS.
+    """
+
+    def __init__(self, batch_id: Text):
+        self.batch_id = batch_id
+        self.pending: List[Text] = []
+        self.flushed_at = timer()
+
+    def add(self, row: List[Any]):
+        self.pending.append(dumps(row, default=str))
+        if timer() - self.flushed_at >= CHECKPOINT_INTERVAL_SECONDS:
+            self.flush()
+
+    def flush(self):
+        self.flushed_at = timer()
+        if not self.pending:
+            return
+
+        chunk = f'[{", ".join(self.pending)}]'
+        if len(chunk) > MAX_ITEM_BYTES and not OVERFLOW_S3_URI.scheme:
+            LOG.debug(f'Checkpoint of {len(chunk)} bytes is too large, skipping it.')
+            self.pending = []
+            return
+
+        try:
+            self._write_chunk(chunk)
+            LOG.debug(f'Checkpointed {len(self.pending)} row(s) of {self.batch_id}.')
+        except ClientError as ce:
+            LOG.error(ce)  # the rows are processed again if the batch is resumed
+
+        self.pending = []
+
+    def _write_chunk(self, chunk: Text):
+        n = table.update_item(
+            Key={'batch_id': self.batch_id},
+            UpdateExpression='ADD #checkpoints :one',
+            ExpressionAttributeNames={'#checkpoints': 'checkpoints'},
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='UPDATED_NEW',
+        )['Attributes']['checkpoints']
+        item = {
+            'batch_id': f'{self.batch_id}#checkpoint#{n}',
+            'ttl': expires_at(),
+        }
+
+        if len(chunk) > MAX_ITEM_BYTES:
+            item['s3_key'] = (
+                f'{OVERFLOW_S3_URI.path.lstrip("/")}{self.batch_id}/{n}.json'
+            )
+            s3.put_object(
+                Bucket=OVERFLOW_S3_URI.netloc,
+                Key=item['s3_key'],
+                Body=chunk.encode(),
+                ContentType='application/json',
+            )
+        else:
+            item['rows'] = chunk
+
+        table.put_item(Item=item)
@@ -0,0 +1,190 @@
+'''
+Keep-alive connection pooling for urllib.
+
+urllib.request opens a new connection, and pays for a new TCP and TLS handshake,
+for every request it makes. KeepAliveHTTPSHandler instead checks connections out
+of a per-container pool keyed by (scheme, host, port), so that rows, pages and
+warm invocations calling the same host reuse the same connections.
+
+Responses are read in full before the connection is returned to the pool, which
+is how the call drivers consume them anyway.
+'''
+
+import http.client
+import socket
+import ssl
+from collections import defaultdict
+from io import BytesIO
+from os import environ
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+from typing import Any, DefaultDict, Dict, List, Tuple
+from urllib import request
+from urllib.error import URLError
+from urllib.parse import urlsplit
+from urllib.response import addinfourl
+
+from .utils import LOG
+
+MAX_CONNECTIONS_PER_HOST = int(environ.get('HTTPS_POOL_MAX_CONNECTIONS_PER_HOST', 32))
+IDLE_TIMEOUT_SECONDS = float(environ.get('HTTPS_POOL_IDLE_TIMEOUT_SECONDS', 30))
+# requests re-sent when a reused connection turns out to be closed, as the server
+# may have processed the first attempt
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+PoolKey = Tuple[str, str, int]
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of idle HTTPS connections.
+
+    At most max_connections_per_host connections per key are checked out at
+    once, further callers block until one is released. Idle connections are
+    closed once they have not been used for idle_timeout seconds.
+    """
+
+    def __init__(self, max_connections_per_host: int, idle_timeout: float):
+        self.max_connections_per_host = max_connections_per_host
+        self.idle_timeout = idle_timeout
+        self._idle: DefaultDict[
+            PoolKey, List[Tuple[http.client.HTTPSConnection, float]]
+        ] = defaultdict(list)
+        self._slots: Dict[PoolKey, BoundedSemaphore] = {}
+        self._lock = Lock()
+        self._context = ssl.create_default_context()
+
+    def _evict_idle(self, now: float):
+        for key, connections in self._idle.items():
+            fresh = []
+            for conn, last_used in connections:
+                if now - last_used > self.idle_timeout:
+                    conn.close()
+                else:
+                    fresh.append((conn, last_used))
+            connections[:] = fresh
+
+    def acquire(
+        self, key: PoolKey, timeout: Any
+    ) -> Tuple[http.client.HTTPSConnection, bool]:
+        """
+        Checks out a connection for key, reusing an idle one when possible.
+
+        Returns:
+            Tuple[http.client.HTTPSConnection, bool]: The connection, and whether
+            it was reused from the pool.
+        """
+        with self._lock:
+            slots = self._slots.setdefault(
+                key, BoundedSemaphore(self.max_connections_per_host)
+            )
+        slots.acquire()
+
+        with self._lock:
+            self._evict_idle(monotonic())
+            idle = self._idle[key]
+            if idle:
+                conn, _ = idle.pop()  # most recently used is least likely stale
+                # the connection keeps the timeout of the request that opened it
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(
+                        socket.getdefaulttimeout()
+                        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT  # type: ignore
+                        else timeout
+                    )
+                return conn, True
+
+        _, host, port = key
+        return (
+            http.client.HTTPSConnection(
+                host, port, timeout=timeout, context=self._context
+            ),
+            False,
+        )
+
+    def release(self, key: PoolKey, conn: http.client.HTTPSConnection, reusable: bool):
+        if reusable:
+            with self._lock:
+                self._idle[key].append((conn, monotonic()))
+        else:
+            conn.close()
+        self._slots[key].release()
+
+    def clear(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for conn, _ in connections:
+                    conn.close()
+            self._idle.clear()
+
+
+POOL = ConnectionPool(MAX_CONNECTIONS_PER_HOST, IDLE_TIMEOUT_SECONDS)
+
+
+class KeepAliveHTTPSHandler(request.HTTPSHandler):
+    """
+    urllib handler serving https:// requests from a ConnectionPool.
+
+    Requests going through a proxy are left to the default HTTPSHandler.
+    """
+
+    def __init__(self, pool: ConnectionPool = POOL):
+        super().__init__()
+        self.pool = pool
+
+    def https_open(self, req: request.Request):
+        if req._tunnel_host:  # type: ignore
+            return super().https_open(req)
+
+        if not req.host:
+            raise URLError('no host given')
+
+        parsed_host = urlsplit(f'//{req.host}')
+        key = ('https', parsed_host.hostname or '', parsed_host.port or 443)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers = {name.title(): val for name, val in headers.items()}
+
+        while True:
+            conn, reused = self.pool.acquire(key, req.timeout)
+            try:
+                conn.request(
+                    req.get_method(),
+                    req.selector,
+                    req.data,
+                    headers,
+                    encode_chunked=req.has_header('Transfer-encoding'),
+                )
+                res = conn.getresponse()
+                body = res.read()
+            except (
+                http.client.RemoteDisconnected,
+                ConnectionResetError,
+                BrokenPipeError,
+            ) as e:
+                self.pool.release(key, conn, False)
+                if reused and req.get_method() in IDEMPOTENT_METHODS:
+                    # the server closed the idle connection, retry on a new one
+                    LOG.debug(f'Discarding stale connection to {req.host}: {e!r}')
+                    continue
+                raise URLError(e)
+            except OSError as e:
+                self.pool.release(key, conn, False)
+                raise URLError(e)
+            except BaseException:
+                self.pool.release(key, conn, False)
+                raise
+
+            self.pool.release(key, conn, not res.will_close)
+            break
+
+        response = addinfourl(BytesIO(body), res.msg, req.get_full_url(), res.status)
+        response.msg = res.reason  # type: ignore
+        return response
+
+
+def build_opener() -> request.OpenerDirector:
+    """Returns an opener using pooled keep-alive HTTPS connections."""
+    return request.build_opener(KeepAliveHTTPSHandler())
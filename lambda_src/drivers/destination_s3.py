@@ -1,22 +1,103 @@
 import json
 import os
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from random import sample
-from typing import Any, AnyStr, Dict, Generator, List, Optional, Text, Tuple, Union
-from urllib.parse import urlparse
-from time import strftime
+from threading import BoundedSemaphore, Lock
+from typing import (
+    Any,
+    AnyStr,
+    DefaultDict,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Text,
+    Tuple,
+    Union,
+)
+from urllib.parse import parse_qsl, urlparse
+from time import monotonic, strftime
 import re
+from string import Formatter
 from hashlib import sha256
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from ..log import format_trace
 from ..utils import LOG, DataMetadata
 
 SAMPLE_SIZE: int = 10
 MAX_JSON_FILE_SIZE: int = 15 * 1024 * 1024 * 1024
 AWS_REGION = os.environ.get('AWS_REGION')
-S3_CLIENT = boto3.client('s3', region_name=AWS_REGION)
+S3_WRITE_CONCURRENCY = int(os.environ.get('S3_WRITE_CONCURRENCY', 16))
+S3_MAX_IN_FLIGHT_WRITES = int(os.environ.get('S3_MAX_IN_FLIGHT_WRITES', 64))
+S3_CLIENT = boto3.client(
+    's3',
+    region_name=AWS_REGION,
+    config=Config(max_pool_connections=S3_WRITE_CONCURRENCY),
+)
 MANIFEST_FILENAME = 'MANIFEST.json'
 MANIESTS_FOLDER_NAME = 'meta'
+DEFAULT_PART_SIZE: int = 64 * 1024 * 1024
+
+# Row objects are uploaded in the background while the call driver processes
+# the next rows. write() blocks once S3_MAX_IN_FLIGHT_WRITES uploads are pending,
+# and finalize() waits for all uploads of the batch before writing the manifest.
+UPLOADS = ThreadPoolExecutor(
+    max_workers=S3_WRITE_CONCURRENCY, thread_name_prefix='destination_s3'
+)
+_in_flight_writes = BoundedSemaphore(S3_MAX_IN_FLIGHT_WRITES)
+_pending_writes: DefaultDict[Text, Dict[int, Future]] = defaultdict(dict)
+_pending_writes_lock = Lock()
+# set in the manifest entries of rows whose upload failed, see wait_for_writes()
+UPLOAD_ERROR_KEY = '_upload_error'
+
+
+class PartBuffer:
+    """
+    Row results of a batch buffered into the next NDJSON part file, along with
+    the manifest entries of those rows, whose 'uri' is set once the part is
+    flushed.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.part_index = 0
+        self.chunks: List[bytes] = []
+        self.size = 0
+        self.entries: Dict[int, Dict[Text, Any]] = {}
+        self.last_written = monotonic()
+
+
+_part_buffers: DefaultDict[Text, PartBuffer] = defaultdict(PartBuffer)
+_part_buffers_lock = Lock()
+# buffers of batches that never reached finalize(), e.g. because the invocation
+# crashed or timed out, are dropped once idle for longer than a Lambda can run
+PART_BUFFER_MAX_IDLE_SECONDS = 900
+
+# batches whose manifest was written, most recent last, so that rows abandoned at
+# the deadline and finishing later cannot overwrite what the manifest points to
+MAX_FINALIZED_BATCHES = 1024
+_finalized_batches: 'OrderedDict[Text, None]' = OrderedDict()
+
+
+def is_finalized(batch_id: Text) -> bool:
+    with _pending_writes_lock:
+        return batch_id in _finalized_batches
+
+
+def set_finalized(batch_id: Text, finalized: bool):
+    with _pending_writes_lock:
+        if not finalized:
+            _finalized_batches.pop(batch_id, None)
+            return
+        _finalized_batches[batch_id] = None
+        _finalized_batches.move_to_end(batch_id)
+        while len(_finalized_batches) > MAX_FINALIZED_BATCHES:
+            _finalized_batches.popitem(last=False)
 
 
 def parse_destination_uri(destination: Text) -> Tuple[Text, Text]:
@@ -33,6 +114,21 @@ def parse_destination_uri(destination: Text) -> Tuple[Text, Text]:
     return (parsed_url.netloc, strftime(parsed_url.path[1:]))  # remove leading slash
 
 
+@lru_cache(maxsize=32)
+def parse_batch_destination_uri(destination: Text, batch_id: Text) -> Tuple[Text, Text]:
+    """Parses the URL into bucket and prefix once per batch, so that every row of
+    the batch is written under the same strftime() prefix.
+
+    Args:
+        destination (Text): Destination URI from the request headers.
+        batch_id (Text): Batch ID of the request.
+
+    Returns:
+        Tuple[Text, Text]: Bucket and prefix.
+    """
+    return parse_destination_uri(destination)
+
+
 def estimated_record_size(records: List[Dict[Text, Any]]) -> float:
     """A helper utility to get a rough (really rough) estimate of
     the size of a single record in a list of dictionary objects.
@@ -79,6 +175,114 @@ def write_to_s3(bucket: Text, filename: Text, content: AnyStr) -> Dict[Text, Any
     )
 
 
+def parse_destination_options(destination: Text) -> Dict[Text, Text]:
+    """Parses the options in the query string of the destination URI, e.g.
+    s3://bucket/prefix/?coalesce=true&part_size=1048576
+
+    Args:
+        destination (Text): Destination URI from the request headers.
+
+    Returns:
+        Dict[Text, Text]: Option names and values.
+    """
+    return dict(parse_qsl(urlparse(destination).query))
+
+
+def write_to_s3_in_background(
+    batch_id: Text,
+    entries: Dict[int, Dict[Text, Any]],
+    bucket: Text,
+    filename: Text,
+    content: AnyStr,
+):
+    """Uploads content in the background. Once the upload completes, its outcome is
+    kept in the manifest entries of the rows, and it is no longer pending, so that
+    batches that are never finalized do not keep their uploads around.
+
+    Args:
+        batch_id (Text): Batch ID of the rows.
+        entries (Dict[int, Dict[Text, Any]]): Manifest entries of the rows by index.
+    """
+    _in_flight_writes.acquire()
+    try:
+        future = UPLOADS.submit(write_to_s3, bucket, filename, content)
+    except BaseException:
+        _in_flight_writes.release()
+        raise
+
+    with _pending_writes_lock:
+        for row_index in entries:
+            _pending_writes[batch_id][row_index] = future
+
+    def on_done(future: Future):
+        _in_flight_writes.release()
+        error = future.exception()
+        for entry in entries.values():
+            if error is None:
+                entry['response'] = future.result()
+            else:
+                entry[UPLOAD_ERROR_KEY] = error
+
+        with _pending_writes_lock:
+            pending = _pending_writes.get(batch_id, {})
+            for row_index in entries:
+                if pending.get(row_index) is future:
+                    del pending[row_index]
+            if not pending:
+                _pending_writes.pop(batch_id, None)
+
+    future.add_done_callback(on_done)
+
+
+def wait_for_writes(batch_id: Text, datum: List[List[Any]]):
+    """Waits for the background uploads of a batch, setting the S3 response in the
+    row results of datum, or replacing them with an error if the upload failed.
+
+    Args:
+        batch_id (Text): Batch ID of the uploads to wait for.
+        datum (List[List[Any]]): Row numbers and row results of the batch.
+    """
+    with _pending_writes_lock:
+        pending = _pending_writes.pop(batch_id, {})
+
+    if pending:
+        LOG.debug(f'Waiting for {len(pending)} writes of batch {batch_id}.')
+
+    for row in datum:
+        if not isinstance(row, list):
+            continue
+        future = pending.get(row[0])
+        try:
+            if future is not None:
+                row[1]['response'] = future.result()
+            elif isinstance(row[1], dict) and UPLOAD_ERROR_KEY in row[1]:
+                # the upload completed before the batch was finalized
+                raise row[1].pop(UPLOAD_ERROR_KEY)
+        except Exception as e:
+            row[1] = [{'error': repr(e), 'trace': format_trace(e)}]
+
+
+def start_batch(destination: Text, batch_id: Text):
+    """Prepares to write the rows of a batch, in the invocation processing them,
+    which may run in another container than the one that initialized the batch.
+    """
+    set_finalized(batch_id, False)  # the batch may be processed again
+    drop_part_buffers(batch_id)
+
+
+def drop_part_buffers(batch_id: Text):
+    """Drops the rows buffered for an earlier run of the batch, and those of
+    batches abandoned without being finalized.
+    """
+    now = monotonic()
+    with _part_buffers_lock:
+        for b in list(_part_buffers):
+            buffer = _part_buffers[b]
+            if b == batch_id or now - buffer.last_written > PART_BUFFER_MAX_IDLE_SECONDS:
+                LOG.debug(f'Dropping {len(buffer.entries)} rows buffered for {b}.')
+                del _part_buffers[b]
+
+
 def initialize(destination: Text, batch_id: Text):
     bucket, prefix = parse_destination_uri(destination)
     content = ''  # We use empty body for creating a folder
@@ -90,13 +294,114 @@ def initialize(destination: Text, batch_id: Text):
         write_to_s3(bucket, prefix_folder, content)
 
 
+def flush_part(bucket: Text, prefix: Text, batch_id: Text, buffer: PartBuffer):
+    """Uploads the rows buffered for a batch as its next part file and sets the
+    part's URI in their manifest entries. Called with buffer.lock held.
+    """
+    if not buffer.chunks:
+        return
+
+    content = b''.join(buffer.chunks)
+    part_name = f'part_{buffer.part_index}'
+    prefixed_filename = (
+        f'{prefix}{batch_id}_{part_name}.ndjson'
+        if prefix.endswith('/')
+        else prefix.format(
+            hash=sha256(content).hexdigest(),
+            batch_id=batch_id,
+            row_index=part_name,
+        )
+    )
+    for entry in buffer.entries.values():
+        entry['uri'] = f's3://{bucket}/{prefixed_filename}'
+
+    LOG.debug(f'Writing {len(buffer.entries)} rows to {prefixed_filename}.')
+    write_to_s3_in_background(
+        batch_id, buffer.entries, bucket, prefixed_filename, content
+    )
+
+    buffer.part_index += 1
+    buffer.chunks = []
+    buffer.size = 0
+    buffer.entries = {}
+
+
+def write_coalesced(
+    destination: Text,
+    batch_id: Text,
+    encoded_data: bytes,
+    encoded_datum_hash: Text,
+    metadata: Any,
+    row_index: int,
+) -> Dict[Text, Any]:
+    """Buffers a row into the next NDJSON part file of the batch, flushing the
+    part once it would grow past the part_size option of the destination.
+
+    Returns:
+        Dict[Text, Any]: Manifest entry locating the row in the part file by
+        byte offset and length.
+    """
+    bucket, prefix = parse_batch_destination_uri(destination, batch_id)
+    if not prefix.endswith('/') and not {'hash', 'row_index'} & {
+        field for _, field, _, _ in Formatter().parse(prefix)
+    }:
+        raise ValueError(
+            'coalesced rows need a destination ending in / or naming each part '
+            'with {hash} or {row_index}'
+        )
+    part_size = min(
+        int(parse_destination_options(destination).get('part_size', DEFAULT_PART_SIZE)),
+        MAX_JSON_FILE_SIZE,
+    )
+
+    with _part_buffers_lock:
+        if is_finalized(batch_id):
+            raise RuntimeError(
+                f'Batch {batch_id} was finalized before row {row_index}.'
+            )
+        buffer = _part_buffers[batch_id]
+
+    with buffer.lock:
+        if buffer.chunks and buffer.size + len(encoded_data) + 1 > part_size:
+            flush_part(bucket, prefix, batch_id, buffer)
+
+        entry = {
+            'response': None,  # set once the part is uploaded
+            'uri': None,  # set once the part is flushed
+            'offset': buffer.size,
+            'length': len(encoded_data),
+            'sha256': encoded_datum_hash,
+            'metadata': metadata,
+        }
+        buffer.chunks.append(encoded_data + b'\n')
+        buffer.size += len(encoded_data) + 1
+        buffer.entries[row_index] = entry
+        buffer.last_written = monotonic()
+
+    return entry
+
+
+def flush_parts(destination: Text, batch_id: Text):
+    """Uploads the rows still buffered for a batch."""
+    with _part_buffers_lock:
+        buffer = _part_buffers.pop(batch_id, None)
+
+    if buffer:
+        bucket, prefix = parse_batch_destination_uri(destination, batch_id)
+        with buffer.lock:
+            flush_part(bucket, prefix, batch_id, buffer)
+
+
 def write(
     destination: Text,
     batch_id: Text,
     result: DataMetadata,
     row_index: int,
 ) -> Dict[Text, Any]:
-    bucket, prefix = parse_destination_uri(destination)
+    if is_finalized(batch_id):
+        raise RuntimeError(f'Batch {batch_id} was finalized before row {row_index}.')
+
+    bucket, prefix = parse_batch_destination_uri(destination, batch_id)
     data = result.data
     encoded_data = (
         data
@@ -107,6 +412,16 @@ def write(
     )
     encoded_datum_hash = sha256(encoded_data).hexdigest()
 
+    if parse_destination_options(destination).get('coalesce') == 'true':
+        return write_coalesced(
+            destination,
+            batch_id,
+            encoded_data,
+            encoded_datum_hash,
+            result.metadata if isinstance(result, DataMetadata) else None,
+            row_index,
+        )
+
     prefixed_filename = (
         f'{prefix}{batch_id}_row_{row_index}.data.json'
         if prefix.endswith('/')
@@ -119,16 +434,17 @@ def write(
 
     s3_uri = f's3://{bucket}/{prefixed_filename}'
 
-    return {
-        'response': write_to_s3(
-            bucket,
-            prefixed_filename,
-            encoded_data,
-        ),
+    entry = {
+        'response': None,  # set once the upload completes
         'uri': s3_uri,
         'sha256': encoded_datum_hash,
         'metadata': result.metadata if isinstance(result, DataMetadata) else None,
     }
+    write_to_s3_in_background(
+        batch_id, {row_index: entry}, bucket, prefixed_filename, encoded_data
+    )
+
+    return entry
 
 
 def finalize(
@@ -136,7 +452,10 @@ def finalize(
     batch_id: Text,
     datum: Dict,
 ) -> Dict[Text, Any]:
-    bucket, _ = parse_destination_uri(destination)
+    bucket, _ = parse_batch_destination_uri(destination, batch_id)
+    set_finalized(batch_id, True)
+    flush_parts(destination, batch_id)
+    wait_for_writes(batch_id, datum)  # type: ignore
     encoded_datum = json.dumps(datum)
     prefixed_filename = f'{MANIESTS_FOLDER_NAME}/{batch_id}_{MANIFEST_FILENAME}'
     s3_uri = f's3://{bucket}/{prefixed_filename}'
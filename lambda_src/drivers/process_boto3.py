@@ -1,11 +1,129 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 from json import loads
+from threading import Lock
+from typing import Any, DefaultDict, Dict, Optional, Tuple
 
 import boto3
 from botocore.response import StreamingBody
 
-from ..utils import pick
+from ..utils import LOG, pick
 
 DISALLOWED_CLIENTS = {'kms', 'secretsmanager'}
+READ_METHOD_PREFIXES = ('describe_', 'get_', 'head_', 'list_', 'lookup_', 'search_')
+# reads returning secrets or credentials, whose results must not be cached
+SECRET_CLIENTS = {'cognito-identity', 'kms', 'secretsmanager', 'sso', 'sts'}
+SECRET_METHOD_PARTS = ('auth', 'credential', 'parameter', 'password', 'secret', 'token')
+CREDENTIALS_REFRESH_MARGIN = timedelta(minutes=5)
+
+# (assume_role_chain_params, role_session_name) -> STS Credentials
+CREDENTIALS: Dict[Tuple[str, Optional[str]], Dict[str, Any]] = {}
+# (client_name, region, AccessKeyId) -> client
+CLIENTS: Dict[Tuple[str, Optional[str], Optional[str]], Any] = {}
+
+_credentials_locks: DefaultDict[Tuple[str, Optional[str]], Lock] = defaultdict(Lock)
+# the default boto3 session is not thread-safe, so clients are created one at a time
+_clients_lock = Lock()
+
+
+def assume_role_chain(
+    assume_role_chain_params: str, role_session_name: Optional[str]
+) -> Dict[str, Any]:
+    """
+    Assumes each role of the chain in turn, reusing the resulting credentials
+    until CREDENTIALS_REFRESH_MARGIN before they expire.
+    """
+    key = (assume_role_chain_params, role_session_name)
+
+    with _credentials_locks[key]:
+        cached = CREDENTIALS.get(key)
+        if cached and cached['Expiration'] - CREDENTIALS_REFRESH_MARGIN > datetime.now(
+            timezone.utc
+        ):
+            return cached
+
+        LOG.debug(f'Assuming role chain for session {role_session_name}.')
+        creds = None
+        # clients of intermediate roles are only needed for the next hop, and
+        # their keys change on every refresh, so they are not kept around
+        intermediate_keys = []
+        try:
+            for p in loads(assume_role_chain_params):
+                access_key: Optional[str] = (
+                    creds['Credentials']['AccessKeyId'] if creds else None
+                )
+                secret_key: Optional[str] = (
+                    creds['Credentials']['SecretAccessKey'] if creds else None
+                )
+                aws_session_token: Optional[str] = (
+                    creds['Credentials']['SessionToken'] if creds else None
+                )
+                if access_key:
+                    intermediate_keys.append(access_key)
+                assume_role_params = p if type(p) is dict else {"RoleArn": p}
+                creds = get_client(
+                    'sts',
+                    None,
+                    aws_access_key_id=access_key,
+                    aws_secret_access_key=secret_key,
+                    aws_session_token=aws_session_token,
+                ).assume_role(
+                    RoleSessionName='geff'
+                    if role_session_name is None
+                    else f'geff_{role_session_name}',
+                    **assume_role_params,
+                )
+        finally:
+            for intermediate_key in intermediate_keys:
+                forget_clients(intermediate_key)
+
+        if cached:
+            forget_clients(cached['AccessKeyId'])
+        CREDENTIALS[key] = creds['Credentials']  # type: ignore
+        return CREDENTIALS[key]
+
+
+def get_client(
+    client_name: str,
+    region: Optional[str],
+    aws_access_key_id: Optional[str] = None,
+    aws_secret_access_key: Optional[str] = None,
+    aws_session_token: Optional[str] = None,
+) -> Any:
+    """
+    Returns a client for the service, region and credentials, creating it once.
+    """
+    key = (client_name, region, aws_access_key_id)
+
+    with _clients_lock:
+        if key not in CLIENTS:
+            CLIENTS[key] = boto3.client(
+                client_name,
+                region,
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                aws_session_token=aws_session_token,
+            )
+        return CLIENTS[key]
+
+
+def forget_clients(aws_access_key_id: str):
+    with _clients_lock:
+        for key in [k for k in CLIENTS if k[2] == aws_access_key_id]:
+            del CLIENTS[key]
+
+
+def is_idempotent(client_name, method_name, *args, **kwargs) -> bool:
+    return method_name.startswith(READ_METHOD_PREFIXES)
+
+
+def is_read_only(client_name, method_name, *args, **kwargs) -> bool:
+    """whether results can be cached, which excludes reads of secrets"""
+    return (
+        is_idempotent(client_name, method_name)
+        and client_name not in SECRET_CLIENTS
+        and not any(part in method_name for part in SECRET_METHOD_PARTS)
+    )
 
 
 def process_row(
@@ -20,32 +138,16 @@ def process_row(
     if client_name in DISALLOWED_CLIENTS:
         return
     if assume_role_chain_params:
-        creds = None
-        for p in loads(assume_role_chain_params):
-            access_key = creds['Credentials']['AccessKeyId'] if creds else None
-            secret_key = creds['Credentials']['SecretAccessKey'] if creds else None
-            aws_session_token = creds['Credentials']['SessionToken'] if creds else None
-            assume_role_params = p if type(p) is dict else {"RoleArn": p}
-            creds = boto3.client(
-                'sts',
-                aws_access_key_id=access_key,
-                aws_secret_access_key=secret_key,
-                aws_session_token=aws_session_token,
-            ).assume_role(
-                RoleSessionName='geff'
-                if role_session_name is None
-                else f'geff_{role_session_name}',
-                **assume_role_params,
-            )
-        client = boto3.client(
+        creds = assume_role_chain(assume_role_chain_params, role_session_name)
+        client = get_client(
             client_name,
-            region_name=region,
-            aws_access_key_id=creds['Credentials']['AccessKeyId'],
-            aws_secret_access_key=creds['Credentials']['SecretAccessKey'],
-            aws_session_token=creds['Credentials']['SessionToken'],
+            region,
+            aws_access_key_id=creds['AccessKeyId'],
+            aws_secret_access_key=creds['SecretAccessKey'],
+            aws_session_token=creds['SessionToken'],
         )
     else:
-        client = boto3.client(client_name, region)
+        client = get_client(client_name, region)
     method = getattr(client, method_name)
     result = method(**kwargs)
     if results_path:
@@ -1,11 +1,44 @@
 import boto3
 import datetime
+from botocore.exceptions import ClientError, ParamValidationError
+from collections import defaultdict
+from json import dumps
+from math import isfinite
+from threading import Lock
+from typing import Any, DefaultDict, Dict, List, Tuple
+from urllib.parse import quote
+
+# put_metric_data accepts up to 1000 metrics, each with up to 150 distinct values
+MAX_DATUMS_PER_REQUEST = 1000
+MAX_VALUES_PER_DATUM = 150
+# requests are limited to 1 MB, and datums are sent query-encoded, e.g. as
+# MetricData.member.1.Values.member.1=2.0, so calls are split well below that
+MAX_REQUEST_BYTES = 800_000
+# errors caused by the content or the size of datums rather than by the call
+INVALID_DATUM_ERROR_CODES = {
+    'InvalidParameterCombination',
+    'InvalidParameterValue',
+    'MissingParameter',
+    'RequestEntityTooLarge',
+}
+
+# region -> client
+CLIENTS: Dict[str, Any] = {}
+# the default boto3 session is not thread-safe, so clients are created one at a time
+_clients_lock = Lock()
+
+
+def get_client(region: str) -> Any:
+    with _clients_lock:
+        if region not in CLIENTS:
+            CLIENTS[region] = boto3.client('cloudwatch', region)
+        return CLIENTS[region]
 
 
 def process_row(
     namespace, name, dimensions, value, unit='None', timestamp=None, region='us-west-2'
 ):
-    boto3.client('cloudwatch', region).put_metric_data(
+    get_client(region).put_metric_data(
         Namespace=namespace,
         MetricData=[
             {
@@ -17,3 +50,138 @@ def process_row(
             }
         ],
     )
+
+
+def process_rows(rows: List[Dict[str, Any]]) -> List[Any]:
+    """
+    Publishes the rows of a batch in as few put_metric_data calls as possible.
+
+    Rows are grouped by region and namespace, and rows of the same metric,
+    dimensions, unit and timestamp are merged into one datum with Values and
+    Counts. Each row gets None, or the exception of the call its datum was in.
+    """
+    now = datetime.datetime.utcnow()
+    results: List[Any] = [None] * len(rows)
+
+    # (region, namespace) -> datum key -> value -> indexes of rows with the value
+    groups: DefaultDict[
+        Tuple[str, str], DefaultDict[Tuple, DefaultDict[float, List[int]]]
+    ] = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+    for i, row in enumerate(rows):
+        try:
+            group = groups[row.get('region', 'us-west-2'), row['namespace']]
+            datum_key = (
+                row['name'],
+                dumps(row['dimensions'], sort_keys=True, default=str),
+                row.get('unit', 'None'),
+                row.get('timestamp') or now,
+            )
+            value = float(row['value'])
+            if not isfinite(value):
+                raise ValueError(f'metric value must be finite, got {value}')
+            group[datum_key][value].append(i)
+        except Exception as e:
+            results[i] = e
+
+    for (region, namespace), datums in groups.items():
+        metric_data: List[Dict[str, Any]] = []
+        datum_rows: List[List[int]] = []
+        for (name, dimensions, unit, timestamp), values in datums.items():
+            distinct_values = list(values)
+            for start in range(0, len(distinct_values), MAX_VALUES_PER_DATUM):
+                chunk = distinct_values[start : start + MAX_VALUES_PER_DATUM]
+                metric_data.append(
+                    {
+                        'MetricName': name,
+                        'Dimensions': rows[values[chunk[0]][0]]['dimensions'],
+                        'Timestamp': timestamp,
+                        'Unit': unit,
+                        'Values': chunk,
+                        'Counts': [float(len(values[v])) for v in chunk],
+                    }
+                )
+                datum_rows.append([i for v in chunk for i in values[v]])
+
+        client = get_client(region)
+        for start, end in chunk_datums(metric_data):
+            put_metric_data(
+                client,
+                namespace,
+                metric_data[start:end],
+                datum_rows[start:end],
+                results,
+            )
+
+    return results
+
+
+def estimated_datum_size(datum: Dict[str, Any]) -> int:
+    """rough size of a datum query-encoded in a put_metric_data request"""
+    size = 0
+    for key, value in datum.items():
+        for member in value if isinstance(value, list) else [value]:
+            fields = member.items() if isinstance(member, dict) else [('', member)]
+            for field, v in fields:
+                # e.g. MetricData.member.1000.Dimensions.member.30.Value=v&
+                size += 40 + len(key) + len(field) + len(quote(str(v)))
+    return size
+
+
+def chunk_datums(metric_data: List[Dict[str, Any]]) -> List[Tuple[int, int]]:
+    """
+    Splits metric_data into (start, end) ranges of at most MAX_DATUMS_PER_REQUEST
+    datums and MAX_REQUEST_BYTES each.
+    """
+    chunks = []
+    start, size = 0, 0
+    for end, datum in enumerate(metric_data):
+        datum_size = estimated_datum_size(datum)
+        if end > start and (
+            end - start >= MAX_DATUMS_PER_REQUEST
+            or size + datum_size > MAX_REQUEST_BYTES
+        ):
+            chunks.append((start, end))
+            start, size = end, 0
+        size += datum_size
+    if start < len(metric_data):
+        chunks.append((start, len(metric_data)))
+    return chunks
+
+
+def is_invalid_datum_error(e: Exception) -> bool:
+    """whether the call may succeed for some of its datums, if split"""
+    if isinstance(e, ParamValidationError):
+        return True
+    return isinstance(e, ClientError) and (
+        e.response.get('Error', {}).get('Code') in INVALID_DATUM_ERROR_CODES
+        or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 413
+    )
+
+
+def put_metric_data(
+    client: Any,
+    namespace: str,
+    metric_data: List[Dict[str, Any]],
+    datum_rows: List[List[int]],
+    results: List[Any],
+):
+    """
+    Sends metric_data, setting the exception of a failed call on the rows of its
+    datums. Calls rejecting a datum, or too large, are split in halves, so that an
+    invalid datum only fails its own rows.
+    """
+    try:
+        client.put_metric_data(Namespace=namespace, MetricData=metric_data)
+    except Exception as e:
+        if len(metric_data) > 1 and is_invalid_datum_error(e):
+            half = len(metric_data) // 2
+            for data, rows in (
+                (metric_data[:half], datum_rows[:half]),
+                (metric_data[half:], datum_rows[half:]),
+            ):
+                put_metric_data(client, namespace, data, rows, results)
+            return
+
+        for indexes in datum_rows:
+            for i in indexes:
+                results[i] = e
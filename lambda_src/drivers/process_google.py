@@ -1,9 +1,158 @@
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 from json import loads
+from os import environ
+from threading import Lock, local
+from typing import Any, DefaultDict, Dict, List, Optional, Tuple
 
+from google.auth.exceptions import RefreshError  # type: ignore
 from google.oauth2 import credentials, service_account  # type: ignore
-from googleapiclient.discovery import build  # type: ignore
+from google_auth_httplib2 import AuthorizedHttp  # type: ignore
+from googleapiclient.discovery import UnknownApiNameOrVersion, build  # type: ignore
+from googleapiclient.http import build_http  # type: ignore
 
-from ..vault import decrypt_if_encrypted
+from ..utils import LOG
+from ..vault import decrypt_if_encrypted, invalidate
+
+READ_METHODS = {'get', 'list', 'search', 'query'}
+# rows are sent one by one unless sf-custom-bulk is true, see process_rows
+BULK = False
+# Google APIs accept up to 100 calls in a batch request
+MAX_BATCH_SIZE = 100
+# batch requests sent at once
+BATCH_CONCURRENCY = 8
+# services kept per container, e.g. one per subject impersonated by a service account
+SERVICE_CACHE_MAX_SIZE = int(environ.get('GOOGLE_SERVICE_CACHE_MAX_SIZE', 64))
+
+# (service_name, service_version, credentials digest, subject, scopes)
+ServiceKey = Tuple[str, str, str, Optional[str], str]
+
+# key -> (credentials, service), so that discovery documents are parsed and
+# access tokens are fetched once per container rather than once per row,
+# evicting the least recently used beyond SERVICE_CACHE_MAX_SIZE
+SERVICES: 'OrderedDict[ServiceKey, Tuple[Any, Any]]' = OrderedDict()
+_services_lock = Lock()
+# httplib2.Http is not thread-safe, so each thread sends requests with its own
+_local = local()
+
+
+def is_read_only(
+    service_name, service_version, resource_name, method, *args, **kwargs
+):
+    return method in READ_METHODS
+
+
+is_idempotent = is_read_only
+
+
+def build_credentials(
+    service_account_info, authorized_user_info, without_subject, subject, scopes
+):
+    scopes = loads(scopes)
+    if authorized_user_info is not None:
+        return credentials.Credentials.from_authorized_user_info(
+            loads(decrypt_if_encrypted(authorized_user_info)), scopes
+        )
+
+    c = service_account.Credentials.from_service_account_info(
+        loads(decrypt_if_encrypted(service_account_info))
+    )
+    if subject is None or without_subject:
+        return c.with_scopes(scopes)
+    return c.with_subject(subject).with_scopes(scopes)
+
+
+def build_service(service_name, service_version, creds):
+    try:
+        # discovery documents bundled with the client library
+        return build(
+            service_name,
+            version=service_version,
+            credentials=creds,
+            static_discovery=True,
+        )
+    except UnknownApiNameOrVersion:
+        LOG.debug(f'Fetching the discovery document for {service_name}.')
+        return build(
+            service_name,
+            version=service_version,
+            credentials=creds,
+            static_discovery=False,
+            cache_discovery=False,
+        )
+
+
+def get_service(
+    service_name,
+    service_version,
+    service_account_info=None,
+    authorized_user_info=None,
+    without_subject=False,
+    subject=None,
+    scopes='null',
+) -> Tuple[ServiceKey, Any, Any]:
+    """
+    Returns the cache key, credentials and service for the arguments, building
+    the credentials and service the first time they are seen. Secrets are keyed
+    by digest and only decrypted then.
+    """
+    info = (
+        authorized_user_info
+        if authorized_user_info is not None
+        else service_account_info
+    )
+    key = (
+        service_name,
+        service_version,
+        sha256(f'{authorized_user_info is not None}:{info}'.encode()).hexdigest(),
+        None if without_subject else subject,
+        scopes,
+    )
+
+    with _services_lock:
+        cached = SERVICES.get(key)
+        if cached:
+            SERVICES.move_to_end(key)
+    if not cached:
+        creds = build_credentials(
+            service_account_info, authorized_user_info, without_subject, subject, scopes
+        )
+        service = build_service(service_name, service_version, creds)
+        with _services_lock:
+            cached = SERVICES.setdefault(key, (creds, service))
+            SERVICES.move_to_end(key)
+            while len(SERVICES) > SERVICE_CACHE_MAX_SIZE:
+                SERVICES.popitem(last=False)
+
+    return (key, *cached)
+
+
+def get_http(key: ServiceKey, creds) -> AuthorizedHttp:
+    """returns this thread's authorized http for the credentials of key"""
+    https: Dict[ServiceKey, AuthorizedHttp] = _local.__dict__.setdefault('https', {})
+    http = https.get(key)
+    if http is None or http.credentials is not creds:
+        # drop the https of services evicted since
+        with _services_lock:
+            for k in [k for k in https if k not in SERVICES]:
+                del https[k]
+        http = https[key] = AuthorizedHttp(creds, http=build_http())
+    return http
+
+
+def get_request(service, resource_name, method, params):
+    resource_name, *subresource_names = resource_name.split('.')
+    resource = getattr(service, resource_name)()
+    for srn in subresource_names:
+        resource = getattr(resource, srn)()
+
+    return getattr(resource, method)(**loads(params))
+
+
+def forget_service(key: ServiceKey):
+    with _services_lock:
+        SERVICES.pop(key, None)
 
 
 def process_row(
@@ -18,24 +167,83 @@ def process_row(
     subject=None,
     scopes='null',
 ):
-    scopes = loads(scopes)
-    if authorized_user_info is not None:
-        creds = credentials.Credentials.from_authorized_user_info(
-            loads(decrypt_if_encrypted(authorized_user_info)), scopes
-        )
-    else:
-        c = service_account.Credentials.from_service_account_info(
-            loads(decrypt_if_encrypted(service_account_info))
+    key, creds, service = get_service(
+        service_name,
+        service_version,
+        service_account_info,
+        authorized_user_info,
+        without_subject,
+        subject,
+        scopes,
+    )
+
+    try:
+        return get_request(service, resource_name, method, params).execute(
+            http=get_http(key, creds)
         )
-        if subject is None or without_subject:
-            creds = c.with_scopes(scopes)
-        else:
-            creds = c.with_subject(subject).with_scopes(scopes)
+    except RefreshError:
+        # the cached credentials may have been rotated
+        forget_service(key)
+        invalidate(service_account_info, authorized_user_info)
+        raise
 
-    service = build(service_name, version=service_version, credentials=creds)
-    resource_name, *subresource_names = resource_name.split('.')
-    resource = getattr(service, resource_name)()
-    for srn in subresource_names:
-        resource = getattr(resource, srn)()
 
-    return getattr(resource, method)(**loads(params)).execute()
+def process_rows(rows: List[Dict[str, Any]]) -> List[Any]:
+    """
+    Sends the calls of a batch as Google API batch requests, with up to
+    MAX_BATCH_SIZE calls sharing a service and credentials in each. Each row gets
+    its response, or the exception of its call or of the batch request.
+    """
+    results: List[Any] = [None] * len(rows)
+
+    # service key -> (credentials, service), and row indexes and requests
+    services: Dict[ServiceKey, Tuple[Any, Any]] = {}
+    requests: DefaultDict[ServiceKey, List[Tuple[int, Any]]] = defaultdict(list)
+    for i, row in enumerate(rows):
+        try:
+            row = dict(row)
+            resource_name = row.pop('resource_name')
+            method = row.pop('method')
+            params = row.pop('params')
+            key, creds, service = get_service(**row)
+            request = get_request(service, resource_name, method, params)
+        except Exception as e:
+            results[i] = e
+            continue
+
+        services[key] = (creds, service)
+        requests[key].append((i, request))
+
+    def send_batch(key: ServiceKey, batch_requests: List[Tuple[int, Any]]):
+        creds, service = services[key]
+
+        def set_result(request_id, response, exception):
+            results[int(request_id)] = response if exception is None else exception
+
+        batch = service.new_batch_http_request(callback=set_result)
+        for i, request in batch_requests:
+            batch.add(request, request_id=str(i))
+
+        try:
+            batch.execute(http=get_http(key, creds))
+        except Exception as e:
+            if isinstance(e, RefreshError):
+                # the cached credentials may have been rotated
+                forget_service(key)
+                row = rows[batch_requests[0][0]]
+                invalidate(
+                    row.get('service_account_info'), row.get('authorized_user_info')
+                )
+            for i, _ in batch_requests:
+                results[i] = e
+
+    batches = [
+        (key, key_requests[start : start + MAX_BATCH_SIZE])
+        for key, key_requests in requests.items()
+        for start in range(0, len(key_requests), MAX_BATCH_SIZE)
+    ]
+    if batches:
+        with ThreadPoolExecutor(min(BATCH_CONCURRENCY, len(batches))) as executor:
+            list(executor.map(lambda batch: send_batch(*batch), batches))
+
+    return results
@@ -1,18 +1,54 @@
+from asyncio import (
+    AbstractEventLoop,
+    Task,
+    TimeoutError as AsyncTimeoutError,
+    ensure_future,
+    get_running_loop,
+    sleep as async_sleep,
+)
 from base64 import b64encode
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.message import Message
 from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from gzip import decompress
 from hashlib import sha256
 from hmac import new as new_hmac
 from io import BytesIO
 from json import JSONDecodeError, dumps, loads
+from os import environ
+from random import uniform
 from re import match
-from time import time
-from typing import Any, Dict, List, Optional, Union
+from time import sleep, time
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 from urllib.error import HTTPError, URLError
 from urllib.parse import parse_qsl, urlparse
 from urllib import request
 
+import jinja2
 
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:  # only needed by process_row_async
+    aiohttp = None  # type: ignore[assignment]
+
+from .. import rate_limit as rate_limiter
+from ..connection_pool import build_opener
 from ..utils import (
     LOG,
     parse_header_links,
@@ -20,8 +56,58 @@ from ..utils import (
     pick,
     DataMetadata,
     add_param_to_url,
+    row_remaining_seconds,
+)
+from ..event_loop import run_blocking
+from ..vault import decrypt_if_encrypted, invalidate
+
+CONCURRENCY = 8
+# rows processed at once when the batch runs process_row_async
+ASYNC_CONCURRENCY = 256
+ASYNC_MAX_CONNECTIONS_PER_HOST = int(
+    environ.get('HTTPS_ASYNC_MAX_CONNECTIONS_PER_HOST', 256)
 )
-from ..vault import decrypt_if_encrypted
+
+MAX_RETRIES = int(environ.get('HTTPS_MAX_RETRIES', 3))
+RETRY_BASE_DELAY_SECONDS = float(environ.get('HTTPS_RETRY_BASE_DELAY_SECONDS', 0.5))
+RETRY_MAX_DELAY_SECONDS = float(environ.get('HTTPS_RETRY_MAX_DELAY_SECONDS', 20))
+# time kept for returning the batch when deciding whether a retry still fits
+RETRY_DEADLINE_MARGIN_SECONDS = float(
+    environ.get('HTTPS_RETRY_DEADLINE_MARGIN_SECONDS', 3)
+)
+# the server did not process the request, so any method can be retried
+RETRY_STATUSES = {429, 503}
+# the request may have been processed, so only idempotent methods are retried
+RETRY_IDEMPOTENT_STATUSES = {502, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+READ_ONLY_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+# reuses keep-alive connections across rows, pages and invocations, leaving the
+# process-wide urllib opener alone
+OPENER = build_opener()
+
+JINJA_ENV = jinja2.Environment()
+JINJA_SYNTAX = ('{{', '{%', '{#')
+AUTH_TEMPLATE_GLOBALS = {
+    'time': time,
+    'hmac_sha256_base64': lambda secret_key, signature_string: (
+        b64encode(
+            new_hmac(
+                secret_key.encode(),
+                signature_string.encode(),
+                sha256,
+            ).digest()
+        ).decode()
+    ),
+}
+
+
+Page = namedtuple('Page', ['ok', 'result', 'response', 'links_headers'])
+
+# aiohttp session used by process_row_async and the loop it was created on,
+# see get_session()
+_session: Optional[Any] = None
+_session_loop: Optional[AbstractEventLoop] = None
 
 
 def make_basic_header(auth):
@@ -32,280 +118,789 @@ def parse_header_dict(value):
     return {k: v for k, v in parse_qsl(value)}
 
 
-def render_jinja_template(template, params, global_functions):
-    import jinja2
-
-    e = jinja2.Environment()
-    e.globals.update(global_functions)
-    return e.from_string(template).render(params)
-
-
-def process_row(
-    base_url: str = '',
-    url: str = '',
-    data: Optional[str] = None,
-    json: Optional[str] = None,
-    method: str = 'get',
-    headers: str = '',
-    auth: Optional[str] = None,
-    params: str = '',
-    verbose: bool = False,
-    cursor: str = '',
-    page_limit: Optional[int] = None,
-    results_path: str = '',
-    destination_metadata: str = '',
-):
-    if not base_url and not url:
-        raise ValueError('Missing required parameter. Need one of url or base-url.')
-
-    if data and json:
-        raise ValueError('parameters data and json cannot both be present')
-
-    req_url = url if url.startswith(base_url) else base_url + url
-
-    req_params: str = params
-    if req_params:
-        req_url += f'?{req_params}'
+@lru_cache(maxsize=128)
+def compile_jinja_template(template):
+    return JINJA_ENV.from_string(template)
 
-    parsed_url = urlparse(req_url)
-    if parsed_url.scheme != 'https':
-        raise ValueError('URL scheme must be HTTPS.')
 
-    req_host = parsed_url.hostname
-    req_headers = (
-        loads(headers)
-        if headers.startswith('{')
-        else parse_header_dict(headers)
-        if headers
-        else {}
+def render_jinja_template(template, params, global_functions):
+    if '\r' not in template and not any(s in template for s in JINJA_SYNTAX):
+        # without template syntax, rendering only strips a single trailing newline
+        return template[:-1] if template.endswith('\n') else template
+
+    return compile_jinja_template(template).render({**global_functions, **params})
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parses a Retry-After header, in delay-seconds or HTTP-date form, into seconds.
+    """
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt: int, retry_after: Optional[float]) -> float:
+    """
+    Seconds to wait before retry number attempt + 1: what the server asked for in
+    Retry-After up to RETRY_MAX_DELAY_SECONDS, otherwise exponential backoff with
+    full jitter.
+    """
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY_SECONDS)
+    return uniform(
+        0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt)
     )
 
-    req_headers.setdefault('User-Agent', 'GEFF 1.0')
-    req_headers.setdefault('Accept-Encoding', 'gzip')
-
-    auth_template = decrypt_if_encrypted(auth) if auth else None
 
-    # query, nextpage_path, results_path
-    req_results_path: str = results_path
-    req_cursor: str = cursor
-    req_page_count: int = 0
-    req_method: str = method.upper()
-    if json:
-        req_json = loads(json) if json.startswith('{') else parse_header_dict(json)
-        req_headers['Content-Type'] = 'application/json'
+def parse_cursor(
+    cursor: str,
+) -> Tuple[str, Optional[str], Optional[str], Dict[str, Any]]:
+    """
+    Parses the cursor parameter into the path of the next cursor value in the
+    response, the query parameter and the json body path to set it in, and any
+    other options of a JSON cursor. Numeric cursors have no path.
+    """
+    if cursor.startswith('{'):
+        c = loads(cursor)
+        if c.get('strategy') == 'numeric':
+            if not c.get('param') and not c.get('body'):
+                raise ValueError('numeric cursor needs a param or body')
+            return '', c.get('param'), c.get('body'), c
+        if not c.get('path'):
+            raise ValueError('cursor needs a path to the next cursor value')
+        return c['path'], c.get('param'), c.get('body'), c
+    elif ':' in cursor:
+        cursor_path, cursor_param = cursor.rsplit(':', 1)
+        return cursor_path, cursor_param, None, {}
     else:
-        req_json = None
+        return cursor, cursor.split('.')[-1], None, {}
+
+
+def plan_numeric_pages(
+    req_url: str,
+    req_json: Optional[Any],
+    cursor_param: Optional[str],
+    cursor_body: Optional[str],
+    cursor_options: Dict[str, Any],
+) -> Tuple[Callable[[int], Tuple[str, Optional[Any]]], int]:
+    """
+    Returns the URL and JSON body of the page at each index, and how many pages
+    to request ahead, for iter_numeric_pages and aiter_numeric_pages.
+    """
+    step = int(cursor_options.get('step', 1))
+    url_start = (
+        dict(parse_qsl(urlparse(req_url).query)).get(cursor_param, 1)
+        if cursor_param
+        else 1
+    )
+    start = int(cursor_options.get('start', url_start))
+    prefetch = max(1, int(cursor_options.get('prefetch', 1)))
 
-    next_url: Optional[str] = req_url
-    row_data: List[Any] = []
-    metadata: Optional[Any] = None
+    if cursor_body and not isinstance(req_json, dict):
+        raise ValueError('cursor.body present without json param')
 
-    LOG.debug('Starting pagination.')
-    while next_url:
-        if auth:
-            parsed_url = urlparse(next_url)
-            auth = render_jinja_template(
-                auth_template,
+    def numbered_page(page_index: int) -> Tuple[str, Optional[Any]]:
+        value = start + page_index * step
+        page_url = (
+            add_param_to_url(req_url, cursor_param, value) if cursor_param else req_url
+        )
+        page_json = req_json
+        if cursor_body:
+            page_json = loads(dumps(req_json))
+            set_value(page_json, cursor_body, value)
+        return page_url, page_json
+
+    return numbered_page, prefetch
+
+
+def is_last_numeric_page(page: Page, page_size: Optional[Any]) -> Tuple[bool, Any]:
+    """
+    Whether no pages follow page, and the expected page size from now on.
+    """
+    if not isinstance(page.result, list) or not page.result:
+        return True, page_size
+    if page_size is None:
+        return False, len(page.result)
+    return len(page.result) < int(page_size), page_size
+
+
+def iter_numeric_pages(
+    fetch_page: Callable[[str, Optional[Any]], Page],
+    req_url: str,
+    req_json: Optional[Any],
+    cursor_param: Optional[str],
+    cursor_body: Optional[str],
+    cursor_options: Dict[str, Any],
+    page_limit: Optional[int],
+) -> Iterator[Page]:
+    """
+    Yields the pages of an API with numeric page or offset parameters, e.g. for
+    cursor={"param": "page", "strategy": "numeric", "prefetch": 4}, requesting
+    up to prefetch pages ahead concurrently.
+
+    The page number starts at the cursor's start option, or the parameter's
+    value in the URL, or 1, and increases by the step option, or 1. The last
+    page yielded is the first one that is empty, shorter than the size option
+    (or than the first page), or not a list, or page number page_limit.
+    """
+    numbered_page, prefetch = plan_numeric_pages(
+        req_url, req_json, cursor_param, cursor_body, cursor_options
+    )
+    page_size = cursor_options.get('size')
+
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    pending: Deque[Future] = deque()
+    requested = 0
+
+    def request_next_page():
+        nonlocal requested
+        if page_limit is None or requested < page_limit:
+            pending.append(executor.submit(fetch_page, *numbered_page(requested)))
+            requested += 1
+
+    try:
+        for _ in range(prefetch):
+            request_next_page()
+
+        while pending:
+            page = pending.popleft().result()
+            yield page
+
+            last, page_size = is_last_numeric_page(page, page_size)
+            if last:
+                break
+
+            request_next_page()
+    finally:
+        # pages requested past the last one are discarded, and those in flight
+        # are waited for so that no request outlives the row
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+async def aiter_numeric_pages(
+    fetch_page: Callable[[str, Optional[Any]], Awaitable[Page]],
+    req_url: str,
+    req_json: Optional[Any],
+    cursor_param: Optional[str],
+    cursor_body: Optional[str],
+    cursor_options: Dict[str, Any],
+    page_limit: Optional[int],
+) -> AsyncIterator[Page]:
+    """
+    Same as iter_numeric_pages, with pages requested ahead as asyncio tasks.
+    """
+    numbered_page, prefetch = plan_numeric_pages(
+        req_url, req_json, cursor_param, cursor_body, cursor_options
+    )
+    page_size = cursor_options.get('size')
+
+    pending: Deque[Task] = deque()
+    requested = 0
+
+    def request_next_page():
+        nonlocal requested
+        if page_limit is None or requested < page_limit:
+            pending.append(ensure_future(fetch_page(*numbered_page(requested))))
+            requested += 1
+
+    try:
+        for _ in range(prefetch):
+            request_next_page()
+
+        while pending:
+            page = await pending.popleft()
+            yield page
+
+            last, page_size = is_last_numeric_page(page, page_size)
+            if last:
+                break
+
+            request_next_page()
+    finally:
+        # pages requested past the last one are discarded
+        for task in pending:
+            task.cancel()
+
+
+def urlopen(req: request.Request) -> Any:
+    return OPENER.open(req)
+
+
+def get_session() -> Any:
+    """
+    Returns the aiohttp session of the running event loop, which keeps
+    connections alive across rows, pages and invocations.
+    """
+    global _session, _session_loop
+    loop = get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session_loop = loop
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=0, limit_per_host=ASYNC_MAX_CONNECTIONS_PER_HOST
+            ),
+            # bodies are decompressed like the ones received by urllib
+            auto_decompress=False,
+        )
+    return _session
+
+
+def is_idempotent(*args, method: str = 'get', **kwargs) -> bool:
+    return method.upper() in IDEMPOTENT_METHODS
+
+
+def is_read_only(*args, method: str = 'get', **kwargs) -> bool:
+    return method.upper() in READ_ONLY_METHODS
+
+
+class HttpsCall:
+    """
+    Auth, parsing, retries and pagination of the requests made for one row,
+    shared by process_row, which sends them with urllib, and process_row_async,
+    which sends them with aiohttp.
+    """
+
+    def __init__(
+        self,
+        base_url: str = '',
+        url: str = '',
+        data: Optional[str] = None,
+        json: Optional[str] = None,
+        method: str = 'get',
+        headers: str = '',
+        auth: Optional[str] = None,
+        params: str = '',
+        verbose: bool = False,
+        cursor: str = '',
+        page_limit: Optional[int] = None,
+        results_path: str = '',
+        destination_metadata: str = '',
+        rate_limit: str = '',
+        retries: Optional[int] = None,
+    ):
+        if not base_url and not url:
+            raise ValueError('Missing required parameter. Need one of url or base-url.')
+
+        if data and json:
+            raise ValueError('parameters data and json cannot both be present')
+
+        req_url = url if url.startswith(base_url) else base_url + url
+
+        req_params: str = params
+        if req_params:
+            req_url += f'?{req_params}'
+
+        parsed_url = urlparse(req_url)
+        if parsed_url.scheme != 'https':
+            raise ValueError('URL scheme must be HTTPS.')
+
+        self.req_url = req_url
+        self.req_host = parsed_url.hostname
+        self.req_headers = (
+            loads(headers)
+            if headers.startswith('{')
+            else parse_header_dict(headers)
+            if headers
+            else {}
+        )
+
+        self.req_headers.setdefault('User-Agent', 'GEFF 1.0')
+        self.req_headers.setdefault('Accept-Encoding', 'gzip')
+
+        self.data = data
+        self.json = json
+        self.method = method
+        self.auth_secret = auth
+        # decrypted by decrypt_auth(), which blocks on KMS or Secrets Manager
+        self.auth_template: Optional[str] = None
+        self.header_rate_limit = rate_limiter.parse_rate_limit(rate_limit)
+        self.verbose = verbose
+        self.page_limit = page_limit
+        self.destination_metadata = destination_metadata
+
+        # query, nextpage_path, results_path
+        self.req_results_path: str = results_path
+        self.req_cursor: str = cursor
+        self.req_method: str = method.upper()
+        if json:
+            self.req_json = (
+                loads(json) if json.startswith('{') else parse_header_dict(json)
+            )
+            self.req_headers['Content-Type'] = 'application/json'
+        else:
+            self.req_json = None
+
+        self.max_retries = MAX_RETRIES if retries is None else retries
+
+        (
+            self.cursor_path,
+            self.cursor_param,
+            self.cursor_body,
+            self.cursor_options,
+        ) = parse_cursor(self.req_cursor)
+        self.numeric_pagination = self.cursor_options.get('strategy') == 'numeric'
+        self.row_data: List[Any] = []
+        self.metadata: Optional[Any] = None
+
+    def decrypt_auth(self):
+        if self.auth_secret:
+            self.auth_template = decrypt_if_encrypted(self.auth_secret)
+
+    def build_request(
+        self, page_url: str, page_json: Optional[Any]
+    ) -> Tuple[request.Request, Optional[str], Optional[rate_limiter.RateLimit]]:
+        """
+        Renders auth for a page, returning its request, host and rate limit.
+        """
+        # pages may be fetched concurrently, so auth only changes copies
+        page_headers = dict(self.req_headers)
+        page_data = self.data
+        page_host = self.req_host
+        page_rate_limit = self.header_rate_limit
+
+        if self.auth_secret:
+            parsed_page_url = urlparse(page_url)
+            rendered_auth = render_jinja_template(
+                self.auth_template,
                 {
-                    'path': parsed_url.path,
-                    'query': parsed_url.query,
-                    'method': method,
+                    'path': parsed_page_url.path,
+                    'query': parsed_page_url.query,
+                    'method': self.method,
                     'unixtime': int(time()),
                 },
-                {
-                    'time': time,
-                    'hmac_sha256_base64': lambda secret_key, signature_string: (
-                        b64encode(
-                            new_hmac(
-                                secret_key.encode(),
-                                signature_string.encode(),
-                                sha256,
-                            ).digest()
-                        ).decode()
-                    ),
-                },
+                AUTH_TEMPLATE_GLOBALS,
             )
 
             req_auth = (
-                loads(auth)
-                if auth and auth.startswith('{')
-                else parse_header_dict(auth)
-                if auth
+                loads(rendered_auth)
+                if rendered_auth and rendered_auth.startswith('{')
+                else parse_header_dict(rendered_auth)
+                if rendered_auth
                 else {}
             )
             auth_host = req_auth.get('host')
+            page_rate_limit = rate_limiter.strictest(
+                self.header_rate_limit,
+                rate_limiter.parse_rate_limit(req_auth.get('rate_limit')),
+            )
 
             # We reject the request if the 'auth' is present but doesn't match the pinned host.
-            if auth_host and req_host and auth_host != req_host:
+            if auth_host and page_host and auth_host != page_host:
                 raise ValueError(
                     "Requests can only be made to host provided in the auth header."
                 )
             # If the URL is missing a hostname, use the host from the auth dictionary
-            elif auth_host and not req_host:
-                req_host = auth_host
+            elif auth_host and not page_host:
+                page_host = auth_host
             # We make unauthenticated request if the 'host' key is missing.
             elif not auth_host:
                 raise ValueError(f"'auth' missing the 'host' key.")
             elif 'basic' in req_auth:
-                req_headers['Authorization'] = make_basic_header(req_auth['basic'])
+                page_headers['Authorization'] = make_basic_header(req_auth['basic'])
             elif 'bearer' in req_auth:
-                req_headers['Authorization'] = f"Bearer {req_auth['bearer']}"
+                page_headers['Authorization'] = f"Bearer {req_auth['bearer']}"
             elif 'authorization' in req_auth:
-                req_headers['authorization'] = req_auth['authorization']
+                page_headers['authorization'] = req_auth['authorization']
             elif 'headers' in req_auth:
-                req_headers.update(req_auth['headers'])
+                page_headers.update(req_auth['headers'])
             elif 'body' in req_auth:
-                if json:
+                if self.json:
                     raise ValueError(f"auth 'body' key and json param are both present")
-                if data:
+                if self.data:
                     raise ValueError(f"auth 'body' key and data param are both present")
                 else:
-                    data = (
+                    page_data = (
                         req_auth['body']
                         if isinstance(req_auth['body'], str)
                         else dumps(req_auth['body'])
                     )
 
-        LOG.debug(f'~> {req_method} {next_url}')
+        LOG.debug(f'~> {self.req_method} {page_url}')
         req = request.Request(
-            next_url,
-            method=req_method,
-            headers=req_headers,
+            page_url,
+            method=self.req_method,
+            headers=page_headers,
             data=(
-                data.encode()
-                if data is not None
-                else dumps(req_json).encode()
-                if req_json is not None
+                page_data.encode()
+                if page_data is not None
+                else dumps(page_json).encode()
+                if page_json is not None
                 else None
             ),
         )
-        links_headers = None
 
+        return req, page_host, page_rate_limit
+
+    def read_response(
+        self, status: int, res_headers: Message, res_body: bytes
+    ) -> Tuple[Page, bool, Optional[float]]:
+        links_headers = parse_header_links(','.join(res_headers.get_all('link', [])))
+        headers = dict(res_headers.items())
+        res_encoding = headers.get('Content-Encoding')
+        res_type = headers.get('Content-Type', '')
+        LOG.debug(f'<~ {len(res_body)} bytes [{res_type}] [{res_encoding}]')
+
+        raw_response = decompress(res_body) if res_encoding == 'gzip' else res_body
+        response_date = (
+            parsedate_to_datetime(headers['Date']).isoformat()
+            if 'Date' in headers
+            else None
+        )
         try:
-            res = request.urlopen(req)
-            links_headers = parse_header_links(
-                ','.join(res.headers.get_all('link', []))
-            )
-            res_headers = dict(res.headers.items())
-            res_body = res.read()
-            res_encoding = res_headers.get('Content-Encoding')
-            res_type = res_headers.get('Content-Type', '')
-            LOG.debug(f'<~ {len(res_body)} bytes [{res_type}] [{res_encoding}]')
-
-            raw_response = decompress(res_body) if res_encoding == 'gzip' else res_body
-            response_date = (
-                parsedate_to_datetime(res_headers['Date']).isoformat()
-                if 'Date' in res_headers
-                else None
-            )
             response_body = (
                 loads(raw_response)
                 if res_type.startswith('application/json')
                 else BytesIO(raw_response).getbuffer().tobytes()
             )
-
-            response = (
-                {
-                    'body': response_body,
-                    'headers': res_headers,
-                    'responded_at': response_date,
-                }
-                if verbose
-                else response_body
-            )
-            result = pick(req_results_path, response)
-            if destination_metadata:
-                metadata = pick(destination_metadata, response)
-
-        except HTTPError as e:
-            response_body = (
-                decompress(e.read())
-                if e.headers.get('Content-Encoding') == 'gzip'
-                else e.read()
-            ).decode()
-            content_type = e.headers.get('Content-Type', '')
-            result = {
-                'error': 'HTTPError',
-                'url': next_url,
-                'status': e.code,
-                'reason': e.reason,
-                'body': (
-                    loads(response_body)
-                    if content_type and content_type.startswith('application/json')
-                    else response_body
-                ),
-            }
-        except URLError as e:
-            result = {
-                'error': f'URLError',
-                'reason': str(e.reason),
-                'host': req_host,
-            }
-        except JSONDecodeError as e:
+        except JSONDecodeError:
             result = {
                 'error': 'JSONDecodeError' if raw_response else 'No Content',
                 'body': raw_response.decode(),
-                'status': res.status,
+                'status': status,
                 'responded_at': response_date,
             }
+            return Page(False, result, None, None), False, None
 
-        if req_cursor and isinstance(result, list):
-            row_data += result
-            req_page_count += 1
-
-            cursor_body = None
-            if req_cursor.startswith('{'):
-                c = loads(req_cursor)
-                cursor_path = c.get('path')
-                cursor_body = c.get('body')
-                cursor_param = c.get('param')
-            elif ':' in req_cursor:
-                cursor_path, cursor_param = req_cursor.rsplit(':', 1)
-            else:
-                cursor_path = req_cursor
-                cursor_param = cursor_path.split('.')[-1]
-
-            cursor_value = pick(cursor_path, response)
-
-            next_url = (
-                cursor_value
-                if cursor_value
-                and isinstance(cursor_value, str)
-                and cursor_value.startswith('https://')
-                else add_param_to_url(req_url, cursor_param, cursor_value)
-                if cursor_param and cursor_value
-                else next_url
-                if cursor_body and cursor_value and isinstance(req_json, dict)
-                else None
+        response = (
+            {
+                'body': response_body,
+                'headers': headers,
+                'responded_at': response_date,
+            }
+            if self.verbose
+            else response_body
+        )
+        return (
+            Page(True, pick(self.req_results_path, response), response, links_headers),
+            False,
+            None,
+        )
+
+    def read_http_error(
+        self,
+        page_url: str,
+        status: int,
+        reason: Optional[str],
+        res_headers: Message,
+        res_body: bytes,
+    ) -> Tuple[Page, bool, Optional[float]]:
+        if self.auth_secret and status in (401, 403):
+            # the cached secret may have been rotated
+            invalidate(self.auth_secret)
+        response_body = (
+            decompress(res_body)
+            if res_headers.get('Content-Encoding') == 'gzip'
+            else res_body
+        ).decode()
+        content_type = res_headers.get('Content-Type', '')
+        retryable = status in RETRY_STATUSES or (
+            status in RETRY_IDEMPOTENT_STATUSES
+            and self.req_method in IDEMPOTENT_METHODS
+        )
+        retry_after = parse_retry_after(res_headers.get('Retry-After'))
+        result = {
+            'error': 'HTTPError',
+            'url': page_url,
+            'status': status,
+            'reason': reason,
+            'body': (
+                loads(response_body)
+                if content_type and content_type.startswith('application/json')
+                else response_body
+            ),
+        }
+        return Page(False, result, None, None), retryable, retry_after
+
+    def read_url_error(
+        self, reason: str, page_host: Optional[str]
+    ) -> Tuple[Page, bool, Optional[float]]:
+        # the request may have reached the server before the connection failed
+        retryable = self.req_method in IDEMPOTENT_METHODS
+        result = {
+            'error': f'URLError',
+            'reason': reason,
+            'host': page_host,
+        }
+        return Page(False, result, None, None), retryable, None
+
+    def next_retry_delay(
+        self,
+        page_url: str,
+        attempt: int,
+        page: Page,
+        retryable: bool,
+        retry_after: Optional[float],
+    ) -> Optional[float]:
+        """
+        Seconds to wait before retrying a page, or None if it is not retried.
+        """
+        if page.ok or not retryable or attempt >= self.max_retries:
+            return None
+
+        delay = retry_delay(attempt, retry_after)
+        remaining = row_remaining_seconds()
+        if remaining is not None and delay > remaining - RETRY_DEADLINE_MARGIN_SECONDS:
+            LOG.debug(f'Not retrying {page_url}, {remaining:.1f}s left.')
+            return None
+
+        LOG.debug(f'Retrying {page_url} in {delay:.2f}s, attempt {attempt + 1}.')
+        return delay
+
+    def fetch_page_once(
+        self, page_url: str, page_json: Optional[Any]
+    ) -> Tuple[Page, bool, Optional[float]]:
+        req, page_host, page_rate_limit = self.build_request(page_url, page_json)
+        rate_limiter.acquire(page_host or '', page_rate_limit)
+
+        try:
+            res = urlopen(req)
+            res_body = res.read()
+        except HTTPError as e:
+            return self.read_http_error(page_url, e.code, e.reason, e.headers, e.read())
+        except URLError as e:
+            return self.read_url_error(str(e.reason), page_host)
+
+        return self.read_response(res.status, res.headers, res_body)
+
+    def fetch_page(self, page_url: str, page_json: Optional[Any]) -> Page:
+        attempt = 0
+        while True:
+            page, retryable, retry_after = self.fetch_page_once(page_url, page_json)
+            delay = self.next_retry_delay(
+                page_url, attempt, page, retryable, retry_after
             )
-            if cursor_body:
-                if isinstance(req_json, dict):
-                    set_value(req_json, cursor_body, cursor_value)
-                else:
-                    raise ValueError('cursor.body present without json param')
+            if delay is None:
+                return page
+
+            attempt += 1
+            sleep(delay)
+
+    async def fetch_page_once_async(
+        self, page_url: str, page_json: Optional[Any]
+    ) -> Tuple[Page, bool, Optional[float]]:
+        req, page_host, page_rate_limit = self.build_request(page_url, page_json)
+        if page_rate_limit:
+            await run_blocking(rate_limiter.acquire, page_host or '', page_rate_limit)
+
+        headers = {
+            name: value.decode() if isinstance(value, bytes) else value
+            for name, value in req.header_items()
+        }
+        if req.data is not None and not req.has_header('Content-type'):
+            # the default of urllib, where aiohttp would send application/octet-stream
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
 
-            if page_limit == req_page_count:
-                next_url = None
+        try:
+            async with get_session().request(
+                self.req_method,
+                URL(page_url, encoded=True),
+                headers=headers,
+                data=req.data,
+            ) as res:
+                res_body = await res.read()
+                res_headers = Message()
+                for name, value in res.headers.items():
+                    res_headers[name] = value
+        except (aiohttp.ClientError, AsyncTimeoutError) as e:
+            return self.read_url_error(str(e) or repr(e), page_host)
+
+        if res.status >= 400:
+            return self.read_http_error(
+                page_url, res.status, res.reason, res_headers, res_body
+            )
+
+        return self.read_response(res.status, res_headers, res_body)
 
-        elif links_headers and isinstance(result, list):
-            row_data += result
-            req_page_count += 1
-            link_dict: Dict[Any, Any] = next(
-                (l for l in links_headers if l['rel'] == 'next'), {}
+    async def fetch_page_async(self, page_url: str, page_json: Optional[Any]) -> Page:
+        attempt = 0
+        while True:
+            page, retryable, retry_after = await self.fetch_page_once_async(
+                page_url, page_json
             )
-            nu: Optional[str] = link_dict.get('url')
-            next_url = nu if nu != next_url else None
+            delay = self.next_retry_delay(
+                page_url, attempt, page, retryable, retry_after
+            )
+            if delay is None:
+                return page
+
+            attempt += 1
+            await async_sleep(delay)
 
-            if page_limit == req_page_count:
+    def add_numeric_page(self, page: Page):
+        if page.ok and self.destination_metadata:
+            self.metadata = pick(self.destination_metadata, page.response)
+        if isinstance(page.result, list):
+            self.row_data += page.result
+        else:
+            self.row_data = page.result
+
+    def paginate(self) -> Generator[Tuple[str, Optional[Any]], Page, None]:
+        """
+        Follows cursors and links, yielding the URL and JSON body of each page
+        to fetch and receiving the fetched page.
+        """
+        req_url = self.req_url
+        req_json = self.req_json
+        req_cursor = self.req_cursor
+        cursor_path = self.cursor_path
+        cursor_param = self.cursor_param
+        cursor_body = self.cursor_body
+        page_limit = self.page_limit
+        req_page_count: int = 0
+        next_url: Optional[str] = req_url
+
+        while next_url:
+            page = yield next_url, req_json
+            result = page.result
+            response = page.response
+            links_headers = page.links_headers
+            if page.ok and self.destination_metadata:
+                self.metadata = pick(self.destination_metadata, response)
+
+            if req_cursor and isinstance(result, list):
+                self.row_data += result
+                req_page_count += 1
+
+                cursor_value = pick(cursor_path, response)
+
+                next_url = (
+                    cursor_value
+                    if cursor_value
+                    and isinstance(cursor_value, str)
+                    and cursor_value.startswith('https://')
+                    else add_param_to_url(req_url, cursor_param, cursor_value)
+                    if cursor_param and cursor_value
+                    else next_url
+                    if cursor_body and cursor_value and isinstance(req_json, dict)
+                    else None
+                )
+                if cursor_body:
+                    if isinstance(req_json, dict):
+                        set_value(req_json, cursor_body, cursor_value)
+                    else:
+                        raise ValueError('cursor.body present without json param')
+
+                if page_limit == req_page_count:
+                    next_url = None
+
+            elif links_headers and isinstance(result, list):
+                self.row_data += result
+                req_page_count += 1
+                link_dict: Dict[Any, Any] = next(
+                    (l for l in links_headers if l['rel'] == 'next'), {}
+                )
+                nu: Optional[str] = link_dict.get('url')
+                next_url = nu if nu != next_url else None
+
+                if page_limit == req_page_count:
+                    next_url = None
+
+            elif isinstance(result, list):
+                self.row_data += result
                 next_url = None
 
-        elif isinstance(result, list):
-            row_data += result
-            next_url = None
+            else:
+                self.row_data = result
+                next_url = None
 
-        else:
-            row_data = result
-            next_url = None
+    def numeric_pages_args(self) -> Tuple[Any, ...]:
+        return (
+            self.req_url,
+            self.req_json,
+            self.cursor_param,
+            self.cursor_body,
+            self.cursor_options,
+            self.page_limit,
+        )
+
+    def result(self) -> Any:
+        LOG.debug(f'<- len(row_data)={len(self.row_data)}')
+        return (
+            self.row_data
+            if self.metadata is None
+            else DataMetadata(self.row_data, self.metadata)
+        )
+
+
+def process_row(
+    base_url: str = '',
+    url: str = '',
+    data: Optional[str] = None,
+    json: Optional[str] = None,
+    method: str = 'get',
+    headers: str = '',
+    auth: Optional[str] = None,
+    params: str = '',
+    verbose: bool = False,
+    cursor: str = '',
+    page_limit: Optional[int] = None,
+    results_path: str = '',
+    destination_metadata: str = '',
+    rate_limit: str = '',
+    retries: Optional[int] = None,
+):
+    call = HttpsCall(
+        base_url,
+        url,
+        data,
+        json,
+        method,
+        headers,
+        auth,
+        params,
+        verbose,
+        cursor,
+        page_limit,
+        results_path,
+        destination_metadata,
+        rate_limit,
+        retries,
+    )
+    call.decrypt_auth()
+
+    LOG.debug('Starting pagination.')
+    if call.numeric_pagination:
+        for page in iter_numeric_pages(call.fetch_page, *call.numeric_pages_args()):
+            call.add_numeric_page(page)
+    else:
+        pages = call.paginate()
+        try:
+            page_request = next(pages)
+            while True:
+                page_request = pages.send(call.fetch_page(*page_request))
+        except StopIteration:
+            pass
+
+    return call.result()
+
+
+async def process_row_async(*args, **kwargs):
+    """
+    Same as process_row, with requests sent on the event loop by aiohttp, so that
+    a batch can have hundreds of requests in flight without a thread for each.
+    """
+    call = HttpsCall(*args, **kwargs)
+    await run_blocking(call.decrypt_auth)
+
+    LOG.debug('Starting pagination.')
+    if call.numeric_pagination:
+        async for page in aiter_numeric_pages(
+            call.fetch_page_async, *call.numeric_pages_args()
+        ):
+            call.add_numeric_page(page)
+    else:
+        pages = call.paginate()
+        try:
+            page_request = next(pages)
+            while True:
+                page_request = pages.send(await call.fetch_page_async(*page_request))
+        except StopIteration:
+            pass
 
-    LOG.debug(f'<- len(row_data)={len(row_data)}')
-    return row_data if metadata is None else DataMetadata(row_data, metadata)
+    return call.result()
@@ -1,11 +1,110 @@
 import json
 import smtplib
 import ssl
+from collections import defaultdict
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import Dict, Optional, Tuple, Any
+from hashlib import sha256
+from os import environ
+from threading import Lock
+from time import monotonic
+from typing import Callable, DefaultDict, Dict, List, Optional, Tuple, Any
+
+from ..utils import LOG
+from ..vault import decrypt_if_encrypted, invalidate
+
+# providers limit messages per connection, e.g. to 100, so sessions are renewed
+MAX_MESSAGES_PER_SESSION = int(environ.get('SMTP_MAX_MESSAGES_PER_SESSION', 100))
+# servers drop idle clients after a few minutes, sessions are closed before that
+IDLE_TIMEOUT_SECONDS = float(environ.get('SMTP_POOL_IDLE_TIMEOUT_SECONDS', 60))
+
+# (host, port, user, password digest, TLS mode)
+SessionKey = Tuple[str, int, Optional[str], str, str]
+
+
+class SmtpSession:
+    """
+    An authenticated SMTP connection and the number of messages sent on it.
+    """
+
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.messages = 0
+        self.last_used = monotonic()
+
+    def is_alive(self) -> bool:
+        """whether the server still answers, checked before the session is reused"""
+        try:
+            code, _ = self.server.noop()
+        except (smtplib.SMTPException, OSError):
+            return False
+        return code == 250
+
+    def sendmail(self, sender: str, recipients: List[str], message: str):
+        self.messages += 1
+        return self.server.sendmail(sender, recipients, message)
+
+    def close(self, quit: bool = False):
+        try:
+            if quit:
+                self.server.quit()
+            else:
+                self.server.close()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+
+# idle sessions kept across rows and warm invocations, most recently used last
+SESSIONS: DefaultDict[SessionKey, List[SmtpSession]] = defaultdict(list)
+_sessions_lock = Lock()
+
+
+def acquire_session(
+    key: SessionKey, connect: Callable[[], smtplib.SMTP]
+) -> SmtpSession:
+    """
+    Checks out an idle session for key that the server still answers on, or
+    connects a new one. Messages are never resent once their data may have been
+    sent, so sessions closed by the server must be detected before sending.
+    """
+    now = monotonic()
+    stale: List[SmtpSession] = []
+    with _sessions_lock:
+        for sessions in SESSIONS.values():
+            fresh: List[SmtpSession] = []
+            for s in sessions:
+                (stale if now - s.last_used > IDLE_TIMEOUT_SECONDS else fresh).append(s)
+            sessions[:] = fresh
+
+    for s in stale:
+        s.close()
+
+    while True:
+        with _sessions_lock:
+            session = SESSIONS[key].pop() if SESSIONS[key] else None
+        if session is None:
+            return SmtpSession(connect())
+        if session.is_alive():
+            return session
+        LOG.debug(f'Discarding stale SMTP session to {key[0]}.')
+        session.close()
+
+
+def release_session(key: SessionKey, session: SmtpSession, reusable: bool):
+    if reusable and session.messages < MAX_MESSAGES_PER_SESSION:
+        session.last_used = monotonic()
+        with _sessions_lock:
+            SESSIONS[key].append(session)
+    else:
+        session.close(quit=reusable)
+
 
-from ..vault import decrypt_if_encrypted
+def clear_sessions():
+    with _sessions_lock:
+        sessions = [s for ss in SESSIONS.values() for s in ss]
+        SESSIONS.clear()
+    for s in sessions:
+        s.close()
 
 
 def parse_smtp_creds(
@@ -34,6 +133,7 @@ def process_row(
     use_ssl=True,
     use_tls=True,
 ):
+    secrets = (user, password, auth)
     user = decrypt_if_encrypted(user)
     password = decrypt_if_encrypted(password)
     sender_email = sender_email or user
@@ -89,32 +189,58 @@ def process_row(
         message.add_header('reply-to', reply_to)
 
     if use_ssl is True:
-        context = ssl.create_default_context()
-        if use_tls is True:
-            smtpserver = smtplib.SMTP(host, port)
-            smtpserver.starttls(context=context)
-        else:
-            smtpserver = smtplib.SMTP_SSL(host, port, context=context)
+        tls_mode = 'starttls' if use_tls is True else 'ssl'
     else:
-        smtpserver = smtplib.SMTP(host, port)
+        tls_mode = 'none'
 
-    if user and password:
-        smtpserver.login(user, password)
+    def connect() -> smtplib.SMTP:
+        if tls_mode == 'starttls':
+            smtpserver = smtplib.SMTP(host, port)
+            smtpserver.starttls(context=ssl.create_default_context())
+        elif tls_mode == 'ssl':
+            smtpserver = smtplib.SMTP_SSL(
+                host, port, context=ssl.create_default_context()
+            )
+        else:
+            smtpserver = smtplib.SMTP(host, port)
 
+        if user and password:
+            try:
+                smtpserver.login(user, password)
+            except smtplib.SMTPAuthenticationError:
+                # the cached credentials may have been rotated
+                invalidate(*secrets)
+                smtpserver.close()
+                raise
+
+        return smtpserver
+
+    key = (
+        host,
+        int(port),
+        user,
+        sha256((password or '').encode()).hexdigest(),
+        tls_mode,
+    )
+
+    session = acquire_session(key, connect)
+    reusable = True
     try:
-        result = smtpserver.sendmail(sender_email, recipients, message.as_string())
+        # not retried on disconnects, the server may have accepted the message
+        return session.sendmail(sender_email, recipients, message.as_string())
     except ValueError as e:
-        result = {
+        return {
             'error': 'ValueError',
             'reason': str(e),
         }
     except smtplib.SMTPDataError as e:
-        result = {
+        return {
             'error': 'SMTPDataError',
             'smtp_code': e.smtp_code,
             'smtp_error': e.smtp_error.decode(),
         }
+    except BaseException:
+        reusable = False
+        raise
     finally:
-        smtpserver.close()
-
-    return result
+        release_session(key, session, reusable)
@@ -0,0 +1,54 @@
+'''
+Event loop shared by all invocations of a container.
+
+Coroutine drivers run on a single loop in a daemon thread that outlives the
+invocation, so that connection pools bound to the loop, like aiohttp sessions,
+are reused by later batches the same way lru_cache keeps clients around.
+
+Blocking steps of coroutines, like decrypting secrets, waiting for rate limits
+or writing to destinations, must go through run_blocking() so they do not stall
+the loop. Its executor is sized for the number of rows in flight, which the
+default executor of the loop is not.
+'''
+
+from asyncio import (
+    AbstractEventLoop,
+    get_running_loop,
+    new_event_loop,
+    run_coroutine_threadsafe,
+)
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import environ
+from threading import Lock, Thread
+from typing import Any, Callable, Coroutine, Optional
+
+EXECUTOR_MAX_WORKERS = int(environ.get('GEFF_EVENT_LOOP_EXECUTOR_WORKERS', 256))
+
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=EXECUTOR_MAX_WORKERS, thread_name_prefix='geff-blocking'
+)
+
+_loop: Optional[AbstractEventLoop] = None
+_loop_lock = Lock()
+
+
+def get_loop() -> AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = new_event_loop()
+            _loop.set_default_executor(EXECUTOR)
+            Thread(
+                target=_loop.run_forever, name='geff-event-loop', daemon=True
+            ).start()
+        return _loop
+
+
+def submit(coro: Coroutine[Any, Any, Any]) -> Future:
+    """runs coro on the shared loop and returns a future for its result"""
+    return run_coroutine_threadsafe(coro, get_loop())
+
+
+async def run_blocking(func: Callable[..., Any], *args: Any) -> Any:
+    """runs func(*args) on EXECUTOR without blocking the running loop"""
+    return await get_running_loop().run_in_executor(EXECUTOR, func, *args)
@@ -1,38 +1,62 @@
 import os
 import os.path
 import sys
-from base64 import b64encode
-from gzip import compress
+from asyncio import Semaphore, Task, ensure_future, gather, shield
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import lru_cache
 from importlib import import_module
 from json import dumps, loads
-from typing import Any, Callable, Dict, Text, Optional, List, Tuple, Union
+from math import inf
+from typing import Any, Callable, Dict, Generator, Text, Optional, List, Tuple, Union
+from threading import Event, Lock
+from time import monotonic
 from types import ModuleType
 from urllib.parse import urlparse
 from timeit import default_timer as timer
 
 from botocore.exceptions import ClientError
+from . import result_cache
+from .event_loop import run_blocking, submit as submit_to_event_loop
 from .log import format_trace
 from .utils import (
     LOG,
-    cast_parameters,
+    apply_cast_plan,
+    compile_format,
     create_response,
-    format,
+    format_row,
     invoke_process_lambda,
     ResponseType,
     DataMetadata,
+    GzipResponseBuilder,
+    get_cast_plan,
+    remaining_seconds,
+    set_deadline,
+    set_row_deadline,
 )
 from .batch_locking_backends.dynamodb import (
-    initialize_batch,
-    is_batch_initialized,
-    is_batch_processing,
-    get_response_for_batch,
+    claim_batch,
+    get_checkpoints,
+    release_batch,
+    wait_for_batch_response,
     finish_batch_processing,
+    BatchCheckpoint,
     BATCH_LOCKING_ENABLED,
 )
 
 LAMBDA_RESPONSE_MAX_BYTES = 6_291_556
 SECONDS_BEFORE_BATCH_LOCKING_BACKEND_STORAGE = 20
 SECONDS_BEFORE_GATEWAY_TIMEOUT = 30
+MAX_LAMBDA_TIMEOUT_SECONDS = 900
+MAX_CONCURRENCY = 64
+MAX_ASYNC_CONCURRENCY = 1024
+DEFAULT_CONCURRENCY = int(os.environ.get('GEFF_CONCURRENCY', 0))
+# time kept for serializing and returning the response after the last row
+DEADLINE_MARGIN_SECONDS = float(os.environ.get('GEFF_DEADLINE_MARGIN_SECONDS', 3))
+DEADLINE_ERROR = repr(
+    TimeoutError('row was not processed before the invocation deadline')
+)
 
 # pip install --target ./site-packages -r requirements.txt
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -41,6 +65,10 @@ sys.path.append(os.path.join(dir_path, 'site-packages'))
 BATCH_ID_HEADER = 'sf-external-function-query-batch-id'
 DESTINATION_URI_HEADER = 'sf-custom-destination-uri'
 
+ResolvedDriver = namedtuple(
+    'ResolvedDriver', ['module', 'path', 'process_row', 'cast_plan']
+)
+
 
 def async_flow_init(event: Any, context: Any) -> ResponseType:
     """
@@ -104,46 +132,300 @@ def async_flow_poll(destination: Text, batch_id: Text) -> ResponseType:
         return {'statusCode': 202}
 
 
-def process_batch(
+@lru_cache(maxsize=None)
+def resolve_driver(event_path: Text) -> ResolvedDriver:
+    """
+    Parses the request path, imports the call driver and precomputes how its
+    parameters are cast. Cached for the lifetime of the container, so that rows
+    only pay for formatting their arguments and calling the driver.
+
+    Args:
+        event_path (Text): Path of the request, e.g. /https or /boto3/extra/args.
+
+    Returns:
+        ResolvedDriver: The driver module, the remaining path segments which are
+        passed as positional arguments, its process_row and its cast plan.
+    """
+    driver, *path = event_path.lstrip('/').split('/')
+    driver = driver.replace('-', '_')
+    driver_module = import_module(f'geff.drivers.process_{driver}', package=None)
+    process_row = driver_module.process_row  # type: ignore
+
+    return ResolvedDriver(
+        driver_module, tuple(path), process_row, get_cast_plan(process_row)
+    )
+
+
+def get_concurrency(
+    concurrency: Optional[Text], event_path: Text, use_async: bool = False
+) -> int:
+    """
+    Resolves how many rows of a batch are processed in parallel.
+
+    The sf-custom-concurrency header takes precedence over the GEFF_CONCURRENCY
+    environment variable, which takes precedence over the CONCURRENCY attribute
+    of the call driver module, or ASYNC_CONCURRENCY for coroutines. Rows are
+    processed sequentially by default. An invalid header is ignored.
+
+    Args:
+        concurrency (Optional[Text]): Value of the sf-custom-concurrency header.
+        event_path (Text): Path of the request, used to find the call driver.
+        use_async (bool): Whether rows are processed as coroutines, which are
+            cheaper than threads and allow more of them. Defaults to False.
+
+    Returns:
+        int: Number of worker threads or coroutines, between 1 and
+        MAX_CONCURRENCY or MAX_ASYNC_CONCURRENCY.
+    """
+    n: Optional[int] = None
+    if concurrency:
+        try:
+            n = int(concurrency)
+        except ValueError:
+            LOG.debug(f'Ignoring the invalid concurrency {concurrency!r}.')
+
+    if n is None and DEFAULT_CONCURRENCY:
+        n = DEFAULT_CONCURRENCY
+
+    if n is None:
+        try:
+            module = resolve_driver(event_path).module
+            n = getattr(module, 'CONCURRENCY', 1)
+            if use_async:
+                n = getattr(module, 'ASYNC_CONCURRENCY', n)
+        except Exception:
+            n = 1  # the per-row error is reported by process_batch
+
+    return max(1, min(n, MAX_ASYNC_CONCURRENCY if use_async else MAX_CONCURRENCY))
+
+
+def get_cache_ttl(cache_ttl: Optional[Text]) -> float:
+    """
+    Parses the sf-custom-cache-ttl header.
+
+    Args:
+        cache_ttl (Optional[Text]): Seconds for which read-only results are cached.
+
+    Returns:
+        float: The number of seconds, or 0, meaning results are not cached, if the
+        header is missing or invalid.
+    """
+    if not cache_ttl:
+        return 0
+    try:
+        ttl = float(cache_ttl)
+    except ValueError:
+        ttl = -1
+    if not 0 <= ttl < inf:
+        LOG.debug(f'Ignoring the invalid cache TTL {cache_ttl!r}.')
+        return 0
+    return ttl
+
+
+def get_deadline(event: Any, start_time: float) -> Optional[float]:
+    """
+    Resolves by when, in monotonic() time, the rows of a batch must be done.
+
+    Invocations end when the Lambda function times out. Requests from API Gateway
+    also end when the gateway times out, unless the batch-locking backend keeps
+    the response for Snowflake's retry of the request.
+
+    Args:
+        event (Any): This is the event object as received by the lambda_handler().
+        start_time (float): timer() when the invocation started.
+
+    Returns:
+        Optional[float]: The deadline, or None if the remaining time is unknown.
+    """
+    remaining = remaining_seconds()
+
+    if event.get('httpMethod') and not BATCH_LOCKING_ENABLED:
+        gateway_remaining = SECONDS_BEFORE_GATEWAY_TIMEOUT - (timer() - start_time)
+        if remaining is None or gateway_remaining < remaining:
+            remaining = gateway_remaining
+
+    if remaining is None:
+        return None
+
+    return monotonic() + remaining - DEADLINE_MARGIN_SECONDS
+
+
+def driver_allows(driver: ResolvedDriver, hook: Text, params: Dict[Text, Any]) -> bool:
+    """
+    Asks the call driver whether a call may be shared between rows with the same
+    arguments (is_idempotent) or cached across batches (is_read_only). Drivers
+    opt in by defining these hooks, which receive the arguments of process_row.
+
+    Args:
+        driver (ResolvedDriver): The call driver.
+        hook (Text): Name of the hook, is_idempotent or is_read_only.
+        params (Dict[Text, Any]): Cast keyword arguments of the call.
+
+    Returns:
+        bool: False unless the driver defines the hook and it returns True.
+    """
+    driver_hook = getattr(driver.module, hook, None)
+    return bool(driver_hook and driver_hook(*driver.path, **params))
+
+
+def iter_batch(
     driver_kwargs: Dict[Text, Any],
     write_uri: Text,
     batch_id: Text,
     req_body_data: List[List[Any]],
     event_path: Text,
     destination_driver: Optional[ModuleType],
-) -> List[List[Union[int, Any]]]:
+    concurrency: int = 1,
+    dedupe: bool = False,
+    cache_ttl: float = 0,
+    deadline: Optional[float] = None,
+    use_async: bool = False,
+    bulk: Optional[bool] = None,
+) -> Generator[List[Union[int, Any]], None, None]:
     """
-    Processes a request and returns the result data.
+    Processes a request, yielding the result of each row as soon as it and all
+    rows before it are done. Closing the iterator stops dispatching new rows.
+
+    Call drivers defining process_rows(*path, rows) get all rows of the batch in
+    one call instead, and return a result or an exception for each of them. This
+    is the default unless the driver sets BULK = False.
 
     Args:
         event (Any): This is the event object as received by the lambda_handler().
         destination_driver (Optional[ModuleType]): The destination driver such as S3.
-
-    Returns:
-        List[List[Union[int, Any]]]: Result data returned after the request is processed.
+        concurrency (int): Number of rows processed in parallel. Defaults to 1.
+        dedupe (bool): Call idempotent drivers once per distinct set of arguments
+            and share the result between rows. Defaults to False.
+        cache_ttl (float): Seconds for which results of read-only calls are
+            cached across batches, see result_cache. Defaults to 0, not cached.
+        deadline (Optional[float]): monotonic() time after which rows are no longer
+            started or waited for, and get a TimeoutError instead. Defaults to None.
+        use_async (bool): Process rows as coroutines on the container's event loop
+            if the call driver defines process_row_async. Defaults to False.
+        bulk (Optional[bool]): Whether to use the driver's process_rows, if it has
+            one. Defaults to None, which uses its BULK attribute.
+
+    Yields:
+        List[Union[int, Any]]: Row number and result, in the same order as req_body_data.
     """
-    res_data = []
+    templates = {k: compile_format(v) for k, v in driver_kwargs.items()}
+    # serialized arguments -> result of the first row calling the driver with them
+    calls: Dict[Text, Future] = {}
+    calls_lock = Lock()
+    # set once the caller stops waiting for rows
+    stopped = Event()
+    # the same for coroutines, only used from the event loop
+    async_calls: 'Dict[Text, Task[DataMetadata]]' = {}
+
+    def prepare_call(
+        process_row_params: Dict[Text, Any],
+    ) -> Tuple[ResolvedDriver, Dict[Text, Any], Optional[Text], Optional[Text]]:
+        """driver and cast arguments of a row, and its cache and dedupe keys"""
+        driver = resolve_driver(event_path)
+        params = apply_cast_plan(process_row_params, driver.cast_plan)
+
+        cache_key = (
+            result_cache.cache_key(event_path, process_row_params)
+            if cache_ttl and driver_allows(driver, 'is_read_only', params)
+            else None
+        )
+        dedupe_key = (
+            dumps(process_row_params, sort_keys=True, default=str)
+            if dedupe and driver_allows(driver, 'is_idempotent', params)
+            else None
+        )
+
+        return driver, params, cache_key, dedupe_key
+
+    def call_driver(
+        driver: ResolvedDriver, params: Dict[Text, Any], cache_key: Optional[Text]
+    ) -> DataMetadata:
+        if cache_key:
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                LOG.debug('Using a cached result.')
+                return cached
+
+        LOG.debug(f'Invoking process_row for the driver {driver.module.__name__}.')
+        result = driver.process_row(*driver.path, **params)
+        LOG.debug(f'Got result for URL: {params.get("url")}.')
+
+        if not isinstance(result, DataMetadata):
+            result = DataMetadata(result, None)
+
+        if cache_key:
+            result_cache.put(cache_key, result, cache_ttl)
+
+        return result
+
+    def call_driver_once(
+        driver: ResolvedDriver,
+        params: Dict[Text, Any],
+        cache_key: Optional[Text],
+        key: Text,
+    ) -> DataMetadata:
+        with calls_lock:
+            first = key not in calls
+            if first:
+                calls[key] = Future()
+            call: Future = calls[key]
+
+        if first:
+            try:
+                call.set_result(call_driver(driver, params, cache_key))
+            except Exception as e:
+                call.set_exception(e)
+        else:
+            LOG.debug('Reusing the result of a row with the same arguments.')
+
+        return call.result()
+
+    async def call_driver_async(
+        driver: ResolvedDriver, params: Dict[Text, Any], cache_key: Optional[Text]
+    ) -> DataMetadata:
+        if cache_key:
+            cached = await run_blocking(result_cache.get, cache_key)
+            if cached is not None:
+                LOG.debug('Using a cached result.')
+                return cached
+
+        result = await driver.module.process_row_async(  # type: ignore
+            *driver.path, **params
+        )
+
+        if not isinstance(result, DataMetadata):
+            result = DataMetadata(result, None)
+
+        if cache_key:
+            await run_blocking(result_cache.put, cache_key, result, cache_ttl)
+
+        return result
+
+    def timed_out(row: List[Any]) -> List[Union[int, Any]]:
+        return [row[0], [{'error': DEADLINE_ERROR}]]
 
-    for row_number, *args in req_body_data:
-        process_row_params = {k: format(v, args) for k, v in driver_kwargs.items()}
+    def is_stopped() -> bool:
+        """whether rows can no longer be returned, e.g. they were abandoned"""
+        return stopped.is_set() or (deadline is not None and monotonic() >= deadline)
+
+    def process_batch_row(row: List[Any]) -> List[Union[int, Any]]:
+        if is_stopped():
+            return timed_out(row)
+
+        row_number, *args = row
+        process_row_params = format_row(templates, args)
 
         try:
-            driver, *path = event_path.lstrip('/').split('/')
-            driver = driver.replace('-', '_')
-            driver_module = f'geff.drivers.process_{driver}'
-            process_row = import_module(
-                driver_module, package=None
-            ).process_row  # type: ignore
-
-            LOG.debug(f'Invoking process_row for the driver {driver_module}.')
-            result = process_row(
-                *path, **cast_parameters(process_row_params, process_row)
-            )
-            LOG.debug(f'Got result for URL: {process_row_params.get("url")}.')
+            driver, params, cache_key, dedupe_key = prepare_call(process_row_params)
 
-            if not isinstance(result, DataMetadata):
-                result = DataMetadata(result, None)
+            if dedupe_key:
+                result = call_driver_once(driver, params, cache_key, dedupe_key)
+            else:
+                result = call_driver(driver, params, cache_key)
 
+            if write_uri and is_stopped():
+                # the batch may be finalized already, so its destination is left alone
+                return timed_out(row)
             if write_uri:
                 # Write data to destination and return manifest
                 row_result = destination_driver.write(  # type: ignore
@@ -155,9 +437,264 @@ def process_batch(
         except Exception as e:
             row_result = [{'error': repr(e), 'trace': format_trace(e)}]
 
-        res_data.append([row_number, row_result])
+        return [row_number, row_result]
+
+    async def process_batch_row_async(row: List[Any]) -> List[Union[int, Any]]:
+        if is_stopped():
+            return timed_out(row)
+
+        row_number, *args = row
+        process_row_params = format_row(templates, args)
+
+        try:
+            driver, params, cache_key, dedupe_key = prepare_call(process_row_params)
+
+            if dedupe_key:
+                if dedupe_key not in async_calls:
+                    async_calls[dedupe_key] = ensure_future(
+                        call_driver_async(driver, params, cache_key)
+                    )
+                # the call is shared, so a cancelled row must not cancel it
+                result = await shield(async_calls[dedupe_key])
+            else:
+                result = await call_driver_async(driver, params, cache_key)
+
+            if write_uri and is_stopped():
+                # the batch may be finalized already, so its destination is left alone
+                return timed_out(row)
+            if write_uri:
+                # Write data to destination and return manifest
+                row_result = await run_blocking(
+                    destination_driver.write,  # type: ignore
+                    write_uri,
+                    batch_id,
+                    result,
+                    row_number,
+                )
+            else:
+                row_result = result.data
+
+        except Exception as e:
+            row_result = [{'error': repr(e), 'trace': format_trace(e)}]
+
+        return [row_number, row_result]
+
+    async def process_rows_async(futures: List[Future]):
+        semaphore = Semaphore(concurrency)
+
+        async def process_row_async(row: List[Any], future: Future):
+            async with semaphore:
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    future.set_result(await process_batch_row_async(row))
+                except BaseException as e:
+                    # e.g. a template referencing a missing column, or cancellation
+                    future.set_exception(e)
+                    if not isinstance(e, Exception):
+                        raise
+
+        await gather(*map(process_row_async, req_body_data, futures))
+
+    def process_rows_in_bulk(
+        driver: ResolvedDriver,
+    ) -> Generator[List[Union[int, Any]], None, None]:
+        # row index -> result or exception, missing for rows never sent
+        results: Dict[int, Any] = {}
+        calls: List[Tuple[int, Dict[Text, Any]]] = []
+        for i, (row_number, *args) in enumerate(req_body_data):
+            process_row_params = format_row(templates, args)
+            try:
+                calls.append((i, apply_cast_plan(process_row_params, driver.cast_plan)))
+            except Exception as e:
+                results[i] = e
+
+        if calls and (deadline is None or monotonic() < deadline):
+            LOG.debug(f'Invoking process_rows for {len(calls)} rows.')
+            try:
+                call_results = driver.module.process_rows(  # type: ignore
+                    *driver.path, [params for _, params in calls]
+                )
+            except Exception as e:
+                call_results = [e] * len(calls)
+            results.update(zip((i for i, _ in calls), call_results))
+
+        for i, row in enumerate(req_body_data):
+            if i not in results:
+                yield timed_out(row)
+                continue
+
+            row_number = row[0]
+            result = results[i]
+            try:
+                if isinstance(result, Exception):
+                    raise result
+
+                if not isinstance(result, DataMetadata):
+                    result = DataMetadata(result, None)
+
+                if write_uri:
+                    # Write data to destination and return manifest
+                    row_result = destination_driver.write(  # type: ignore
+                        write_uri, batch_id, result, row_number
+                    )
+                else:
+                    row_result = result.data
+
+            except Exception as e:
+                row_result = [{'error': repr(e), 'trace': format_trace(e)}]
+
+            yield [row_number, row_result]
+
+    try:
+        driver = resolve_driver(event_path)
+    except Exception:
+        driver = None  # the per-row error is reported by process_batch_row
+
+    if driver is None:
+        yield from map(process_batch_row, req_body_data)
+        return
+
+    if bulk is None:
+        bulk = getattr(driver.module, 'BULK', True)
+
+    if bulk and hasattr(driver.module, 'process_rows'):
+        yield from process_rows_in_bulk(driver)
+        return
+
+    use_async = use_async and hasattr(driver.module, 'process_row_async')
+
+    # with a deadline, even a single row runs on a worker thread, so that it can
+    # be abandoned if the driver call outlasts the deadline
+    sequential = concurrency <= 1 or len(req_body_data) <= 1
+    if not use_async and sequential and deadline is None:
+        yield from map(process_batch_row, req_body_data)
+        return
+
+    futures: List[Future]
+    if use_async:
+        LOG.debug(
+            f'Processing {len(req_body_data)} rows as coroutines,'
+            f' {concurrency} at once.'
+        )
+        futures = [Future() for _ in req_body_data]
+        rows_done = submit_to_event_loop(process_rows_async(futures))
+
+        def stop():
+            # rows not started yet are cancelled, and so are rows still running,
+            # whose results cannot be returned anyway
+            for future in futures:
+                future.cancel()
+            rows_done.cancel()
+
+    else:
+        LOG.debug(
+            f'Processing {len(req_body_data)} rows with concurrency {concurrency}.'
+        )
+        executor = ThreadPoolExecutor(max_workers=min(concurrency, len(req_body_data)))
+        futures = [executor.submit(process_batch_row, row) for row in req_body_data]
+
+        def stop():
+            # rows not started yet are cancelled, rows still running past the
+            # deadline are left behind as their results cannot be returned anyway
+            executor.shutdown(wait=deadline is None, cancel_futures=True)
+
+    try:
+        for row, future in zip(req_body_data, futures):
+            try:
+                yield future.result(
+                    None if deadline is None else max(0, deadline - monotonic())
+                )
+            except FutureTimeoutError:
+                yield timed_out(row)
+    finally:
+        stopped.set()
+        stop()
+
+
+def is_timed_out(row: List[Union[int, Any]]) -> bool:
+    return row[1] == [{'error': DEADLINE_ERROR}]
+
+
+def is_error(row: List[Union[int, Any]]) -> bool:
+    """whether a row failed, e.g. timed out or got a 429 from the driver"""
+    result = row[1]
+    if isinstance(result, list) and len(result) == 1:
+        result = result[0]
+    return isinstance(result, dict) and 'error' in result
+
+
+def merge_checkpointed_rows(
+    req_body_data: List[List[Any]],
+    checkpointed: Dict[int, Any],
+    rows: Generator[List[Union[int, Any]], None, None],
+) -> Generator[List[Union[int, Any]], None, None]:
+    """
+    Yields the results of a resumed batch in row order, taking checkpointed rows
+    from checkpointed and the others from rows, which processes the missing rows.
+    """
+    try:
+        for row_number, *_ in req_body_data:
+            if row_number in checkpointed:
+                yield [row_number, checkpointed[row_number]]
+            else:
+                yield next(rows)
+    finally:
+        rows.close()
+
+
+def process_batch(
+    driver_kwargs: Dict[Text, Any],
+    write_uri: Text,
+    batch_id: Text,
+    req_body_data: List[List[Any]],
+    event_path: Text,
+    destination_driver: Optional[ModuleType],
+    concurrency: int = 1,
+    dedupe: bool = False,
+    cache_ttl: float = 0,
+    deadline: Optional[float] = None,
+    use_async: bool = False,
+    bulk: Optional[bool] = None,
+) -> List[List[Union[int, Any]]]:
+    """
+    Processes a request and returns the result data.
+
+    Args:
+        event (Any): This is the event object as received by the lambda_handler().
+        destination_driver (Optional[ModuleType]): The destination driver such as S3.
+        concurrency (int): Number of rows processed in parallel. Defaults to 1.
+        dedupe (bool): Share results between rows with the same arguments.
+            Defaults to False.
+        cache_ttl (float): Seconds for which results of read-only calls are
+            cached across batches. Defaults to 0, not cached.
+        deadline (Optional[float]): monotonic() time after which rows time out.
+            Defaults to None.
+        use_async (bool): Process rows as coroutines if the driver supports it.
+            Defaults to False.
+        bulk (Optional[bool]): Send all rows to the driver's process_rows.
+            Defaults to None, decided by the driver.
 
-    return res_data
+    Returns:
+        List[List[Union[int, Any]]]: Result data returned after the request is processed,
+        in the same order as req_body_data.
+    """
+    return list(
+        iter_batch(
+            driver_kwargs,
+            write_uri,
+            batch_id,
+            req_body_data,
+            event_path,
+            destination_driver,
+            concurrency,
+            dedupe,
+            cache_ttl,
+            deadline,
+            use_async,
+            bulk,
+        )
+    )
 
 
 def sync_flow(event: Any, context: Any = None) -> Optional[ResponseType]:
@@ -188,55 +725,104 @@ def sync_flow(event: Any, context: Any = None) -> Optional[ResponseType]:
 
     LOG.debug(f'sync_flow() received destination: {write_uri}.')
 
-    if BATCH_LOCKING_ENABLED and not destination_driver:
-        if not is_batch_initialized(batch_id):
-            initialize_batch(batch_id)
-        else:
-            while is_batch_processing(batch_id):
-                if (timer() - start_time) > SECONDS_BEFORE_GATEWAY_TIMEOUT:
-                    return None
-
-            return get_response_for_batch(batch_id)
-
+    # batch options are read before the batch is claimed, so that they cannot
+    # fail the invocation while it holds the lock
     driver_kwargs: Dict[Text, Any] = {
         k.replace('sf-custom-', '').replace('-', '_'): v
         for k, v in headers.items()
         if k.startswith('sf-custom-')
     }
+    use_async = driver_kwargs.pop('async', '').lower() == 'true'
+    bulk = driver_kwargs.pop('bulk', None)
+    concurrency = get_concurrency(
+        driver_kwargs.pop('concurrency', None), event['path'], use_async
+    )
+    dedupe = driver_kwargs.pop('dedupe', '').lower() == 'true'
+    cache_ttl = get_cache_ttl(driver_kwargs.pop('cache_ttl', None))
+
+    checkpoint = None
+    checkpointed: Dict[int, Any] = {}
+    if BATCH_LOCKING_ENABLED and not destination_driver:
+        claimed, checkpoints = claim_batch(
+            batch_id, remaining_seconds() or MAX_LAMBDA_TIMEOUT_SECONDS
+        )
+        if not claimed:
+            return wait_for_batch_response(
+                batch_id, SECONDS_BEFORE_GATEWAY_TIMEOUT - (timer() - start_time)
+            )
+        if checkpoints:
+            checkpointed = get_checkpoints(batch_id, checkpoints)
+        checkpoint = BatchCheckpoint(batch_id)
+
+    if destination_driver:
+        # Ignoring style due to dynamic import
+        destination_driver.start_batch(write_uri, batch_id)  # type: ignore
+
+    deadline = get_deadline(event, start_time)
+    # drivers stop retrying in time for rows to be returned
+    set_row_deadline(deadline)
 
-    res_data = process_batch(
+    rows = iter_batch(
         driver_kwargs,
         write_uri,
         batch_id,
-        req_body_data,
+        [row for row in req_body_data if row[0] not in checkpointed],
         event['path'],
         destination_driver,
+        concurrency,
+        dedupe,
+        cache_ttl,
+        deadline,
+        use_async,
+        None if bulk is None else bulk.lower() == 'true',
     )
+    if checkpointed:
+        rows = merge_checkpointed_rows(req_body_data, checkpointed, rows)
 
     # Write data to s3 or return data synchronously
     if destination_driver:
+        res_data = list(rows)
         response = destination_driver.finalize(  # type: ignore
             write_uri, batch_id, res_data
         )
-    else:
-        data_dumps = dumps({'data': res_data}, default=str)
-        response = {
-            'statusCode': 200,
-            'body': b64encode(compress(data_dumps.encode())).decode(),
-            'isBase64Encoded': True,
-            'headers': {'Content-Encoding': 'gzip'},
-        }
-        end_time = timer()
-        if (
-            BATCH_LOCKING_ENABLED
-            and (end_time - start_time) > SECONDS_BEFORE_BATCH_LOCKING_BACKEND_STORAGE
-        ):
-            LOG.debug('Storing the response in the batch locking backend.')
-            finish_batch_processing(batch_id, response, res_data)  # write the response
-
-    response_length = len(dumps(response))
-    if response_length > LAMBDA_RESPONSE_MAX_BYTES:
-        response = construct_size_error_response(response_length, req_body)
+        response_length = len(dumps(response))
+        if response_length > LAMBDA_RESPONSE_MAX_BYTES:
+            response = construct_size_error_response(response_length, req_body)
+        return response
+
+    # Rows are serialized and compressed as they complete, and processing stops
+    # as soon as the response is known to exceed the maximum payload size.
+    response_builder = GzipResponseBuilder()
+    res_data = []
+    for row in rows:
+        res_data.append(row)
+        response_builder.add_row(row)
+        # failed rows are processed again when the batch is resumed
+        if checkpoint and row[0] not in checkpointed and not is_error(row):
+            checkpoint.add(row)
+        if response_builder.size > LAMBDA_RESPONSE_MAX_BYTES:
+            rows.close()  # the remaining rows cannot be returned anyway
+            break
+
+    if response_builder.size <= LAMBDA_RESPONSE_MAX_BYTES:
+        response = response_builder.finish()
+    if response_builder.size > LAMBDA_RESPONSE_MAX_BYTES:
+        response = construct_size_error_response(response_builder.size, req_body)
+
+    if checkpoint and any(map(is_timed_out, res_data)):
+        # a retry of the request resumes from the rows completed so far
+        checkpoint.flush()
+        release_batch(batch_id)
+        return response
+
+    end_time = timer()
+    if (
+        BATCH_LOCKING_ENABLED
+        and (end_time - start_time) > SECONDS_BEFORE_BATCH_LOCKING_BACKEND_STORAGE
+    ):
+        LOG.debug('Storing the response in the batch locking backend.')
+        finish_batch_processing(batch_id, response, res_data)  # write the response
+
     return response
 
 
@@ -292,6 +878,7 @@ def lambda_handler(event: Any, context: Any) -> Optional[ResponseType]:
     method = event.get('httpMethod')
     headers = event['headers']
     LOG.debug(f'lambda_handler() called.')
+    set_deadline(context)
 
     destination = headers.get(DESTINATION_URI_HEADER)
     batch_id = headers.get(BATCH_ID_HEADER)
@@ -0,0 +1,184 @@
+'''
+Per-host rate limiting for call drivers.
+
+Requests to a host are paced by a token bucket shared by all rows and threads
+of the container, refilling at `rate` requests per second up to `burst`
+requests. With `shared`, containers additionally coordinate through per-second
+request counters in the batch-locking DynamoDB table, so that the rate also
+holds across concurrent invocations.
+
+Limits are written as a number of requests per second, e.g. `5`, or as JSON,
+e.g. `{"rate": 5, "burst": 10, "shared": true}`.
+'''
+
+from collections import namedtuple
+from json import loads
+from math import ceil
+from threading import Lock
+from time import monotonic, sleep, time
+from typing import Any, Dict, Optional
+
+from .batch_locking_backends.dynamodb import BATCH_LOCKING_ENABLED, count_request
+from .utils import LOG, row_remaining_seconds
+
+RateLimit = namedtuple('RateLimit', ['rate', 'burst', 'shared'])
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def configure(self, rate: float, burst: float):
+        """Changes the limit, keeping the tokens left rather than a new burst."""
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+    def acquire(self, timeout: Optional[float] = None) -> float:
+        """
+        Takes a token, waiting for one to be refilled if necessary.
+
+        Args:
+            timeout (Optional[float]): Seconds after which to give up waiting.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+
+            check_timeout(waited + wait, timeout)
+            sleep(wait)
+            waited += wait
+
+
+def check_timeout(wait: float, timeout: Optional[float]):
+    if timeout is not None and wait > timeout:
+        raise TimeoutError(f'rate limit would delay the request by {wait:.1f}s')
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_buckets_lock = Lock()
+
+
+def parse_rate_limit(value: Any) -> Optional[RateLimit]:
+    """
+    Parses a rate limit from a header value or a key of an auth secret.
+
+    Args:
+        value (Any): A number of requests per second, a dict or a JSON object with
+            rate and optional burst and shared keys, or None.
+
+    Returns:
+        Optional[RateLimit]: The rate limit, or None if value is empty.
+    """
+    if value in (None, ''):
+        return None
+    if isinstance(value, str) and value.startswith('{'):
+        value = loads(value)
+    if not isinstance(value, dict):
+        value = {'rate': value}
+
+    rate = float(value['rate'])
+    if rate <= 0:
+        raise ValueError('rate limit must be a positive number of requests per second')
+
+    # buckets never refill beyond burst, so they need room for a whole request
+    burst = float(value.get('burst', max(1.0, rate)))
+    if burst < 1:
+        raise ValueError('rate limit burst must be at least 1 request')
+
+    return RateLimit(rate, burst, bool(value.get('shared')))
+
+
+def strictest(*limits: Optional[RateLimit]) -> Optional[RateLimit]:
+    """Combines rate limits, e.g. from a header and an auth secret."""
+    given = [l for l in limits if l]
+    if not given:
+        return None
+
+    return RateLimit(
+        min(l.rate for l in given),
+        min(l.burst for l in given),
+        any(l.shared for l in given),
+    )
+
+
+def acquire(host: str, limit: Optional[RateLimit]):
+    """
+    Waits until a request to host is allowed by limit, raising TimeoutError
+    rather than waiting past the row deadline.
+
+    Args:
+        host (str): Host the request is made to.
+        limit (Optional[RateLimit]): Rate limit for the host. No-op if None.
+    """
+    if not limit:
+        return
+
+    timeout = row_remaining_seconds()
+
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if not bucket:
+            bucket = _buckets[host] = TokenBucket(limit.rate, limit.burst)
+        elif (bucket.rate, bucket.burst) != (limit.rate, limit.burst):
+            # rows with different limits for a host share its tokens
+            bucket.configure(limit.rate, limit.burst)
+
+    waited = bucket.acquire(timeout)
+
+    if limit.shared:
+        waited += acquire_shared(
+            host, limit, None if timeout is None else timeout - waited
+        )
+
+    if waited:
+        LOG.debug(f'Rate limited requests to {host} for {waited:.3f}s.')
+
+
+def acquire_shared(
+    host: str, limit: RateLimit, timeout: Optional[float] = None
+) -> float:
+    """
+    Waits until fewer than limit.rate requests to host were counted in the current
+    window across all containers.
+
+    Returns:
+        float: Seconds spent waiting.
+    """
+    if not BATCH_LOCKING_ENABLED:
+        LOG.debug('Shared rate limits need the batch-locking DynamoDB table.')
+        return 0.0
+
+    window = max(1.0, 1 / limit.rate)
+    allowed = max(1, int(limit.rate * window))
+    waited = 0.0
+
+    while True:
+        now = time()
+        window_start = int(now // window * window)
+        if count_request(f'rate-limit#{host}#{window_start}', ceil(window)) <= allowed:
+            return waited
+
+        wait = window_start + window - now
+        check_timeout(waited + wait, timeout)
+        sleep(wait)
+        waited += wait
@@ -0,0 +1,155 @@
+'''
+Cache of call driver results shared between rows, batches and invocations.
+
+Results of read-only calls are kept for the number of seconds given by the
+sf-custom-cache-ttl header, in an in-container LRU and, if RESULT_CACHE_URI is
+set, in a tier shared by all containers:
+
+- `dynamodb://<table>` stores results in a table with a string partition key
+  named `key`, expired by DynamoDB TTL on the `ttl` attribute
+- `s3://<bucket>/<prefix>` stores results as objects under the prefix, which
+  a lifecycle rule should expire
+
+Keys are SHA-256 hashes of the driver path and its formatted arguments, so that
+neither arguments nor secret references are stored. Error results are not cached.
+'''
+
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps, loads
+from os import environ
+from threading import Lock
+from time import time
+from typing import Any, Dict, Optional, Text, Tuple
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+from .utils import LOG, DataMetadata
+
+AWS_REGION = environ.get('AWS_REGION', 'us-west-2')
+RESULT_CACHE_MAX_SIZE = int(environ.get('RESULT_CACHE_MAX_SIZE', 1024))
+RESULT_CACHE_URI = environ.get('RESULT_CACHE_URI', '')
+# DynamoDB items are limited to 400 KB
+MAX_DYNAMODB_VALUE_BYTES = 350_000
+
+_shared_uri = urlparse(RESULT_CACHE_URI)
+if _shared_uri.scheme == 'dynamodb':
+    table = boto3.resource('dynamodb', region_name=AWS_REGION).Table(_shared_uri.netloc)
+elif _shared_uri.scheme == 's3':
+    s3 = boto3.client('s3', region_name=AWS_REGION)
+
+# key -> (expires at, result), least recently used first
+_cache: 'OrderedDict[str, Tuple[float, DataMetadata]]' = OrderedDict()
+_cache_lock = Lock()
+
+
+def cache_key(event_path: Text, params: Dict[Text, Any]) -> str:
+    return sha256(
+        dumps([event_path, params], sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def is_error(result: DataMetadata) -> bool:
+    return isinstance(result.data, dict) and 'error' in result.data
+
+
+def _get_local(key: str) -> Optional[DataMetadata]:
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit and hit[0] > time():
+            _cache.move_to_end(key)
+            return hit[1]
+    return None
+
+
+def _put_local(key: str, expires_at: float, result: DataMetadata):
+    with _cache_lock:
+        _cache[key] = (expires_at, result)
+        _cache.move_to_end(key)
+        while len(_cache) > RESULT_CACHE_MAX_SIZE:
+            _cache.popitem(last=False)
+
+
+def _get_shared(key: str) -> Optional[Tuple[float, str]]:
+    if _shared_uri.scheme == 'dynamodb':
+        item = table.get_item(Key={'key': key}).get('Item')
+        return (float(item['ttl']), item['value']) if item else None
+
+    if _shared_uri.scheme == 's3':
+        try:
+            obj = s3.get_object(
+                Bucket=_shared_uri.netloc, Key=_shared_uri.path.lstrip('/') + key
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+        return float(obj['Metadata']['expires-at']), obj['Body'].read().decode()
+
+    return None
+
+
+def _put_shared(key: str, expires_at: float, value: str):
+    if (
+        _shared_uri.scheme == 'dynamodb'
+        and len(value.encode()) <= MAX_DYNAMODB_VALUE_BYTES
+    ):
+        table.put_item(Item={'key': key, 'value': value, 'ttl': int(expires_at)})
+
+    elif _shared_uri.scheme == 's3':
+        s3.put_object(
+            Bucket=_shared_uri.netloc,
+            Key=_shared_uri.path.lstrip('/') + key,
+            Body=value.encode(),
+            ContentType='application/json',
+            Metadata={'expires-at': str(int(expires_at))},
+        )
+
+
+def get(key: str) -> Optional[DataMetadata]:
+    """
+    Returns the cached result for key, or None on a miss.
+    """
+    result = _get_local(key)
+    if result is not None or not _shared_uri.scheme:
+        return result
+
+    try:
+        hit = _get_shared(key)
+    except Exception as e:
+        LOG.debug(f'Reading the shared result cache failed: {e!r}')
+        return None
+
+    if not hit or hit[0] <= time():
+        return None
+
+    result = DataMetadata(*loads(hit[1]))
+    _put_local(key, hit[0], result)
+    return result
+
+
+def put(key: str, result: DataMetadata, ttl_seconds: float):
+    """
+    Caches result for key for ttl_seconds, unless it is an error.
+    """
+    if is_error(result):
+        return
+
+    expires_at = time() + ttl_seconds
+    _put_local(key, expires_at, result)
+    if not _shared_uri.scheme:
+        return
+
+    try:
+        _put_shared(key, expires_at, dumps([result.data, result.metadata]))
+    except TypeError:
+        pass  # e.g. bytes bodies are only cached in the container
+    except Exception as e:
+        LOG.debug(f'Writing the shared result cache failed: {e!r}')
+
+
+def clear():
+    with _cache_lock:
+        _cache.clear()
@@ -4,14 +4,20 @@ import logging
 import os
 import re
 import sys
+import zlib
+from base64 import b64encode
 from codecs import encode
+from functools import lru_cache
 from json import dumps
+from time import monotonic
 from typing import (
     Any,
     Callable,
     Dict,
     Optional,
+    List,
     Text,
+    Tuple,
     TypedDict,
     Union,
     get_type_hints,
@@ -29,6 +35,15 @@ LOG.setLevel(logging.DEBUG)
 
 
 DataMetadata = namedtuple('DataMetadata', ['data', 'metadata'])
+FormatTemplate = namedtuple('FormatTemplate', ['ref', 'segments'])
+
+FORMAT_REF_PATTERN = re.compile(r'{(\d+)}')
+
+# monotonic() time at which the current invocation times out, see set_deadline()
+_deadline: Optional[float] = None
+# monotonic() time by which rows of the current batch must be done, which can be
+# earlier, e.g. for API Gateway requests, see set_row_deadline()
+_row_deadline: Optional[float] = None
 
 
 class ResponseType(TypedDict, total=False):
@@ -44,7 +59,74 @@ class ResponseType(TypedDict, total=False):
     uri: str
 
 
-def pick(pointer: str, data: dict):
+class GzipResponseBuilder:
+    """
+    Builds the gzipped and base64-encoded body of a synchronous response
+    incrementally, serializing and compressing each row as it is added instead
+    of holding the whole serialized body in memory.
+
+    size is the length of the JSON-serialized response. It is exact once finish()
+    is called, and a lower bound before that, as the compressor may still hold
+    up to SYNC_FLUSH_BYTES of input it has not output yet.
+    """
+
+    HEADERS = {'Content-Encoding': 'gzip'}
+    SYNC_FLUSH_BYTES = 64 * 1024
+
+    def __init__(self):
+        # same compression level as gzip.compress(), with a gzip header and trailer
+        self._compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        self._compressed = bytearray(self._compressor.compress(b'{"data": ['))
+        self._rows = 0
+        self._unflushed = 0
+        self._overhead = len(
+            dumps(
+                {
+                    'statusCode': 200,
+                    'body': '',
+                    'isBase64Encoded': True,
+                    'headers': self.HEADERS,
+                }
+            )
+        )
+
+    @property
+    def size(self) -> int:
+        # base64 encodes every started 3 bytes to 4, which JSON does not escape
+        return self._overhead + 4 * ((len(self._compressed) + 2) // 3)
+
+    def add_row(self, row: List[Any]):
+        row_dumps = (', ' if self._rows else '') + dumps(row, default=str)
+        self._compressed += self._compressor.compress(row_dumps.encode())
+        self._rows += 1
+        self._unflushed += len(row_dumps)
+
+        if self._unflushed >= self.SYNC_FLUSH_BYTES:
+            # output what the compressor holds so that size stays close to exact
+            self._compressed += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._unflushed = 0
+
+    def finish(self) -> ResponseType:
+        self._compressed += self._compressor.compress(b']}')
+        self._compressed += self._compressor.flush()
+        return {
+            'statusCode': 200,
+            'body': b64encode(self._compressed).decode(),
+            'isBase64Encoded': True,
+            'headers': dict(self.HEADERS),
+        }
+
+
+@lru_cache(maxsize=256)
+def compile_pointer(pointer: str) -> Tuple[Union[int, str], ...]:
+    """split pointer into the keys and indexes pick looks up, once per pointer
+
+    >>> compile_pointer("items[0].'a.b'")
+    ('items', 0, 'a.b')
+
+    >>> compile_pointer('items[*].id')
+    ('items', '*', 'id')
+    """
     tokens = []
     temp_token = ''
     in_quotes = False
@@ -60,20 +142,47 @@ def pick(pointer: str, data: dict):
 
     tokens.append(temp_token)
 
-    pointer_parts = [
-        t for sub_token in tokens for t in re.split(r"[\[\]']", sub_token) if t
-    ]
+    return tuple(
+        to_index_or_key(t)
+        for sub_token in tokens
+        for t in re.split(r"[\[\]']", sub_token)
+        if t
+    )
+
 
+def pick_compiled(steps: Tuple[Union[int, str], ...], data: Any) -> Any:
     retval = data
-    for p in pointer_parts:
+    for i, step in enumerate(steps):
+        if step == '*':
+            # project the rest of the path over every item, dropping misses
+            if isinstance(retval, dict):
+                items = list(retval.values())
+            elif isinstance(retval, list):
+                items = retval
+            else:
+                return None
+            projection = (pick_compiled(steps[i + 1 :], item) for item in items)
+            return [p for p in projection if p is not None]
+
         try:
-            retval = retval[to_index_or_key(p)]
+            retval = retval[step]
         except (KeyError, IndexError, TypeError):
             return None
 
     return retval
 
 
+def pick(pointer: str, data: dict):
+    """pick the value at pointer in data, or None if it is missing
+
+    [*] projects the rest of the pointer over every item of a list or dict
+
+    >>> pick('items[*].id', {'items': [{'id': 1}, {'name': 'x'}, {'id': 3}]})
+    [1, 3]
+    """
+    return pick_compiled(compile_pointer(pointer), data)
+
+
 def to_index_or_key(token: str) -> Union[int, str]:
     try:
         return int(token) if token.startswith('-') or token.isnumeric() else token
@@ -129,6 +238,80 @@ def parse_header_links(value):
     return links
 
 
+@lru_cache(maxsize=1024)
+def compile_format(s: str) -> FormatTemplate:
+    """compile format string s into a FormatTemplate which format_template renders
+
+    A string starting with a reference, e.g. '{0}', is a whole-value reference
+    and renders to the referenced param itself. Other strings are split into
+    literal segments and int segments referencing params by index.
+
+    >>> compile_format('{0}')
+    FormatTemplate(ref=0, segments=())
+
+    >>> compile_format('{"z": [{0}]}')
+    FormatTemplate(ref=None, segments=('{"z": [', 0, ']}'))
+    """
+    m = FORMAT_REF_PATTERN.match(s)
+    if m:
+        return FormatTemplate(int(m.group(1)), ())
+
+    segments: List[Union[str, int]] = []
+    for i, part in enumerate(FORMAT_REF_PATTERN.split(s)):
+        # split() alternates literal parts and captured indexes, and references
+        # are only replaced when spelled the way str(index) spells them
+        if i % 2 and part == str(int(part)):
+            segments.append(int(part))
+        elif i % 2:
+            segments.append('{' + part + '}')
+        elif part:
+            segments.append(part)
+
+    # merge adjacent literals left over from non-canonical references
+    merged: List[Union[str, int]] = []
+    for segment in segments:
+        if merged and isinstance(segment, str) and isinstance(merged[-1], str):
+            merged[-1] += segment
+        else:
+            merged.append(segment)
+
+    return FormatTemplate(None, tuple(merged))
+
+
+def format_template(
+    template: FormatTemplate, ps: List[Any], serialized: Dict[int, str]
+) -> Any:
+    """render a compiled template with params ps
+
+    serialized memoizes the string form of each param, so that it can be shared
+    between all templates rendered for the same params.
+    """
+    if template.ref is not None:
+        return ps[template.ref]
+
+    parts = []
+    for segment in template.segments:
+        if isinstance(segment, str):
+            parts.append(segment)
+        elif segment >= len(ps):
+            parts.append('{' + str(segment) + '}')
+        else:
+            if segment not in serialized:
+                p = ps[segment]
+                serialized[segment] = (
+                    dumps(p) if isinstance(p, (list, dict)) else str(p)
+                )
+            parts.append(serialized[segment])
+
+    return ''.join(parts)
+
+
+def format_row(templates: Dict[str, FormatTemplate], ps: List[Any]) -> Dict[str, Any]:
+    """render every template in templates with the params ps of a single row"""
+    serialized: Dict[int, str] = {}
+    return {k: format_template(t, ps, serialized) for k, t in templates.items()}
+
+
 def format(s, ps):
     """format string s with params ps, preserving type of singular references
 
@@ -136,17 +319,35 @@ def format(s, ps):
     {'a': 'b'}
 
     >>> format('{"z": [{0}]}', [{'a': 'b'}])
+    '{"z": [{"a": "b"}]}'
     """
+    return format_template(compile_format(s), ps, {})
+
+
+def set_deadline(context: Any):
+    """records when the current invocation times out, if its context tells"""
+    global _deadline, _row_deadline
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    _deadline = monotonic() + get_remaining_time() / 1000 if get_remaining_time else None
+    _row_deadline = None
+
+
+def remaining_seconds() -> Optional[float]:
+    """seconds left before the current invocation times out, None if unknown"""
+    return None if _deadline is None else _deadline - monotonic()
 
-    def replace_refs(s, ps):
-        for i, p in enumerate(ps):
-            old = '{' + str(i) + '}'
-            new = dumps(p) if isinstance(p, (list, dict)) else str(p)
-            s = s.replace(old, new)
-        return s
 
-    m = re.match(r'{(\d+)}', s)
-    return ps[int(m.group(1))] if m else replace_refs(s, ps)
+def set_row_deadline(deadline: Optional[float]):
+    """records the monotonic() time by which rows of the current batch must be done"""
+    global _row_deadline
+    _row_deadline = deadline
+
+
+def row_remaining_seconds() -> Optional[float]:
+    """seconds left for rows of the current batch, None if unknown"""
+    if _row_deadline is None:
+        return remaining_seconds()
+    return _row_deadline - monotonic()
 
 
 def create_response(code: int, msg: Text) -> ResponseType:
@@ -179,27 +380,47 @@ def invoke_process_lambda(event: Any, lambda_name: Text) -> Dict[Text, Any]:
     return lambda_response
 
 
-def cast_parameters(params: Dict[str, Any], func: Callable) -> Dict[str, Any]:
-    type_hints = get_type_hints(func)
-    casted_params = {}
+@lru_cache(maxsize=None)
+def get_cast_plan(func: Callable) -> Tuple[Tuple[str, type], ...]:
+    """
+    Precomputes which parameters of func are cast by cast_parameters, and to what.
 
-    for name, param_type in type_hints.items():
-        value = params.get(name)
+    Args:
+        func (Callable): Function whose type hints describe its parameters.
 
-        if value is None:
-            continue
+    Returns:
+        Tuple[Tuple[str, type], ...]: Pairs of parameter name and type to cast to.
+    """
+    cast_plan = []
 
+    for name, param_type in get_type_hints(func).items():
         origin = get_origin(param_type)
         args = get_args(param_type)
 
         actual_type = args[0] if origin is Union else param_type
 
         if isinstance(actual_type, type):
-            casted_params[name] = actual_type(value)
+            cast_plan.append((name, actual_type))
+
+    return tuple(cast_plan)
+
+
+def apply_cast_plan(
+    params: Dict[str, Any], cast_plan: Tuple[Tuple[str, type], ...]
+) -> Dict[str, Any]:
+    casted_params = {
+        name: actual_type(params[name])
+        for name, actual_type in cast_plan
+        if params.get(name) is not None
+    }
 
     return {**params, **casted_params}
 
 
+def cast_parameters(params: Dict[str, Any], func: Callable) -> Dict[str, Any]:
+    return apply_cast_plan(params, get_cast_plan(func))
+
+
 def add_param_to_url(url, param_name, param_value):
     parsed_url = urlparse(url)
     query_dict = (
@@ -1,6 +1,9 @@
+from collections import OrderedDict
 from os import environ
 from base64 import b64decode, b64encode
-from typing import Optional
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, Optional, Tuple
 
 import boto3
 from botocore.exceptions import ClientError, HTTPClientError
@@ -9,55 +12,132 @@ from botocore.exceptions import ClientError, HTTPClientError
 AWS_REGION = environ.get('AWS_REGION', 'us-west-2')
 KMS_KEY = environ.get('AWS_REGION', 'us-west-2')
 ENABLED = bool(KMS_KEY)
+SECRET_CACHE_TTL_SECONDS = float(environ.get('SECRET_CACHE_TTL_SECONDS', 300))
+SECRET_CACHE_MAX_SIZE = int(environ.get('SECRET_CACHE_MAX_SIZE', 256))
+SECRETSMANAGER_ARN_PREFIXES = (
+    'arn:aws:secretsmanager:',
+    'arn:aws-us-gov:secretsmanager:',
+    'arn:aws-cn:secretsmanager:',
+)
 
 kms = boto3.client('kms', region_name=AWS_REGION)
 secretsmanager = boto3.client('secretsmanager', region_name=AWS_REGION)
 
 
+# ARN or ciphertext -> (expires at, plaintext), least recently used first
+_cache: 'OrderedDict[str, Tuple[float, Optional[str]]]' = OrderedDict()
+_cache_lock = Lock()
+_inflight: Dict[str, Lock] = {}
+
+
+def _cached(ct: str, decrypt: Callable[[], Optional[str]]) -> Optional[str]:
+    """
+    Returns the cached plaintext for ct, calling decrypt() on a miss. Concurrent
+    misses for the same ct wait for a single call to decrypt().
+    """
+    with _cache_lock:
+        hit = _cache.get(ct)
+        if hit and hit[0] > monotonic():
+            _cache.move_to_end(ct)
+            return hit[1]
+        ct_lock = _inflight.setdefault(ct, Lock())
+
+    with ct_lock:
+        with _cache_lock:
+            hit = _cache.get(ct)
+            if hit and hit[0] > monotonic():
+                return hit[1]
+
+        try:
+            plaintext = decrypt()
+        except BaseException:
+            with _cache_lock:
+                _release_inflight(ct, ct_lock)
+            raise
+
+        # the plaintext is cached before the lock is released, so that callers
+        # arriving in between find it rather than decrypting again
+        with _cache_lock:
+            _cache[ct] = (monotonic() + SECRET_CACHE_TTL_SECONDS, plaintext)
+            _cache.move_to_end(ct)
+            while len(_cache) > SECRET_CACHE_MAX_SIZE:
+                _cache.popitem(last=False)
+            _release_inflight(ct, ct_lock)
+
+    return plaintext
+
+
+def _release_inflight(ct: str, ct_lock: Lock):
+    """forgets ct_lock, unless a later miss for ct already replaced it"""
+    if _inflight.get(ct) is ct_lock:
+        del _inflight[ct]
+
+
+def invalidate(*cts: Optional[str]):
+    """
+    Drops the cached plaintexts of cts, e.g. after a secret was rejected by the
+    service it authenticates to and may have been rotated.
+    """
+    with _cache_lock:
+        for ct in cts:
+            if ct is not None:
+                _cache.pop(ct, None)
+
+
+def _kms_decrypt(ct: str) -> str:
+    try:
+        ctBlob = b64decode(ct)
+    except Exception:
+        ctBlob = ct.encode()
+
+    res = None  # retry on incomplete response
+    while res is None or 'Plaintext' not in res:
+        n = 10
+        try:
+            res = kms.decrypt(CiphertextBlob=ctBlob)
+        except HTTPClientError:
+            # An HTTP Client raised and unhandled exception:
+            # [(
+            #     'SSL routines',
+            #     'ssl3_get_record',
+            #     'decryption failed or bad record mac',
+            # )]
+            # fixed by waiting
+            import time
+
+            time.sleep(0.1)
+            n -= 1
+            if n == 0:
+                raise
+
+    return res['Plaintext'].decode()
+
+
 def decrypt_if_encrypted(
     ct: Optional[str] = None, envar: Optional[str] = None
 ) -> Optional[str]:
+    """
+    Resolves Secrets Manager ARNs and KMS ciphertexts to their plaintext, and
+    returns any other value as is. Plaintexts are cached in memory for
+    SECRET_CACHE_TTL_SECONDS, so rows share a single call per secret.
+    """
     if envar:
         ct = environ.get(envar)
 
-    if ct and (
-        ct.startswith('arn:aws:secretsmanager:')
-        or ct.startswith('arn:aws-us-gov:secretsmanager:')
-        or ct.startswith('arn:aws-cn:secretsmanager:')
-    ):
-        return secretsmanager.get_secret_value(SecretId=ct).get('SecretString')
+    if ct and ct.startswith(SECRETSMANAGER_ARN_PREFIXES):
+        arn = ct
+        return _cached(
+            arn,
+            lambda: secretsmanager.get_secret_value(SecretId=arn).get('SecretString'),
+        )
 
     # 1-byte plaintext has 205-byte ct
     if not ct or len(ct) < 205 or not ct.startswith('AQICAH'):
         return ct
 
     try:
-        ctBlob = b64decode(ct)
-    except Exception:
-        ctBlob = ct.encode()
-
-    try:
-        res = None  # retry on incomplete response
-        while res is None or 'Plaintext' not in res:
-            n = 10
-            try:
-                res = kms.decrypt(CiphertextBlob=ctBlob)
-            except HTTPClientError:
-                # An HTTP Client raised and unhandled exception:
-                # [(
-                #     'SSL routines',
-                #     'ssl3_get_record',
-                #     'decryption failed or bad record mac',
-                # )]
-                # fixed by waiting
-                import time
-
-                time.sleep(0.1)
-                n -= 1
-                if n == 0:
-                    raise
-
-        return res['Plaintext'].decode()
+        blob = ct
+        return _cached(blob, lambda: _kms_decrypt(blob))
 
     except ClientError:
         raise
@@ -0,0 +1,115 @@
+from time import time
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+from utils import Mock, patch
+
+from lambda_src.batch_locking_backends import dynamodb
+
+RESPONSE = {'statusCode': 200, 'body': '{"data": [[0, 1]]}'}
+
+
+@patch('lambda_src.batch_locking_backends.dynamodb.sleep')
+@patch('lambda_src.batch_locking_backends.dynamodb.table', create=True)
+def test_wait_for_batch_response_backs_off(mock_table, mock_sleep):
+    mock_table.get_item.side_effect = [
+        {'Item': {'batch_id': 'b', 'locked': True}},
+        {'Item': {'batch_id': 'b', 'locked': True}},
+        {'Item': {'batch_id': 'b', 'locked': False, 'response': RESPONSE}},
+    ]
+
+    assert dynamodb.wait_for_batch_response('b', 30) == RESPONSE
+    assert mock_table.get_item.call_count == 3
+    assert all(c[1]['ConsistentRead'] for c in mock_table.get_item.call_args_list)
+
+    first_sleep, second_sleep = (c[0][0] for c in mock_sleep.call_args_list)
+    assert 0.05 <= first_sleep <= 0.1
+    assert 0.1 <= second_sleep <= 0.2
+
+
+@patch('lambda_src.batch_locking_backends.dynamodb.table', create=True)
+def test_wait_for_batch_response_times_out(mock_table):
+    mock_table.get_item.return_value = {'Item': {'batch_id': 'b', 'locked': True}}
+
+    assert dynamodb.wait_for_batch_response('b', 0.3) is None
+    assert 2 <= mock_table.get_item.call_count <= 4
+
+
+@patch('lambda_src.batch_locking_backends.dynamodb.table', create=True)
+def test_claim_batch(mock_table):
+    mock_table.update_item.return_value = {'Attributes': {'checkpoints': 2}}
+    assert dynamodb.claim_batch('b', 60) == (True, 2)
+
+    mock_table.update_item.side_effect = ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem'
+    )
+    assert dynamodb.claim_batch('b', 60) == (False, 0)
+
+
+@patch('lambda_src.batch_locking_backends.dynamodb.CHECKPOINT_INTERVAL_SECONDS', 0)
+@patch('lambda_src.batch_locking_backends.dynamodb.table', create=True)
+def test_checkpoints_round_trip(mock_table):
+    items = {}
+    mock_table.update_item.side_effect = [
+        {'Attributes': {'checkpoints': 1}},
+        {'Attributes': {'checkpoints': 2}},
+    ]
+    mock_table.put_item.side_effect = lambda Item: items.update(
+        {Item['batch_id']: Item}
+    )
+    mock_table.get_item.side_effect = lambda Key, ConsistentRead: (
+        {'Item': items[Key['batch_id']]} if Key['batch_id'] in items else {}
+    )
+
+    checkpoint = dynamodb.BatchCheckpoint('b')
+    checkpoint.add([0, {'a': 1}])
+    checkpoint.add([2, 'c'])
+
+    assert set(items) == {'b#checkpoint#1', 'b#checkpoint#2'}
+    # the third chunk was counted but never written
+    assert dynamodb.get_checkpoints('b', 3) == {0: {'a': 1}, 2: 'c'}
+
+
+@patch('lambda_src.batch_locking_backends.dynamodb.MAX_ITEM_BYTES', 10)
+@patch(
+    'lambda_src.batch_locking_backends.dynamodb.OVERFLOW_S3_URI',
+    urlparse('s3://bucket/geff/'),
+)
+@patch('lambda_src.batch_locking_backends.dynamodb.s3', create=True)
+@patch('lambda_src.batch_locking_backends.dynamodb.table', create=True)
+def test_large_responses_overflow_to_s3(mock_table, mock_s3):
+    dynamodb.finish_batch_processing('b', RESPONSE, [[0, 1]])
+
+    item = mock_table.put_item.call_args[1]['Item']
+    body = mock_s3.put_object.call_args[1]['Body']
+    assert 'response' not in item
+    assert item['ttl'] > time()
+    assert item['response_s3_key'] == 'geff/b/response.json'
+    assert item['response_size'] == len(body)
+
+    mock_table.get_item.return_value = {'Item': item}
+    mock_s3.get_object.return_value = {'Body': Mock(read=Mock(return_value=body))}
+    assert dynamodb.get_response_for_batch('b') == RESPONSE
+    mock_s3.get_object.assert_called_once_with(
+        Bucket='bucket', Key='geff/b/response.json'
+    )
+
+
+@patch(
+    'lambda_src.batch_locking_backends.dynamodb.OVERFLOW_S3_URI',
+    urlparse('s3://bucket/geff/'),
+)
+@patch('lambda_src.batch_locking_backends.dynamodb.s3', create=True)
+@patch('lambda_src.batch_locking_backends.dynamodb.table', create=True)
+def test_unreadable_overflow_objects_are_ignored(mock_table, mock_s3):
+    mock_s3.get_object.side_effect = ClientError(
+        {'Error': {'Code': 'NoSuchKey'}}, 'GetObject'
+    )
+    mock_table.get_item.side_effect = lambda Key, ConsistentRead: {
+        'b': {'Item': {'batch_id': 'b', 'locked': False, 'response_s3_key': 'k'}},
+        'b#checkpoint#1': {'Item': {'batch_id': 'b#checkpoint#1', 's3_key': 'k'}},
+        'b#checkpoint#2': {'Item': {'batch_id': 'b#checkpoint#2', 'rows': '[[1, 2]]'}},
+    }[Key['batch_id']]
+
+    assert dynamodb.wait_for_batch_response('b', 1) is None
+    assert dynamodb.get_checkpoints('b', 2) == {1: 2}
@@ -0,0 +1,92 @@
+import http.client
+from email.message import EmailMessage
+from unittest.mock import Mock
+from urllib import request
+from urllib.error import URLError
+
+from pytest import raises
+
+from utils import patch
+
+from lambda_src.connection_pool import ConnectionPool, KeepAliveHTTPSHandler
+
+
+def fake_connection(*responses):
+    conn = Mock()
+    conn.getresponse.side_effect = [
+        r if isinstance(r, Exception) else fake_response(r) for r in responses
+    ]
+    return conn
+
+
+def fake_response(body: bytes):
+    res = Mock()
+    res.read.return_value = body
+    res.will_close = False
+    res.status = 200
+    res.reason = 'OK'
+    res.msg = EmailMessage()
+    res.msg['Content-Type'] = 'application/json'
+    return res
+
+
+def test_connections_are_reused_across_requests():
+    conn = fake_connection(b'1', b'2')
+    opener = request.build_opener(KeepAliveHTTPSHandler(ConnectionPool(4, 30)))
+
+    with patch('http.client.HTTPSConnection', return_value=conn) as new_connection:
+        first = opener.open('https://api.eg.com/items?p=1')
+        second = opener.open('https://api.eg.com/items?p=2')
+
+    assert new_connection.call_count == 1
+    assert (first.read(), second.read()) == (b'1', b'2')
+    assert first.headers['Content-Type'] == 'application/json'
+    assert conn.request.call_args_list[1][0][:2] == ('GET', '/items?p=2')
+
+
+def test_stale_connections_are_replaced():
+    stale = fake_connection(b'1', http.client.RemoteDisconnected())
+    fresh = fake_connection(b'2')
+    opener = request.build_opener(KeepAliveHTTPSHandler(ConnectionPool(4, 30)))
+
+    with patch('http.client.HTTPSConnection', side_effect=[stale, fresh]):
+        opener.open('https://api.eg.com/items')
+        response = opener.open('https://api.eg.com/items')
+
+    assert response.read() == b'2'
+    stale.close.assert_called_once()
+
+
+def test_idle_connections_are_evicted():
+    conn = fake_connection(b'1', b'2')
+    opener = request.build_opener(KeepAliveHTTPSHandler(ConnectionPool(4, 0)))
+
+    with patch('http.client.HTTPSConnection', return_value=conn) as new_connection:
+        opener.open('https://api.eg.com/items')
+        opener.open('https://api.eg.com/items')
+
+    assert new_connection.call_count == 2
+
+
+def test_non_idempotent_requests_are_not_resent():
+    stale = fake_connection(b'1', http.client.RemoteDisconnected())
+    opener = request.build_opener(KeepAliveHTTPSHandler(ConnectionPool(4, 30)))
+
+    with patch('http.client.HTTPSConnection', side_effect=[stale]) as new_connection:
+        opener.open('https://api.eg.com/items')
+        with raises(URLError):
+            opener.open('https://api.eg.com/items', data=b'{}')
+
+    assert new_connection.call_count == 1
+
+
+def test_reused_connections_take_the_request_timeout():
+    conn = fake_connection(b'1', b'2')
+    opener = request.build_opener(KeepAliveHTTPSHandler(ConnectionPool(4, 30)))
+
+    with patch('http.client.HTTPSConnection', return_value=conn):
+        opener.open('https://api.eg.com/items', timeout=10)
+        opener.open('https://api.eg.com/items', timeout=2)
+
+    assert conn.timeout == 2
+    conn.sock.settimeout.assert_called_with(2)
@@ -0,0 +1,150 @@
+from hashlib import sha256
+from time import sleep
+
+from pytest import raises
+
+from utils import patch
+
+from lambda_src.drivers import destination_s3
+from lambda_src.utils import DataMetadata
+
+
+def slow_write_to_s3(bucket, filename, content):
+    sleep(0.05)
+    if filename.endswith('_row_1.data.json'):
+        raise ValueError('upload failed')
+    return {'ETag': filename}
+
+
+@patch('lambda_src.drivers.destination_s3.write_to_s3')
+def test_finalize_waits_for_row_writes(mock_write_to_s3):
+    mock_write_to_s3.side_effect = slow_write_to_s3
+    destination = 's3://bucket/prefix/'
+
+    res_data = [
+        [n, destination_s3.write(destination, 'b1', DataMetadata([n], None), n)]
+        for n in range(3)
+    ]
+    assert all(row_result['response'] is None for _, row_result in res_data)
+
+    destination_s3.finalize(destination, 'b1', res_data)
+
+    assert res_data[0][1]['response'] == {'ETag': 'prefix/b1_row_0.data.json'}
+    assert res_data[1][1][0]['error'] == "ValueError('upload failed')"
+    assert res_data[2][1]['uri'] == 's3://bucket/prefix/b1_row_2.data.json'
+    assert mock_write_to_s3.call_args_list[-1][0][:2] == (
+        'bucket',
+        'meta/b1_MANIFEST.json',
+    )
+
+
+@patch('lambda_src.drivers.destination_s3.write_to_s3')
+def test_completed_writes_are_not_kept_pending(mock_write_to_s3):
+    mock_write_to_s3.side_effect = slow_write_to_s3
+    destination = 's3://bucket/prefix/'
+
+    res_data = [
+        [n, destination_s3.write(destination, 'b4', DataMetadata([n], None), n)]
+        for n in range(2)
+    ]
+    sleep(0.2)  # the uploads complete before the batch is finalized
+    assert 'b4' not in destination_s3._pending_writes
+
+    destination_s3.finalize(destination, 'b4', res_data)
+    assert res_data[0][1]['response'] == {'ETag': 'prefix/b4_row_0.data.json'}
+    assert res_data[1][1][0]['error'] == "ValueError('upload failed')"
+
+
+@patch('lambda_src.drivers.destination_s3.write_to_s3')
+def test_coalesced_rows_are_written_to_part_files(mock_write_to_s3):
+    mock_write_to_s3.return_value = {'ETag': 'etag'}
+    destination = 's3://bucket/prefix/?coalesce=true&part_size=16'
+
+    res_data = [
+        [n, destination_s3.write(destination, 'b2', DataMetadata(data, None), n)]
+        for n, data in enumerate([{'a': 1}, {'b': 2}, {'c': 3}])
+    ]
+    destination_s3.finalize(destination, 'b2', res_data)
+
+    parts = {c[0][1]: c[0][2] for c in mock_write_to_s3.call_args_list[:-1]}
+    assert parts == {
+        'prefix/b2_part_0.ndjson': b'{"a": 1}\n',
+        'prefix/b2_part_1.ndjson': b'{"b": 2}\n',
+        'prefix/b2_part_2.ndjson': b'{"c": 3}\n',
+    }
+    for _, entry in res_data:
+        part = parts[entry['uri'].replace('s3://bucket/', '')]
+        row = part[entry['offset'] : entry['offset'] + entry['length']]
+        assert sha256(row).hexdigest() == entry['sha256']
+        assert entry['response'] == {'ETag': 'etag'}
+
+
+@patch('lambda_src.drivers.destination_s3.write_to_s3')
+def test_coalesced_rows_share_part_files(mock_write_to_s3):
+    mock_write_to_s3.return_value = {'ETag': 'etag'}
+    destination = 's3://bucket/prefix/?coalesce=true'
+
+    res_data = [
+        [n, destination_s3.write(destination, 'b3', DataMetadata([n, n], None), n)]
+        for n in range(3)
+    ]
+    destination_s3.finalize(destination, 'b3', res_data)
+
+    assert mock_write_to_s3.call_count == 2
+    assert mock_write_to_s3.call_args_list[0][0][2] == b'0\n0\n1\n1\n2\n2\n'
+    assert [(e['offset'], e['length']) for _, e in res_data] == [(0, 3), (4, 3), (8, 3)]
+
+
+@patch('lambda_src.drivers.destination_s3.write_to_s3')
+def test_rows_written_after_finalize_are_ignored(mock_write_to_s3):
+    destination = 's3://bucket/prefix/?coalesce=true'
+    destination_s3.finalize(destination, 'b4', [])
+
+    with raises(RuntimeError):
+        destination_s3.write(destination, 'b4', DataMetadata([1], None), 0)
+
+    assert mock_write_to_s3.call_count == 1  # the manifest
+    assert 'b4' not in destination_s3._part_buffers
+
+    # initializing a retry leaves the mark, its rows may be processed elsewhere
+    destination_s3.initialize('s3://bucket/prefix/', 'b4')
+    with raises(RuntimeError):
+        destination_s3.write(destination, 'b4', DataMetadata([1], None), 0)
+
+    # a retry processed in this container writes its rows again
+    destination_s3.start_batch(destination, 'b4')
+    destination_s3.write(destination, 'b4', DataMetadata([1], None), 0)
+    destination_s3.flush_parts(destination, 'b4')
+
+
+@patch('lambda_src.drivers.destination_s3.write_to_s3')
+def test_abandoned_part_buffers_are_dropped(mock_write_to_s3):
+    destination = 's3://bucket/prefix/?coalesce=true'
+    destination_s3.write(destination, 'b6', DataMetadata([1], None), 0)
+    destination_s3.write(destination, 'b7', DataMetadata([1], None), 0)
+    destination_s3._part_buffers['b7'].last_written -= 1000
+
+    # a retry of b6 and a new batch start in this container
+    destination_s3.start_batch(destination, 'b6')
+    destination_s3.start_batch(destination, 'b8')
+
+    assert 'b6' not in destination_s3._part_buffers
+    assert 'b7' not in destination_s3._part_buffers
+    mock_write_to_s3.assert_not_called()
+
+
+@patch('lambda_src.drivers.destination_s3.write_to_s3')
+def test_coalesced_rows_need_distinct_part_names(mock_write_to_s3):
+    with raises(ValueError):
+        destination_s3.write(
+            's3://bucket/{batch_id}.ndjson?coalesce=true',
+            'b9',
+            DataMetadata([1], None),
+            0,
+        )
+
+    destination = 's3://bucket/{batch_id}_{row_index}.ndjson?coalesce=true'
+    mock_write_to_s3.return_value = {}
+    row_result = destination_s3.write(destination, 'b9', DataMetadata([1], None), 0)
+    destination_s3.finalize(destination, 'b9', [[0, row_result]])
+    assert mock_write_to_s3.call_args_list[0][0][:2] == ('bucket', 'b9_part_0.ndjson')
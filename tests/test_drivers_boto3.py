@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta, timezone
+
+from utils import Mock, patch
+
+from lambda_src.drivers import process_boto3
+
+
+def credentials(n: int, expires_in: timedelta) -> dict:
+    return {
+        'Credentials': {
+            'AccessKeyId': f'AKIA{n}',
+            'SecretAccessKey': 'secret',
+            'SessionToken': 'token',
+            'Expiration': datetime.now(timezone.utc) + expires_in,
+        }
+    }
+
+
+@patch('lambda_src.drivers.process_boto3.boto3.client')
+def test_process_row_reuses_credentials_and_clients(mock_client):
+    process_boto3.CREDENTIALS.clear()
+    process_boto3.CLIENTS.clear()
+    sts = Mock()
+    sts.assume_role.side_effect = [
+        credentials(1, timedelta(hours=1)),
+        credentials(2, timedelta(hours=1)),
+    ]
+    ec2 = Mock()
+    ec2.describe_regions.return_value = {'Regions': [{'RegionName': 'us-west-2'}]}
+    mock_client.side_effect = lambda name, *args, **kwargs: (
+        sts if name == 'sts' else ec2
+    )
+
+    for _ in range(3):
+        result = process_boto3.process_row(
+            'ec2',
+            'describe_regions',
+            assume_role_chain_params='["arn:aws:iam::1:role/a", "arn:aws:iam::2:role/b"]',
+            results_path='Regions',
+        )
+
+    assert result == [{'RegionName': 'us-west-2'}]
+    assert sts.assume_role.call_count == 2
+    assert ec2.describe_regions.call_count == 3
+    assert [c[0][0] for c in mock_client.call_args_list] == ['sts', 'sts', 'ec2']
+
+
+@patch('lambda_src.drivers.process_boto3.boto3.client')
+def test_process_row_refreshes_expiring_credentials(mock_client):
+    process_boto3.CREDENTIALS.clear()
+    process_boto3.CLIENTS.clear()
+    mock_client.return_value.assume_role.side_effect = [
+        credentials(1, timedelta(minutes=1)),
+        credentials(2, timedelta(hours=1)),
+    ]
+
+    for _ in range(2):
+        process_boto3.process_row(
+            's3',
+            'list_buckets',
+            assume_role_chain_params='["arn:aws:iam::1:role/a"]',
+        )
+
+    assert mock_client.return_value.assume_role.call_count == 2
+    assert ('s3', 'us-west-2', 'AKIA1') not in process_boto3.CLIENTS
+    assert ('s3', 'us-west-2', 'AKIA2') in process_boto3.CLIENTS
+
+
+@patch('lambda_src.drivers.process_boto3.boto3.client')
+def test_process_row_forgets_intermediate_clients(mock_client):
+    process_boto3.CREDENTIALS.clear()
+    process_boto3.CLIENTS.clear()
+    mock_client.return_value.assume_role.side_effect = [
+        credentials(1, timedelta(minutes=1)),
+        credentials(2, timedelta(minutes=1)),
+        credentials(3, timedelta(hours=1)),
+        credentials(4, timedelta(hours=1)),
+    ]
+
+    for _ in range(2):
+        process_boto3.process_row(
+            's3',
+            'list_buckets',
+            assume_role_chain_params='["arn:aws:iam::1:role/a", "arn:aws:iam::2:role/b"]',
+        )
+
+    assert set(process_boto3.CLIENTS) == {
+        ('sts', None, None),
+        ('s3', 'us-west-2', 'AKIA4'),
+    }
+
+
+def test_secret_reads_are_not_read_only():
+    assert process_boto3.is_read_only('ec2', 'describe_regions')
+    assert not process_boto3.is_read_only('ssm', 'get_parameter')
+    assert not process_boto3.is_read_only('ecr', 'get_authorization_token')
+    assert not process_boto3.is_read_only('sts', 'get_caller_identity')
+    assert not process_boto3.is_read_only('ec2', 'terminate_instances')
+    assert process_boto3.is_idempotent('ssm', 'get_parameter')
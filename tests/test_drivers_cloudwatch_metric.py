@@ -0,0 +1,95 @@
+from botocore.exceptions import ClientError
+
+from utils import patch, Mock
+
+from lambda_src.drivers import process_cloudwatch_metric
+from lambda_src.drivers.process_cloudwatch_metric import process_rows
+
+
+def row(value, name='latency', dimensions=None, namespace='geff', **kwargs):
+    return {
+        'namespace': namespace,
+        'name': name,
+        'dimensions': dimensions or [{'Name': 'host', 'Value': 'a'}],
+        'value': value,
+        'timestamp': '2024-01-01T00:00:00Z',
+        **kwargs,
+    }
+
+
+def test_process_rows_merges_matching_datums():
+    client = Mock()
+    rows = [row(1), row(2), row(1), row(5, dimensions=[{'Name': 'host', 'Value': 'b'}])]
+
+    with patch.object(process_cloudwatch_metric, 'get_client', return_value=client):
+        assert process_rows(rows) == [None] * 4
+
+    client.put_metric_data.assert_called_once()
+    metric_data = client.put_metric_data.call_args[1]['MetricData']
+    assert [(d['Values'], d['Counts']) for d in metric_data] == [
+        ([1.0, 2.0], [2.0, 1.0]),
+        ([5.0], [1.0]),
+    ]
+
+
+def test_process_rows_splits_requests_and_maps_errors_to_rows():
+    client = Mock()
+    client.put_metric_data.side_effect = [None, ValueError('throttled')]
+    rows = [row(1, name=f'm{i}') for i in range(3)] + [row('x')]
+
+    with patch.object(process_cloudwatch_metric, 'get_client', return_value=client):
+        with patch.object(process_cloudwatch_metric, 'MAX_DATUMS_PER_REQUEST', 2):
+            results = process_rows(rows)
+
+    assert client.put_metric_data.call_count == 2
+    assert results[:2] == [None, None]
+    assert repr(results[2]) == "ValueError('throttled')"
+    assert isinstance(results[3], ValueError)
+
+
+def test_process_rows_groups_by_region_and_namespace():
+    clients = {'us-west-2': Mock(), 'eu-west-1': Mock()}
+    rows = [row(1), row(1, namespace='other'), row(1, region='eu-west-1')]
+
+    with patch.object(process_cloudwatch_metric, 'get_client', side_effect=clients.get):
+        process_rows(rows)
+
+    assert [
+        c[1]['Namespace'] for c in clients['us-west-2'].put_metric_data.call_args_list
+    ] == ['geff', 'other']
+    clients['eu-west-1'].put_metric_data.assert_called_once()
+
+
+def test_process_rows_isolates_invalid_datums():
+    def put_metric_data(Namespace, MetricData):
+        if any(d['Unit'] == 'Bad' for d in MetricData):
+            raise ClientError(
+                {'Error': {'Code': 'InvalidParameterValue', 'Message': 'unit'}},
+                'PutMetricData',
+            )
+
+    client = Mock()
+    client.put_metric_data.side_effect = put_metric_data
+    rows = [row(1, name=f'm{i}') for i in range(5)] + [row(1, unit='Bad')]
+    rows.append(row(float('nan')))
+
+    with patch.object(process_cloudwatch_metric, 'get_client', return_value=client):
+        results = process_rows(rows)
+
+    assert results[:5] == [None] * 5
+    assert isinstance(results[5], ClientError)
+    assert isinstance(results[6], ValueError)
+
+
+def test_process_rows_splits_requests_by_size():
+    client = Mock()
+    rows = [row(v, name=f'm{i}') for i in range(4) for v in range(150)]
+
+    with patch.object(process_cloudwatch_metric, 'get_client', return_value=client):
+        with patch.object(process_cloudwatch_metric, 'MAX_REQUEST_BYTES', 40_000):
+            assert process_rows(rows) == [None] * len(rows)
+
+    # each datum has 150 values and counts, of about 15 KB query-encoded
+    assert [
+        len(c[1]['MetricData']) for c in client.put_metric_data.call_args_list
+    ] == [2, 2]
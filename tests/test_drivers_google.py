@@ -0,0 +1,128 @@
+from utils import patch, Mock, fixture
+
+from google.auth.exceptions import RefreshError
+from pytest import raises
+
+from lambda_src.drivers import process_google
+from lambda_src.drivers.process_google import process_row, SERVICES
+
+
+@fixture(autouse=True)
+def empty_cache():
+    SERVICES.clear()
+    yield
+    SERVICES.clear()
+
+
+def get_user(user_key, subject='admin@eg.com'):
+    return process_row(
+        'admin',
+        'directory_v1',
+        'users',
+        'get',
+        f'{{"userKey": "{user_key}"}}',
+        service_account_info='{}',
+        subject=subject,
+        scopes='["scope"]',
+    )
+
+
+def test_services_are_built_once_per_credentials():
+    service = Mock()
+    service.users().get().execute.side_effect = lambda http: {'ok': True}
+
+    creds = Mock()
+    with patch.object(process_google, 'build_credentials', return_value=creds) as bc:
+        with patch.object(process_google, 'build', return_value=service) as build:
+            assert get_user('a') == {'ok': True}
+            assert get_user('b') == {'ok': True}
+            get_user('c', subject='other@eg.com')
+
+    assert bc.call_count == 2
+    assert build.call_count == 2
+    assert build.call_args[1]['static_discovery'] is True
+    service.users().get.assert_any_call(userKey='b')
+
+
+def test_services_are_evicted_beyond_the_max_size():
+    service = Mock()
+    service.users().get().execute.side_effect = lambda http: {'ok': True}
+
+    with patch.object(process_google, 'SERVICE_CACHE_MAX_SIZE', 2):
+        with patch.object(process_google, 'build_credentials', return_value=Mock()):
+            with patch.object(process_google, 'build', return_value=service) as build:
+                get_user('a', subject='1@eg.com')
+                get_user('a', subject='2@eg.com')
+                get_user('a', subject='1@eg.com')
+                get_user('a', subject='3@eg.com')
+                get_user('a', subject='1@eg.com')
+
+    assert build.call_count == 3
+    assert [key[3] for key in SERVICES] == ['3@eg.com', '1@eg.com']
+
+
+def test_refresh_errors_forget_the_service():
+    service = Mock()
+    service.users().get().execute.side_effect = RefreshError()
+
+    with patch.object(process_google, 'build_credentials', return_value=Mock()):
+        with patch.object(process_google, 'build', return_value=service):
+            with patch.object(process_google, 'invalidate') as invalidate:
+                with raises(RefreshError):
+                    get_user('a')
+
+    assert SERVICES == {}
+    invalidate.assert_called_once_with('{}', None)
+
+
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self, http):
+        for request_id, request in self.requests:
+            if request == 'missing':
+                self.callback(request_id, None, ValueError(request))
+            else:
+                self.callback(request_id, {'user': request}, None)
+
+
+def test_process_rows_sends_batch_requests():
+    batches = []
+
+    def new_batch_http_request(callback):
+        batches.append(FakeBatch(callback))
+        return batches[-1]
+
+    service = Mock()
+    service.new_batch_http_request = new_batch_http_request
+    service.users().get.side_effect = lambda userKey: userKey
+    rows = [
+        {
+            'service_name': 'admin',
+            'service_version': 'directory_v1',
+            'resource_name': 'users',
+            'method': 'get',
+            'params': f'{{"userKey": "{user_key}"}}',
+            'service_account_info': '{}',
+            'scopes': '["scope"]',
+        }
+        for user_key in ['a', 'missing', 'b', 'c']
+    ]
+    rows[3]['resource_name'] = 'unknown'
+    service.unknown.side_effect = AttributeError('unknown')
+
+    with patch.object(process_google, 'build_credentials', return_value=Mock()):
+        with patch.object(process_google, 'build', return_value=service):
+            with patch.object(process_google, 'MAX_BATCH_SIZE', 2):
+                results = process_google.process_rows(rows)
+
+    assert [len(batch.requests) for batch in batches] == [2, 1]
+    assert results[0] == {'user': 'a'}
+    assert repr(results[1]) == "ValueError('missing')"
+    assert results[2] == {'user': 'b'}
+    assert isinstance(results[3], AttributeError)
@@ -0,0 +1,152 @@
+from utils import patch, fixture
+
+from asyncio import run
+from time import monotonic
+from types import ModuleType
+
+from pytest import raises
+
+from lambda_src.drivers.process_https import process_row_async
+from lambda_src.lambda_function import process_batch, resolve_driver
+
+
+class FakeResponse:
+    def __init__(self, body: bytes, status: int = 200, headers: dict = None):
+        self.status = status
+        self.reason = 'OK' if status < 400 else 'Error'
+        self.headers = headers or {'Content-Type': 'application/json'}
+        self.body = body
+
+    async def read(self):
+        return self.body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, headers, data):
+        self.requests.append((method, str(url), headers, data))
+        return self.responses.pop(0)
+
+
+@fixture(autouse=True)
+def clear_driver_cache():
+    resolve_driver.cache_clear()
+    yield
+    resolve_driver.cache_clear()
+
+
+def test_process_row_async():
+    session = FakeSession(FakeResponse(b'{"id": 1}'))
+    with patch('lambda_src.drivers.process_https.get_session', return_value=session):
+        result = run(process_row_async(url='https://api.eg.com/items/1'))
+
+    assert result == {'id': 1}
+    assert session.requests[0][:2] == ('GET', 'https://api.eg.com/items/1')
+
+
+def test_process_row_async_sends_data_like_urllib():
+    session = FakeSession(FakeResponse(b'{"id": 1}'))
+    with patch('lambda_src.drivers.process_https.get_session', return_value=session):
+        run(process_row_async(url='https://api.eg.com/items', method='post', data='a=1'))
+
+    _, _, headers, data = session.requests[0]
+    assert data == b'a=1'
+    assert headers['Content-type'] == 'application/x-www-form-urlencoded'
+
+
+def test_process_row_async_pagination_cursor():
+    session = FakeSession(
+        FakeResponse(b'{"items": [4], "next": "1"}'),
+        FakeResponse(b'{"items": [2], "next": "2"}'),
+    )
+    with patch('lambda_src.drivers.process_https.get_session', return_value=session):
+        result = run(
+            process_row_async(
+                base_url='https://api.eg.com',
+                url='/items',
+                page_limit=2,
+                cursor='{"path":"next", "body":"from"}',
+                results_path='items',
+                method='POST',
+                json='{}',
+            )
+        )
+
+    assert result == [4, 2]
+    assert [data for _, _, _, data in session.requests] == [b'{}', b'{"from": "1"}']
+
+
+def test_process_row_async_http_error():
+    session = FakeSession(
+        FakeResponse(b'not found', status=404, headers={'Content-Type': 'text/plain'})
+    )
+    with patch('lambda_src.drivers.process_https.get_session', return_value=session):
+        result = run(process_row_async(url='https://api.eg.com/items/1'))
+
+    assert result['error'] == 'HTTPError'
+    assert result['status'] == 404
+    assert result['body'] == 'not found'
+
+
+def test_process_batch_uses_process_row_async():
+    calls = []
+
+    def process_row(url):
+        raise AssertionError('the coroutine should be used')
+
+    async def process_row_async(url):
+        calls.append(url)
+        return {'url': url}
+
+    driver = ModuleType('geff.drivers.process_fake')
+    driver.process_row = process_row
+    driver.process_row_async = process_row_async
+    driver.is_idempotent = lambda url: True
+
+    with patch('lambda_src.lambda_function.import_module', return_value=driver):
+        result = process_batch(
+            {'url': '{0}'},
+            '',
+            'batch',
+            [[0, 'a'], [1, 'b'], [2, 'a']],
+            '/fake',
+            None,
+            concurrency=2,
+            dedupe=True,
+            use_async=True,
+        )
+
+    assert result == [[0, {'url': 'a'}], [1, {'url': 'b'}], [2, {'url': 'a'}]]
+    assert sorted(calls) == ['a', 'b']
+
+
+def test_process_batch_async_raises_row_exceptions():
+    async def process_row_async(url):
+        return {'url': url}
+
+    driver = ModuleType('geff.drivers.process_fake')
+    driver.process_row = lambda url: None
+    driver.process_row_async = process_row_async
+
+    with patch('lambda_src.lambda_function.import_module', return_value=driver):
+        with raises(IndexError):
+            process_batch(
+                {'url': '{3}'},
+                '',
+                'batch',
+                [[0, 'a'], [1, 'b']],
+                '/fake',
+                None,
+                concurrency=2,
+                use_async=True,
+                deadline=monotonic() + 5,
+            )
@@ -0,0 +1,75 @@
+from json import dumps
+from urllib.parse import parse_qsl, urlparse
+
+from pytest import raises
+from utils import mock_response, patch
+
+from lambda_src.drivers.process_https import parse_cursor, process_row
+
+
+def paged_api(items: list, page_size: int):
+    def urlopen(req):
+        query = dict(parse_qsl(urlparse(req.full_url).query))
+        page = int(query['page'])
+        body = {'items': items[(page - 1) * page_size : page * page_size]}
+        return mock_response({'Content-Type': 'application/json'}, dumps(body).encode())
+
+    return urlopen
+
+
+def requested_pages(mock_urlopen) -> list:
+    return sorted(
+        int(dict(parse_qsl(urlparse(c[0][0].full_url).query))['page'])
+        for c in mock_urlopen.call_args_list
+    )
+
+
+@patch('lambda_src.drivers.process_https.urlopen')
+def test_numeric_pagination_stops_at_short_page(mock_urlopen):
+    mock_urlopen.side_effect = paged_api(list(range(10)), 3)
+
+    result = process_row(
+        url='https://api.eg.com/items',
+        cursor='{"param": "page", "strategy": "numeric", "prefetch": 3}',
+        results_path='items',
+    )
+
+    assert result == list(range(10))
+    assert requested_pages(mock_urlopen)[:4] == [1, 2, 3, 4]
+    assert max(requested_pages(mock_urlopen)) <= 6
+
+
+@patch('lambda_src.drivers.process_https.urlopen')
+def test_numeric_pagination_stops_at_empty_page(mock_urlopen):
+    mock_urlopen.side_effect = paged_api(list(range(6)), 3)
+
+    result = process_row(
+        url='https://api.eg.com/items',
+        cursor='{"param": "page", "strategy": "numeric"}',
+        results_path='items',
+    )
+
+    assert result == list(range(6))
+    assert requested_pages(mock_urlopen) == [1, 2, 3]
+
+
+@patch('lambda_src.drivers.process_https.urlopen')
+def test_numeric_pagination_honours_page_limit(mock_urlopen):
+    mock_urlopen.side_effect = paged_api(list(range(100)), 3)
+
+    result = process_row(
+        url='https://api.eg.com/items?page=2',
+        cursor='{"param": "page", "strategy": "numeric", "prefetch": 8}',
+        results_path='items',
+        page_limit=2,
+    )
+
+    assert result == [3, 4, 5, 6, 7, 8]
+    assert requested_pages(mock_urlopen) == [2, 3]
+
+
+def test_cursors_without_a_param_or_path_are_rejected():
+    with raises(ValueError, match='numeric cursor needs a param or body'):
+        parse_cursor('{"strategy": "numeric", "prefetch": 2}')
+    with raises(ValueError, match='cursor needs a path'):
+        parse_cursor('{"param": "page"}')
@@ -0,0 +1,92 @@
+from email.message import EmailMessage
+from io import BytesIO
+from urllib.error import HTTPError, URLError
+
+from time import monotonic
+
+from utils import mock_urlopen_with_responses, mock_response, mock_urlopen, patch, Mock
+
+from lambda_src.drivers.process_https import (
+    RETRY_MAX_DELAY_SECONDS,
+    parse_retry_after,
+    process_row,
+)
+from lambda_src.utils import (
+    remaining_seconds,
+    row_remaining_seconds,
+    set_deadline,
+    set_row_deadline,
+)
+
+
+def http_error(code: int, headers: dict = {}) -> HTTPError:
+    message = EmailMessage()
+    for key, value in headers.items():
+        message[key] = value
+    return HTTPError('https://api.eg.com/items', code, 'Error', message, BytesIO(b''))
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('7') == 7.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+    assert parse_retry_after('soon') is None
+
+
+@mock_urlopen_with_responses(
+    http_error(503, {'Retry-After': '2'}),
+    URLError('timed out'),
+    mock_response({'Content-Type': 'application/json'}, b'[1]'),
+)
+@patch('lambda_src.drivers.process_https.sleep')
+def test_process_row_retries_transient_errors(mock_sleep, mock_urlopen):
+    assert process_row(url='https://api.eg.com/items') == [1]
+    assert mock_urlopen.call_count == 3
+    assert mock_sleep.call_args_list[0][0] == (2.0,)
+    assert 0 <= mock_sleep.call_args_list[1][0][0] <= 1
+
+
+@mock_urlopen_with_responses(http_error(502), http_error(502))
+@patch('lambda_src.drivers.process_https.sleep')
+def test_process_row_retries_post_only_when_unprocessed(mock_sleep, mock_urlopen):
+    result = process_row(url='https://api.eg.com/items', method='post', data='{}')
+    assert result['status'] == 502
+    assert mock_urlopen.call_count == 1
+
+
+@mock_urlopen_with_responses(http_error(429), http_error(429), http_error(429))
+@patch('lambda_src.drivers.process_https.sleep')
+def test_process_row_gives_up_after_retries(mock_sleep, mock_urlopen):
+    result = process_row(url='https://api.eg.com/items', retries=2)
+    assert result['status'] == 429
+    assert mock_urlopen.call_count == 3
+
+
+@mock_urlopen_with_responses(http_error(429, {'Retry-After': '60'}), http_error(429))
+@patch('lambda_src.drivers.process_https.row_remaining_seconds', return_value=10.0)
+@patch('lambda_src.drivers.process_https.sleep')
+def test_process_row_does_not_retry_past_deadline(mock_sleep, _, mock_urlopen):
+    result = process_row(url='https://api.eg.com/items')
+    assert result['status'] == 429
+    assert mock_urlopen.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+@mock_urlopen_with_responses(
+    http_error(429, {'Retry-After': '120'}),
+    mock_response({'Content-Type': 'application/json'}, b'[1]'),
+)
+@patch('lambda_src.drivers.process_https.sleep')
+def test_process_row_caps_retry_after(mock_sleep, mock_urlopen):
+    assert process_row(url='https://api.eg.com/items') == [1]
+    assert mock_sleep.call_args[0] == (RETRY_MAX_DELAY_SECONDS,)
+
+
+def test_row_deadline_limits_remaining_seconds():
+    set_deadline(Mock(get_remaining_time_in_millis=lambda: 900_000))
+    set_row_deadline(monotonic() + 25)
+    try:
+        assert 24 < row_remaining_seconds() <= 25
+        assert remaining_seconds() > 800
+    finally:
+        set_deadline(None)
@@ -0,0 +1,101 @@
+import smtplib
+
+from pytest import raises
+from utils import patch, Mock, fixture
+
+from lambda_src.drivers import process_smtp
+from lambda_src.drivers.process_smtp import process_row, clear_sessions
+
+
+@fixture(autouse=True)
+def empty_pool():
+    clear_sessions()
+    yield
+    clear_sessions()
+
+
+def smtp_server() -> Mock:
+    server = Mock()
+    server.noop.return_value = (250, b'OK')
+    server.sendmail.return_value = {}
+    return server
+
+
+def send(recipient='a@eg.com'):
+    return process_row(
+        recipient,
+        'hello',
+        user='me@eg.com',
+        password='secret',
+        host='smtp.eg.com',
+    )
+
+
+def test_session_is_reused_across_rows():
+    server = smtp_server()
+
+    with patch('smtplib.SMTP', return_value=server) as new_server:
+        assert send('a@eg.com') == {}
+        assert send('b@eg.com') == {}
+
+    assert new_server.call_count == 1
+    server.starttls.assert_called_once()
+    server.login.assert_called_once_with('me@eg.com', 'secret')
+    assert server.sendmail.call_count == 2
+    server.close.assert_not_called()
+
+
+def test_disconnected_session_is_replaced():
+    stale, fresh = smtp_server(), smtp_server()
+    stale.noop.side_effect = smtplib.SMTPServerDisconnected()
+
+    with patch('smtplib.SMTP', side_effect=[stale, fresh]) as new_server:
+        send('a@eg.com')
+        assert send('b@eg.com') == {}
+
+    assert new_server.call_count == 2
+    stale.close.assert_called_once()
+    assert stale.sendmail.call_count == 1
+    assert fresh.sendmail.call_args[0][1] == ['b@eg.com']
+
+
+def test_disconnects_while_sending_are_not_retried():
+    server = smtp_server()
+    server.sendmail.side_effect = [{}, smtplib.SMTPServerDisconnected()]
+
+    with patch('smtplib.SMTP', return_value=server) as new_server:
+        send('a@eg.com')
+        with raises(smtplib.SMTPServerDisconnected):
+            send('b@eg.com')
+
+    assert new_server.call_count == 1
+    assert server.sendmail.call_count == 2
+    server.close.assert_called_once()  # the session is not reused
+
+
+def test_session_is_renewed_after_max_messages():
+    first, second = smtp_server(), smtp_server()
+
+    with patch.object(process_smtp, 'MAX_MESSAGES_PER_SESSION', 2):
+        with patch('smtplib.SMTP', side_effect=[first, second]) as new_server:
+            for _ in range(3):
+                send()
+
+    assert new_server.call_count == 2
+    first.quit.assert_called_once()
+    assert first.sendmail.call_count == 2
+    assert second.sendmail.call_count == 1
+
+
+def test_sessions_are_keyed_by_credentials():
+    with patch('smtplib.SMTP', side_effect=[Mock(), Mock()]) as new_server:
+        send()
+        process_row(
+            'a@eg.com',
+            'hello',
+            user='you@eg.com',
+            password='secret',
+            host='smtp.eg.com',
+        )
+
+    assert new_server.call_count == 2
@@ -0,0 +1,29 @@
+from lambda_src.utils import compile_format, format, format_row
+
+
+def test_format_whole_value_reference():
+    assert format('{0}', [{'a': 'b'}]) == {'a': 'b'}
+    assert format('{1}', ['a', 2]) == 2
+
+
+def test_format_embedded_references():
+    assert format('{"z": [{0}]}', [{'a': 'b'}]) == '{"z": [{"a": "b"}]}'
+    assert format('ipAddress={0}&maxAgeInDays={1}', ['1.1.1.1', 90]) == (
+        'ipAddress=1.1.1.1&maxAgeInDays=90'
+    )
+    assert format('x={0}&y={3}&z={01}', ['a']) == 'x=a&y={3}&z={01}'
+    assert format('no refs', []) == 'no refs'
+
+
+def test_format_row_shares_serialized_params():
+    templates = {
+        'url': compile_format('/api/{0}'),
+        'json': compile_format('{"ids": {1}, "kind": "{0}"}'),
+        'data': compile_format('{1}'),
+    }
+
+    assert format_row(templates, ['users', [1, 2]]) == {
+        'url': '/api/users',
+        'json': '{"ids": [1, 2], "kind": "users"}',
+        'data': [1, 2],
+    }
@@ -0,0 +1,26 @@
+from base64 import b64decode
+from gzip import decompress
+from json import dumps, loads
+
+from lambda_src.utils import GzipResponseBuilder
+
+
+def test_gzip_response_builder_matches_full_serialization():
+    res_data = [[0, {'a': [1, 2]}], [1, 'text'], [2, [{'error': 'HTTPError'}]]]
+    response_builder = GzipResponseBuilder()
+    for row in res_data:
+        response_builder.add_row(row)
+
+    response = response_builder.finish()
+
+    assert decompress(b64decode(response['body'])).decode() == dumps({'data': res_data})
+    assert response_builder.size == len(dumps(response))
+    assert response['headers'] == {'Content-Encoding': 'gzip'}
+
+
+def test_gzip_response_builder_empty_batch():
+    response_builder = GzipResponseBuilder()
+    response = response_builder.finish()
+
+    assert loads(decompress(b64decode(response['body']))) == {'data': []}
+    assert response_builder.size == len(dumps(response))
@@ -0,0 +1,38 @@
+from lambda_src.utils import compile_pointer, pick
+
+DATA = {
+    'data': {
+        'items': [
+            {'id': 1, 'tags': [{'name': 'a'}, {'name': 'b'}]},
+            {'id': 2, 'tags': []},
+            {'name': 'no id'},
+        ],
+        'a.b': 'quoted',
+        'by_name': {'x': {'id': 'x1'}, 'y': {'id': 'y1'}},
+    }
+}
+
+
+def test_pick_paths():
+    assert pick('', DATA) is DATA
+    assert pick('data.items[0].id', DATA) == 1
+    assert pick('data.items[-1].name', DATA) == 'no id'
+    assert pick("data.'a.b'", DATA) == 'quoted'
+    assert pick('data.items[5].id', DATA) is None
+    assert pick('data.missing.id', DATA) is None
+
+
+def test_pick_wildcard_projection():
+    assert pick('data.items[*].id', DATA) == [1, 2]
+    assert pick('data.items[*].tags[*].name', DATA) == [['a', 'b'], []]
+    assert pick('data.by_name[*].id', DATA) == ['x1', 'y1']
+    assert pick("data.'a.b'[*]", DATA) is None
+
+
+def test_pick_compiles_pointers_once():
+    compile_pointer.cache_clear()
+
+    for _ in range(3):
+        pick('data.items[*].id', DATA)
+
+    assert compile_pointer.cache_info().misses == 1
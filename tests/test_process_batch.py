@@ -0,0 +1,304 @@
+from base64 import b64decode
+from gzip import decompress
+from json import dumps, loads
+from os import urandom
+from time import monotonic, sleep
+from timeit import default_timer as timer
+from types import ModuleType
+
+from utils import fixture, patch, Mock
+
+from lambda_src.lambda_function import (
+    DEADLINE_ERROR,
+    get_cache_ttl,
+    get_concurrency,
+    get_deadline,
+    lambda_handler,
+    process_batch,
+    resolve_driver,
+)
+
+
+def process_row(value, delay='0'):
+    sleep(float(delay))
+    if value == 'boom':
+        raise ValueError(value)
+    return {'value': value}
+
+
+def fake_driver(**attributes) -> ModuleType:
+    module = ModuleType('geff.drivers.process_fake')
+    module.__dict__.update(process_row=process_row, **attributes)
+    return module
+
+
+@fixture(autouse=True)
+def clear_resolved_drivers():
+    resolve_driver.cache_clear()
+    yield
+    resolve_driver.cache_clear()
+
+
+def test_process_batch_dedupe_calls_idempotent_drivers_once():
+    calls = []
+
+    def counting_process_row(value, delay='0'):
+        calls.append(value)
+        return process_row(value, delay)
+
+    driver = fake_driver(is_idempotent=lambda value, delay='0': value != 'write')
+    driver.process_row = counting_process_row
+    rows = [[0, 'a'], [1, 'boom'], [2, 'a'], [3, 'boom'], [4, 'write'], [5, 'write']]
+
+    with patch('lambda_src.lambda_function.import_module', return_value=driver):
+        result = process_batch(
+            {'value': '{0}', 'delay': '0.05'},
+            '',
+            'batch-id-123',
+            rows,
+            '/fake',
+            None,
+            concurrency=4,
+            dedupe=True,
+        )
+
+    assert result[0] == [0, {'value': 'a'}]
+    assert result[2] == [2, {'value': 'a'}]
+    assert result[1][1][0]['error'] == result[3][1][0]['error'] == "ValueError('boom')"
+    assert result[4] == [4, {'value': 'write'}]
+    assert result[5] == [5, {'value': 'write'}]
+    # write is called for each row as it is not idempotent
+    assert sorted(calls) == ['a', 'boom', 'write', 'write']
+
+
+@patch(
+    'lambda_src.lambda_function.import_module',
+    return_value=fake_driver(),
+)
+def test_process_batch_concurrent_keeps_row_order(mock_import_module):
+    result = process_batch(
+        {'value': '{0}', 'delay': '{1}'},
+        '',
+        'batch-id-123',
+        [[0, 'a', 0.2], [1, 'boom', 0], [2, 'c', 0.1], [3, 'd', 0]],
+        '/fake',
+        None,
+        concurrency=4,
+    )
+
+    assert [row_number for row_number, _ in result] == [0, 1, 2, 3]
+    assert result[0] == [0, {'value': 'a'}]
+    assert result[1][1][0]['error'] == "ValueError('boom')"
+    assert result[2] == [2, {'value': 'c'}]
+    assert result[3] == [3, {'value': 'd'}]
+    assert mock_import_module.call_count == 1
+
+
+@patch(
+    'lambda_src.lambda_function.import_module',
+    return_value=fake_driver(CONCURRENCY=4),
+)
+def test_get_concurrency(mock_import_module):
+    assert get_concurrency('16', '/fake') == 16
+    assert get_concurrency('1000', '/fake') == 64
+    assert get_concurrency(None, '/fake') == 4
+    assert get_concurrency('lots', '/fake') == 4
+
+
+def test_get_cache_ttl():
+    assert get_cache_ttl(None) == 0
+    assert get_cache_ttl('300') == 300
+    assert get_cache_ttl('5m') == 0
+    assert get_cache_ttl('-1') == 0
+    assert get_cache_ttl('nan') == 0
+
+
+@patch('lambda_src.lambda_function.LAMBDA_RESPONSE_MAX_BYTES', 150_000)
+@patch('lambda_src.lambda_function.import_module', return_value=fake_driver())
+def test_sync_flow_stops_processing_rows_too_large_to_return(mock_import_module):
+    processed = []
+
+    def process_large_row(value):
+        processed.append(value)
+        return urandom(40_000).hex()
+
+    mock_import_module.return_value.process_row = process_large_row
+    response = lambda_handler(
+        {
+            'path': '/fake',
+            'headers': {
+                'sf-external-function-query-batch-id': 'batch-id-123',
+                'sf-custom-value': '{0}',
+            },
+            'body': dumps({'data': [[n, n] for n in range(10)]}),
+        },
+        None,
+    )
+
+    assert len(processed) < 10
+    assert loads(response['body'])['data'][9][1]['error'].startswith('Response size')
+
+
+@patch(
+    'lambda_src.lambda_function.import_module',
+    return_value=fake_driver(),
+)
+def test_process_batch_returns_completed_rows_at_deadline(mock_import_module):
+    rows = [[0, 'a', 0], [1, 'b', 1], [2, 'c', 0.1], [3, 'd', 0]]
+    started = monotonic()
+    result = process_batch(
+        {'value': '{0}', 'delay': '{1}'},
+        '',
+        'batch-id-123',
+        rows,
+        '/fake',
+        None,
+        concurrency=2,
+        deadline=monotonic() + 0.3,
+    )
+
+    assert monotonic() - started < 0.6
+    assert result[0] == [0, {'value': 'a'}]
+    assert result[1][1][0]['error'].startswith('TimeoutError(')
+    assert result[2] == [2, {'value': 'c'}]
+    assert result[3] == [3, {'value': 'd'}]
+
+
+@patch(
+    'lambda_src.lambda_function.import_module',
+    return_value=fake_driver(),
+)
+def test_process_batch_stops_dispatching_at_deadline(mock_import_module):
+    started = monotonic()
+    result = process_batch(
+        {'value': '{0}', 'delay': '{1}'},
+        '',
+        'batch-id-123',
+        [[0, 'a', 0.05], [1, 'b', 0.3], [2, 'c', 0]],
+        '/fake',
+        None,
+        deadline=monotonic() + 0.1,
+    )
+
+    # the row running at the deadline is abandoned rather than waited for
+    assert monotonic() - started < 0.25
+    assert result[0] == [0, {'value': 'a'}]
+    assert [row[1][0]['error'][:13] for row in result[1:]] == ['TimeoutError('] * 2
+
+
+@patch('lambda_src.lambda_function.remaining_seconds', return_value=600.0)
+def test_get_deadline(mock_remaining_seconds):
+    now = monotonic()
+
+    # API Gateway times out first
+    deadline = get_deadline({'httpMethod': 'POST'}, timer())
+    assert 26 < deadline - now < 28
+
+    # only the Lambda timeout applies to invocations by the base lambda
+    deadline = get_deadline({}, timer())
+    assert 596 < deadline - now < 598
+
+    mock_remaining_seconds.return_value = None
+    assert get_deadline({}, timer()) is None
+
+
+@patch('lambda_src.lambda_function.BatchCheckpoint')
+@patch('lambda_src.lambda_function.get_checkpoints', return_value={1: {'value': 'b'}})
+@patch('lambda_src.lambda_function.claim_batch', return_value=(True, 1))
+@patch('lambda_src.lambda_function.BATCH_LOCKING_ENABLED', True)
+@patch(
+    'lambda_src.lambda_function.import_module',
+    return_value=fake_driver(),
+)
+def test_sync_flow_resumes_from_checkpoints(
+    mock_import_module, mock_claim_batch, mock_get_checkpoints, mock_checkpoint
+):
+    processed = []
+
+    def process_row(value):
+        processed.append(value)
+        if value == 'c':
+            return {'error': 'HTTPError', 'status': 429}
+        return {'value': value}
+
+    mock_import_module.return_value.process_row = process_row
+    response = lambda_handler(
+        {
+            'path': '/fake',
+            'headers': {
+                'sf-external-function-query-batch-id': 'batch-id-123',
+                'sf-custom-value': '{0}',
+            },
+            'body': dumps({'data': [[0, 'a'], [1, 'b'], [2, 'c']]}),
+        },
+        None,
+    )
+
+    assert processed == ['a', 'c']
+    assert loads(decompress(b64decode(response['body'])))['data'] == [
+        [0, {'value': 'a'}],
+        [1, {'value': 'b'}],
+        [2, {'error': 'HTTPError', 'status': 429}],
+    ]
+    mock_get_checkpoints.assert_called_once_with('batch-id-123', 1)
+    checkpointed = [c[0][0][0] for c in mock_checkpoint.return_value.add.call_args_list]
+    # the failed row is retried when the batch is resumed again
+    assert checkpointed == [0]
+
+
+def test_process_batch_sends_all_rows_to_process_rows():
+    batches = []
+
+    def process_rows(rows):
+        batches.append(rows)
+        return [ValueError(r['value']) if r['value'] == 'bad' else None for r in rows]
+
+    driver = fake_driver(process_rows=process_rows)
+
+    with patch('lambda_src.lambda_function.import_module', return_value=driver):
+        result = process_batch(
+            {'value': '{0}'},
+            '',
+            'batch-id-123',
+            [[0, 'a'], [1, 'bad'], [2, 'b']],
+            '/fake',
+            None,
+            concurrency=4,
+        )
+
+    assert batches == [[{'value': 'a'}, {'value': 'bad'}, {'value': 'b'}]]
+    assert result[0] == [0, None]
+    assert result[1][1][0]['error'] == "ValueError('bad')"
+    assert result[2] == [2, None]
+
+
+def test_process_batch_bulk_can_be_opted_into():
+    def process_rows(rows):
+        return [{'bulk': r['value']} for r in rows]
+
+    driver = fake_driver(process_rows=process_rows, BULK=False)
+
+    with patch('lambda_src.lambda_function.import_module', return_value=driver):
+        args = ({'value': '{0}'}, '', 'batch-id-123', [[0, 'a']], '/fake', None)
+        assert process_batch(*args) == [[0, {'value': 'a'}]]
+        assert process_batch(*args, bulk=True) == [[0, {'bulk': 'a'}]]
+
+
+def test_rows_abandoned_at_the_deadline_are_not_written():
+    destination = Mock()
+
+    with patch('lambda_src.lambda_function.import_module', return_value=fake_driver()):
+        result = process_batch(
+            {'value': '{0}', 'delay': '{1}'},
+            's3://bucket/prefix/',
+            'batch-id-123',
+            [[0, 'a', '0'], [1, 'b', '0.3']],
+            '/fake',
+            destination,
+            concurrency=2,
+            deadline=monotonic() + 0.1,
+        )
+        sleep(0.4)
+
+    assert result[1][1] == [{'error': DEADLINE_ERROR}]
+    assert [c[0][3] for c in destination.write.call_args_list] == [0]
@@ -0,0 +1,86 @@
+from pytest import raises
+from utils import patch
+
+from lambda_src import rate_limit
+from lambda_src.rate_limit import RateLimit, TokenBucket, parse_rate_limit, strictest
+
+
+def test_parse_rate_limit():
+    assert parse_rate_limit('') is None
+    assert parse_rate_limit(None) is None
+    assert parse_rate_limit('5') == RateLimit(5.0, 5.0, False)
+    assert parse_rate_limit('0.5') == RateLimit(0.5, 1.0, False)
+    assert parse_rate_limit('{"rate": 2, "burst": 10, "shared": true}') == RateLimit(
+        2.0, 10.0, True
+    )
+    assert parse_rate_limit({'rate': 3}) == RateLimit(3.0, 3.0, False)
+    with raises(ValueError):
+        parse_rate_limit('{"rate": 5, "burst": 0.5}')
+
+
+def test_strictest():
+    assert strictest(None, None) is None
+    assert strictest(RateLimit(5, 10, False), RateLimit(2, 20, True)) == RateLimit(
+        2, 10, True
+    )
+
+
+def test_token_bucket_paces_after_burst():
+    clock = [100.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    with patch.object(rate_limit, 'monotonic', lambda: clock[0]), patch.object(
+        rate_limit, 'sleep', sleep
+    ):
+        bucket = TokenBucket(rate=2, burst=2)
+        waits = [bucket.acquire() for _ in range(4)]
+
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2:] == [0.5, 0.5]
+    assert clock[0] == 101.0
+
+
+def test_token_bucket_gives_up_at_timeout():
+    with patch.object(rate_limit, 'sleep') as sleep:
+        bucket = TokenBucket(rate=0.1, burst=1)
+        assert bucket.acquire(timeout=5) == 0.0
+        with raises(TimeoutError):
+            bucket.acquire(timeout=5)
+
+    sleep.assert_not_called()
+
+
+def test_alternating_limits_share_tokens():
+    clock = [100.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    with patch.object(rate_limit, 'monotonic', lambda: clock[0]), patch.object(
+        rate_limit, 'sleep', sleep
+    ):
+        rate_limit._buckets.clear()
+        for i in range(6):
+            rate_limit.acquire('api.eg.com', RateLimit(2, 2 + i % 2, False))
+
+    # a new burst for every change of limit would have taken no time
+    assert clock[0] >= 101.5
+
+
+def test_acquire_shared_waits_for_next_window():
+    clock = [1000.2]
+    counts = iter([3, 1])
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    with patch.object(rate_limit, 'BATCH_LOCKING_ENABLED', True), patch.object(
+        rate_limit, 'count_request', lambda key, ttl: next(counts)
+    ), patch.object(rate_limit, 'time', lambda: clock[0]), patch.object(
+        rate_limit, 'sleep', sleep
+    ):
+        waited = rate_limit.acquire_shared('example.com', RateLimit(2, 2, True))
+
+    assert round(waited, 6) == 0.8
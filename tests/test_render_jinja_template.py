@@ -4,7 +4,10 @@ from time import time
 from hashlib import sha256
 from hmac import new as new_hmac
 
-from lambda_src.drivers.process_https import render_jinja_template
+from lambda_src.drivers.process_https import (
+    compile_jinja_template,
+    render_jinja_template,
+)
 
 
 def test_render_jinja_template():
@@ -31,3 +34,21 @@ def test_render_jinja_template():
             ),
         },
     )
+
+
+def test_render_jinja_template_without_template_syntax():
+    auth = '{"host": "api.eg.com", "bearer": "abc"}\n'
+
+    assert render_jinja_template(auth, {'path': '/'}, {}) == auth[:-1]
+
+
+def test_render_jinja_template_reuses_compiled_templates():
+    auth = '{"host": "api.eg.com", "authorization": "{{query}}"}'
+    compile_jinja_template.cache_clear()
+
+    for query in ('from=0', 'from=1'):
+        assert render_jinja_template(auth, {'query': query}, {}) == (
+            '{"host": "api.eg.com", "authorization": "' + query + '"}'
+        )
+
+    assert compile_jinja_template.cache_info().misses == 1
@@ -0,0 +1,92 @@
+from json import dumps
+from types import ModuleType
+from urllib.parse import urlparse
+
+from utils import Mock, fixture, patch
+
+from lambda_src import result_cache
+from lambda_src.lambda_function import process_batch, resolve_driver
+from lambda_src.utils import DataMetadata
+
+
+@fixture(autouse=True)
+def clear_cache():
+    result_cache.clear()
+    resolve_driver.cache_clear()
+    yield
+    result_cache.clear()
+    resolve_driver.cache_clear()
+
+
+def test_cache_key_ignores_argument_order():
+    assert result_cache.cache_key('/https', {'a': 1, 'b': 2}) == (
+        result_cache.cache_key('/https', {'b': 2, 'a': 1})
+    )
+    assert result_cache.cache_key('/https', {'a': 1}) != (
+        result_cache.cache_key('/boto3', {'a': 1})
+    )
+
+
+def test_local_tier_expires_and_skips_errors():
+    with patch.object(result_cache, 'time', return_value=1000.0):
+        result_cache.put('k', DataMetadata([1], None), 60)
+        result_cache.put('e', DataMetadata({'error': 'HTTPError'}, None), 60)
+        assert result_cache.get('k') == DataMetadata([1], None)
+        assert result_cache.get('e') is None
+
+    with patch.object(result_cache, 'time', return_value=1061.0):
+        assert result_cache.get('k') is None
+
+
+def test_shared_s3_tier():
+    s3 = Mock()
+    s3.get_object.return_value = {
+        'Metadata': {'expires-at': '2000'},
+        'Body': Mock(read=Mock(return_value=dumps([{'a': 1}, 'meta']).encode())),
+    }
+
+    with patch.object(
+        result_cache, '_shared_uri', urlparse('s3://bucket/cache/')
+    ), patch.object(result_cache, 's3', s3, create=True), patch.object(
+        result_cache, 'time', return_value=1000.0
+    ):
+        assert result_cache.get('k') == DataMetadata({'a': 1}, 'meta')
+        s3.get_object.assert_called_once_with(Bucket='bucket', Key='cache/k')
+
+        # served by the local tier from now on
+        assert result_cache.get('k') == DataMetadata({'a': 1}, 'meta')
+        assert s3.get_object.call_count == 1
+
+        result_cache.put('b', DataMetadata(b'bytes', None), 60)
+        s3.put_object.assert_not_called()
+
+        result_cache.put('j', DataMetadata([1], None), 60)
+        assert s3.put_object.call_args[1]['Metadata'] == {'expires-at': '1060'}
+
+
+def test_process_batch_uses_cache_for_read_only_calls():
+    calls = []
+
+    def process_row(value, method='get'):
+        calls.append(value)
+        return {'value': value}
+
+    driver = ModuleType('geff.drivers.process_fake')
+    driver.__dict__.update(
+        process_row=process_row,
+        is_read_only=lambda value, method='get': method == 'get',
+    )
+
+    with patch('lambda_src.lambda_function.import_module', return_value=driver):
+        for _ in range(2):
+            process_batch(
+                {'value': '{0}', 'method': '{1}'},
+                '',
+                'batch-id-123',
+                [[0, 'a', 'get'], [1, 'b', 'post']],
+                '/fake',
+                None,
+                cache_ttl=60,
+            )
+
+    assert calls == ['a', 'b', 'b']
@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+from pytest import raises
+from utils import patch
+
+from lambda_src import vault
+
+ARN = 'arn:aws:secretsmanager:us-west-2:123456789012:secret:prod/geff/test-abcdef'
+
+
+def get_secret_value(SecretId):
+    sleep(0.05)
+    return {'SecretString': f'plaintext of {SecretId}'}
+
+
+@patch('lambda_src.vault.secretsmanager')
+def test_secrets_are_fetched_once(mock_secretsmanager):
+    mock_secretsmanager.get_secret_value.side_effect = get_secret_value
+    vault.invalidate(ARN)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        plaintexts = list(executor.map(vault.decrypt_if_encrypted, [ARN] * 16))
+
+    assert plaintexts == [f'plaintext of {ARN}'] * 16
+    assert mock_secretsmanager.get_secret_value.call_count == 1
+
+    vault.invalidate(ARN)
+    vault.decrypt_if_encrypted(ARN)
+    assert mock_secretsmanager.get_secret_value.call_count == 2
+
+
+@patch('lambda_src.vault.SECRET_CACHE_TTL_SECONDS', 0)
+@patch('lambda_src.vault.secretsmanager')
+def test_expired_secrets_are_fetched_again(mock_secretsmanager):
+    mock_secretsmanager.get_secret_value.side_effect = get_secret_value
+    vault.invalidate(ARN)
+
+    vault.decrypt_if_encrypted(ARN)
+    vault.decrypt_if_encrypted(ARN)
+
+    assert mock_secretsmanager.get_secret_value.call_count == 2
+
+
+@patch('lambda_src.vault.secretsmanager')
+def test_failed_fetches_are_not_cached(mock_secretsmanager):
+    mock_secretsmanager.get_secret_value.side_effect = [
+        ValueError('throttled'),
+        {'SecretString': 'plaintext'},
+    ]
+    vault.invalidate(ARN)
+
+    with raises(ValueError):
+        vault.decrypt_if_encrypted(ARN)
+    assert ARN not in vault._inflight
+
+    assert vault.decrypt_if_encrypted(ARN) == 'plaintext'
+    assert ARN not in vault._inflight
+
+
+def test_plaintext_is_returned_as_is():
+    assert vault.decrypt_if_encrypted('{"host": "api.eg.com"}') == (
+        '{"host": "api.eg.com"}'
+    )
+    assert vault.decrypt_if_encrypted(None) is None